@@ -0,0 +1,140 @@
+# src/activity_store.py
+from __future__ import annotations
+from src.engine import EngineProfile, connect
+from src.date_dim import day_key
+from src.prefix_sums import MISSING_TIME, US_PER_DAY, PrefixSums
+from pathlib import Path
+from datetime import date, timedelta
+import numpy as np
+
+### notes on the activity store:
+    # a compact per-user record of daily activity over a fixed day range, in one activity.npz:
+    # - users:        sorted User_id_code
+    # - visit_bits:   one bitset per user (np.packbits over the days): bit set = the user visited that day
+    # - order_users, order_days, order_counts: the (user index, day index, uint16 number of orders paid)
+    #   of every day with an order
+    # - start_day:    day key (days since 1970-01-01) of the first day; n_days: length of the range
+    # it is built from the active (user, day) pairs: nothing of size users x days is allocated but the bitsets.
+    # without any activity nor a given range the store is empty, with a range of 0 days.
+    # on load only the active (user, day) cells are kept: the set bits of the nonzero bitset bytes and the
+    # order records, as per-user dated records with running counts (see src/prefix_sums.py).
+    # a window's visit frequency (a popcount) and purchase frequency (a slice sum) are then two binary
+    # searches per query, and memory grows with the active days, not with users x days.
+    # visits are counted per day: the same as counting visit rows when there is one row per user and day
+    # (the deduplicated daily login records), as are the receipts' dates.
+
+_ACTIVITY = "activity.npz"
+
+
+def build_activity_store(
+        txns_parquet: Path,
+        visits_parquet: Path,
+        store_dir: Path,
+        start: date | None = None,  # None: the first day with a visit or an order
+        end: date | None = None,    # None: the last day with a visit or an order
+        threads: int = 8,
+        engine: EngineProfile | str | None = None
+) -> None:
+    """Build the per-user visit bitsets and daily order counts from all txns and visits."""
+    con = connect(engine, threads)
+    con.execute(f"""
+        CREATE OR REPLACE TABLE visit_days AS
+            SELECT DISTINCT User_id_code, {day_key("Visit_date")} AS d
+            FROM read_parquet(?)
+            WHERE User_id_code IS NOT NULL AND Visit_date IS NOT NULL
+    """, [str(visits_parquet)])
+    con.execute(f"""
+        CREATE OR REPLACE TABLE order_days AS
+            WITH per_order AS (
+                SELECT User_id_code, Pay_date, Order_id_code
+                FROM read_parquet(?)
+                WHERE User_id_code IS NOT NULL AND Pay_date IS NOT NULL
+                GROUP BY 1,2,3
+            )
+            SELECT User_id_code, {day_key("Pay_date")} AS d, COUNT(Order_id_code) AS n_orders
+            FROM per_order
+            GROUP BY 1,2
+    """, [str(txns_parquet)])
+    visits = con.execute("SELECT User_id_code, d FROM visit_days").fetchnumpy()
+    orders = con.execute("SELECT User_id_code, d, n_orders FROM order_days").fetchnumpy()
+    con.close()
+
+    store_dir = Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+    days = np.concatenate([visits["d"], orders["d"]])
+    if not len(days) and (start is None or end is None):
+        # nothing to range over: an empty store of 0 days
+        start_day = (start - date(1970, 1, 1)).days if start is not None else 0
+        end_day = start_day - 1
+    else:
+        start_day = (start - date(1970, 1, 1)).days if start is not None else int(days.min())
+        end_day = (end - date(1970, 1, 1)).days if end is not None else int(days.max())
+    if len(days) and (days.min() < start_day or days.max() > end_day):
+        raise ValueError(f"activity outside [{start}, {end}]; widen the day range")
+    if len(orders["n_orders"]) and orders["n_orders"].max() > np.iinfo(np.uint16).max:
+        raise ValueError("more than 65535 orders of one user on one day")
+    n_days = end_day - start_day + 1
+
+    users = np.unique(np.concatenate([visits["User_id_code"], orders["User_id_code"]]))
+    # set bit 7 - d % 8 of byte d // 8 (np.packbits' big-endian layout) of every visited (user, day)
+    vd = (visits["d"] - start_day).astype(np.int64)
+    visit_bits = np.zeros((len(users), (n_days + 7) // 8), dtype=np.uint8)
+    np.bitwise_or.at(visit_bits, (np.searchsorted(users, visits["User_id_code"]), vd // 8),
+                     (1 << (7 - vd % 8)).astype(np.uint8))
+
+    np.savez_compressed(store_dir / _ACTIVITY, users=users, visit_bits=visit_bits,
+                        order_users=np.searchsorted(users, orders["User_id_code"]),
+                        order_days=(orders["d"] - start_day).astype(np.int64),
+                        order_counts=orders["n_orders"].astype(np.uint16),
+                        start_day=start_day, n_days=n_days)
+
+
+class ActivityStore:
+    """The activity store loaded for window queries; build it with build_activity_store()."""
+
+    def __init__(self, store_dir: Path):
+        with np.load(Path(store_dir) / _ACTIVITY) as f:
+            self.users = f["users"]
+            self.start_day = int(f["start_day"])
+            self.n_days = int(f["n_days"])
+            visit_bits = f["visit_bits"]
+            orders = (f["order_users"], f["order_days"], f["order_counts"])
+
+        # visits: unpack the nonzero bytes only (packbits pads the last byte with 0 bits)
+        uidx, byte = np.nonzero(visit_bits)
+        k, bit = np.nonzero(np.unpackbits(visit_bits[uidx, byte][:, None], axis=1))
+        visits = (uidx[k], byte[k] * 8 + bit, np.ones(len(k), dtype=np.int64))
+
+        self._records = {}
+        self._sums = {}
+        for kind, (uidx, idx, counts) in {"visit_days": visits, "orders": orders}.items():
+            users, days = self.users[uidx], idx.astype(np.int64) + self.start_day
+            self._records[kind] = (users, days, counts)
+            self._sums[kind] = PrefixSums(users, days * US_PER_DAY, {"n": counts})
+
+    @property
+    def end(self) -> date:
+        return date(1970, 1, 1) + timedelta(days=self.start_day + self.n_days - 1)
+
+    def window(self, kind: str, users: np.ndarray, days: np.ndarray, window_len: int,
+               valid: np.ndarray | None = None, missing: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Activity ("visit_days" or "orders") of every query (user, day key) over the days
+        (day - window_len, day - 1], and a no-history flag: no activity up to day - window_len.
+        Queries with a missing day look at the user's whole range (no_hist only without any activity, count 0),
+        the way a missing Receive_date behaves in the as-of lookups of user_features.
+        """
+        known = np.isin(users, self.users)
+        if valid is not None:
+            known &= valid
+        missing = np.zeros(len(users), dtype=bool) if missing is None else missing
+        if (days[known & ~missing] - self.start_day > self.n_days).any():
+            raise ValueError(f"queries after the activity store's last day {self.end}")
+
+        times = np.where(missing, MISSING_TIME, days * US_PER_DAY)
+        no_hist, count = self._sums[kind].window(users, times, window_len, valid)
+        return no_hist, count["n"]
+
+    def records(self, kind: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """The store's activity ("visit_days" or "orders") as per-user dated records: (users, day keys, counts)."""
+        return self._records[kind]
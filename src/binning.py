@@ -0,0 +1,76 @@
+# src/binning.py
+from __future__ import annotations
+from src.prefix_sums import US_PER_DAY
+
+## segment binning by bucket lookup:
+    # every dimension's splits are loaded into a small bucket table (lower edge -> bin) and each row
+    # picks its bin with one ASOF join, so any number of splits costs the same single lookup.
+    # bin i holds the values in (splits[i-1], splits[i]]: the bin is the number of splits strictly below the value.
+
+
+def check_splits(name: str, splits: int | list[int]) -> list[int]:
+    splits = [splits] if isinstance(splits, int) else list(splits)
+    if not splits:
+        raise ValueError(f"[{name}] at least one split is required")
+    if any(a >= b for a, b in zip(splits, splits[1:])):
+        raise ValueError(f"[{name}] splits must be strictly increasing: {splits}")
+    return splits
+
+
+def create_bucket_table(con, name: str, splits: int | list[int], scale: int = 1) -> int:
+    """
+    Create table `name` (lower BIGINT, bin INTEGER) with one row (splits[i] * scale, i + 1) per split.
+    Return the number of bins (len(splits) + 1).
+    """
+    splits = check_splits(name, splits)
+    con.execute(f"CREATE OR REPLACE TEMP TABLE {name}(lower BIGINT, bin INTEGER)")
+    con.execute(f"INSERT INTO {name} SELECT UNNEST(?::BIGINT[]), UNNEST(?::INTEGER[])",
+                [[s * scale for s in splits], list(range(1, len(splits) + 1))])
+    return len(splits) + 1
+
+
+def bucket_join(bucket_table: str, alias: str, value_expr: str) -> str:
+    """ASOF join picking the bin of value_expr: the bucket with the largest lower edge strictly below it."""
+    return f"""
+            ASOF LEFT JOIN {bucket_table} {alias}
+                ON ({value_expr}) > {alias}.lower"""
+
+
+def create_segment_bins(
+        con,
+        source: str,
+        target: str,
+        Price_limit_bin_splits: int | list[int],
+        Coupon_limit_bin_splits: int | list[int],
+        Expiry_span_bin_split: int | list[int]
+) -> None:
+    """
+    Create table `target` as `source` plus Price_limit_bin, Coupon_limit_bin and Expiry_span_bin:
+    - Price / Coupon: bin = number of splits below the value (cents), missing values go to the last bin;
+    - Expiry: bin = number of splits below End_date - Start_date (days), -1 for a missing or negative span.
+    """
+    n_price_bins = create_bucket_table(con, "price_buckets", Price_limit_bin_splits)
+    n_coupon_bins = create_bucket_table(con, "coupon_buckets", Coupon_limit_bin_splits)
+    create_bucket_table(con, "expiry_buckets", Expiry_span_bin_split, scale=US_PER_DAY)
+
+    con.execute(f"""
+        CREATE OR REPLACE TABLE {target} AS
+        WITH spans AS (
+            SELECT *, epoch_us(End_date) - epoch_us(Start_date) AS _expiry_span_us
+            FROM {source}
+        )
+        SELECT r.* EXCLUDE (_expiry_span_us),
+            CASE
+                WHEN r.Price_limit_cent IS NULL THEN {n_price_bins - 1}
+                ELSE COALESCE(pb.bin, 0) END AS Price_limit_bin,
+            CASE
+                WHEN r.Coupon_amt_cent IS NULL THEN {n_coupon_bins - 1}
+                ELSE COALESCE(cb.bin, 0) END AS Coupon_limit_bin,
+            CASE
+                WHEN r._expiry_span_us IS NULL OR r._expiry_span_us < 0 THEN -1
+                ELSE COALESCE(eb.bin, 0) END AS Expiry_span_bin
+        FROM spans r
+        {bucket_join("price_buckets", "pb", "r.Price_limit_cent")}
+        {bucket_join("coupon_buckets", "cb", "r.Coupon_amt_cent")}
+        {bucket_join("expiry_buckets", "eb", "r._expiry_span_us")}
+    """)
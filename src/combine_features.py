@@ -1,63 +1,106 @@
 # src/combine_features.py
 from __future__ import annotations
-import duckdb
+from src.engine import EngineProfile, connect
+from src.feature_dtypes import typed_select_sql
+from src.feature_registry import LABEL_COLUMNS, RECEIPT_COLUMNS, feature_spec, load_feature_selection, registered_columns
 from pathlib import Path
-import pandas as pd
-from datetime import date
-import datetime
+import pyarrow.parquet as pq
+
+## combining:
+    # one SELECT over the feature tables, joined on receipt_key: every column is read from the table that
+    # owns it (see src/feature_registry.py). the tables stay lazy read_parquet scans, so only the selected
+    # columns are read and nothing is materialized before the write (or before the view is queried).
+    # - receipt columns & labels: the coupon features table
+    # - coupon features: the coupon features table; user features: the user features table
+    # - anything else: the first extra features table (e.g. src/target_encoding.py's) that has it
+    # without a column selection, the full-width trainable table: receipt columns, coupon features,
+    # receipt_key_1, user features, receipt_key_2, labels, then the extra tables' columns.
+    # (receipt_key_1 / _2 are the layout of the former SELECT * join that the column pickles hold.)
+
+
+def _sql_path(p: Path) -> str:
+    return "'" + str(p).replace("'", "''") + "'"
+
+
+def _trainable_select(
+        cpn_features_parquet: Path,
+        user_features_parquet: Path | None,
+        columns: list[str] | None,
+        extra_features_parquets: list[Path]
+) -> str:
+    """The SELECT of the trainable table: all columns, or receipt_key and the requested columns."""
+    cpn_cols = pq.read_schema(cpn_features_parquet).names
+    if user_features_parquet is None and columns is None:
+        raise ValueError("The full-width trainable table needs the user features table")
+    user_cols = pq.read_schema(user_features_parquet).names if user_features_parquet is not None else []
+    extra_cols = [pq.read_schema(p).names for p in extra_features_parquets]
+
+    if columns is None:
+        exprs = [f"c.{c}" for c in RECEIPT_COLUMNS + registered_columns(cpn_cols, "src.cpn_features")] \
+              + ["u.receipt_key AS receipt_key_1"] \
+              + [f"u.{c}" for c in registered_columns(user_cols, "src.user_features")] \
+              + ["c.receipt_key AS receipt_key_2"] \
+              + [f"c.{c}" for c in LABEL_COLUMNS] \
+              + [f"e{i}.{c}" for i, cols in enumerate(extra_cols) for c in cols if c != "receipt_key"]
+    else:
+        exprs = []
+        for col in dict.fromkeys(["receipt_key"] + list(columns)):
+            spec = feature_spec(col)
+            if spec is None and not any(col in cols for cols in extra_cols):
+                raise ValueError(f"Unknown feature {col!r}: not in the feature registry nor in the extra tables")
+            if spec is not None and spec.module in ("receipts", "src.labels", "src.cpn_features"):
+                alias, cols, path = "c", cpn_cols, cpn_features_parquet
+            elif spec is not None and spec.module == "src.user_features":
+                alias, cols, path = "u", user_cols, user_features_parquet
+            else:
+                i = next((i for i, cols in enumerate(extra_cols) if col in cols), None)
+                if i is None:
+                    raise ValueError(f"Feature {col!r} ({spec.module}) is in none of the extra tables")
+                alias, cols, path = f"e{i}", extra_cols[i], extra_features_parquets[i]
+            if col not in cols:
+                raise ValueError(f"Feature {col!r} ({spec.module}) is not in {path}")
+            exprs.append(f"{alias}.{col}")
+
+    used = {e.split(".")[0] for e in exprs}
+    joins = [f"LEFT JOIN read_parquet({_sql_path(user_features_parquet)}) u ON c.receipt_key = u.receipt_key"] \
+        if "u" in used else []
+    joins += [f"LEFT JOIN read_parquet({_sql_path(p)}) e{i} ON c.receipt_key = e{i}.receipt_key"
+              for i, p in enumerate(extra_features_parquets) if f"e{i}" in used]
+    join_sql = "".join(f"\n            {j}" for j in joins)
+    return f"""
+            SELECT {", ".join(exprs)}
+            FROM read_parquet({_sql_path(cpn_features_parquet)}) c{join_sql}"""
+
+
+def create_trainable_view(
+        con,
+        cpn_features_parquet: Path,
+        user_features_parquet: Path | None,
+        columns: list[str] | Path | None = None, # a column list or a feature selection pickle; None: all
+        extra_features_parquets: list[Path] = [],
+        view: str = "trainable"
+) -> None:
+    """Create a lazy view of the (projected) trainable table in the open connection; nothing is read yet."""
+    if isinstance(columns, (str, Path)):
+        columns = load_feature_selection(columns)
+    con.execute(f"CREATE OR REPLACE VIEW {view} AS "
+                f"{_trainable_select(cpn_features_parquet, user_features_parquet, columns, extra_features_parquets)}")
+
 
 def features_combining(
         cpn_features_parquet: Path,
-        user_features_parquet: Path,
+        user_features_parquet: Path | None, # None: a column selection without user features
         out_parquet: Path,
-        threads: int = 8
+        extra_features_parquets: list[Path] = [], # more features keyed by receipt_key, e.g. src/target_encoding.py's
+        columns: list[str] | Path | None = None, # a column list or a feature selection pickle; None: all
+        threads: int = 8,
+        engine: EngineProfile | str | None = None
 ) -> None:
-    con = duckdb.connect()
-    con.execute(f"PRAGMA threads={threads}")
-
-    con.execute("""
-        CREATE OR REPLACE TABLE rcs_cpn_fea AS
-            SELECT
-                receipt_key,
-                Receive_date, Start_date, End_date,
-                Price_limit_cent, Coupon_amt_cent, 
-                Price_limit_bin, Coupon_limit_bin, Expiry_span_bin,
-                Generosity_ratio, 
-                Start_bf_receive_marker, End_bf_receive_marker,
-                Weekday_marker, Workday_marker, Holiday_marker,
-                no_history_indicator_7d, Rate_invalid_7d, Rate_fh_redeem_7d, Rate_st_redeem_7d,
-                no_history_indicator_14d, Rate_invalid_14d, Rate_fh_redeem_14d, Rate_st_redeem_14d,
-                no_history_indicator_30d, Rate_invalid_30d, Rate_fh_redeem_30d, Rate_st_redeem_30d
-            FROM read_parquet(?)""", [str(cpn_features_parquet)])
-    
-    con.execute("""
-        CREATE OR REPLACE TABLE labels AS
-            SELECT
-                receipt_key,
-                label_invalid, label_same_user_fh, label_same_user_st
-            FROM read_parquet(?)""", [str(cpn_features_parquet)])
-    
-    con.execute("""
-        CREATE OR REPLACE TABLE rcs_user_fea AS
-            SELECT
-                receipt_key,
-                no_hist_rcs_marker_7d, Rate_same_user_invalid_7d, Rate_same_user_fh_redeem_7d, Rate_same_user_st_redeem_7d,
-                no_hist_rcs_marker_14d, Rate_same_user_invalid_14d, Rate_same_user_fh_redeem_14d, Rate_same_user_st_redeem_14d,
-                no_hist_rcs_marker_30d, Rate_same_user_invalid_30d, Rate_same_user_fh_redeem_30d, Rate_same_user_st_redeem_30d, 
-                no_hist_txns_marker_7d, Rt_avgspend_vs_pricelimit_7d, Rt_avgreduce_vs_couponamt_7d, Freq_purchase_7d,
-                no_hist_txns_marker_14d, Rt_avgspend_vs_pricelimit_14d, Rt_avgreduce_vs_couponamt_14d, Freq_purchase_14d,
-                no_hist_txns_marker_30d, Rt_avgspend_vs_pricelimit_30d, Rt_avgreduce_vs_couponamt_30d, Freq_purchase_30d,
-                no_hist_visits_marker_7d, Freq_visit_7d,
-                no_hist_visits_marker_14d, Freq_visit_14d,
-                no_hist_visits_marker_30d, Freq_visit_30d
-            FROM read_parquet(?)""", [str(user_features_parquet)])
-    
-    con.execute("""
-        CREATE OR REPLACE TABLE trainable AS
-            SELECT * FROM rcs_cpn_fea c
-            LEFT JOIN rcs_user_fea u ON c.receipt_key = u.receipt_key
-            LEFT JOIN labels l ON c.receipt_key = l.receipt_key
-    """)
-
-    con.sql("SELECT * FROM trainable").write_parquet(str(out_parquet))
-    con.close()
\ No newline at end of file
+    """
+    Join the coupon, user (and extra) features with the labels into out_parquet:
+    the full-width trainable table, or a narrow one with receipt_key and the selected columns only.
+    """
+    con = connect(engine, threads)
+    create_trainable_view(con, cpn_features_parquet, user_features_parquet, columns, extra_features_parquets)
+    con.sql(typed_select_sql(con, "trainable")).write_parquet(str(out_parquet))
+    con.close()
@@ -1,17 +1,103 @@
 # src/cpn_features.py
 from __future__ import annotations
-import duckdb
+from src.engine import EngineProfile, connect
+from src.feature_dtypes import typed_select_sql
+from src.profiling import ProfiledConnection
+from src.binning import create_segment_bins
+from src.date_dim import create_date_dim, day_key, load_calendar
+from src.segment_store import SEGMENT_COLS, load_segment_store, segment_cum_sql
+from src.prefix_sums import US_PER_DAY, check_half_lives
 from pathlib import Path
 import pandas as pd
 from datetime import date
 import datetime
 
-holidays = [date(2023, 1, 1), date(2023, 1, 2), 
-           date(2023, 1, 21), date(2023, 1, 22), date(2023, 1, 23), date(2023, 1, 24), date(2023, 1, 25), date(2023, 1, 26), date(2023, 1, 27),
-           date(2023, 4, 5),
-           date(2023, 4, 29), date(2023, 4, 30), date(2023, 5, 1), date(2023, 5, 2), date(2023, 5, 3),
-           date(2023, 6, 22), date(2023, 6, 23), date(2023, 6, 24)]
-workdays = [date(2023, 1, 28), date(2023, 1, 29), date(2023, 4, 23), date(2023, 5, 6), date(2023, 6, 25)]
+holidays, workdays = load_calendar()  # conf/calendar.yaml
+
+
+def _asof_names(side: str) -> list[str]:
+    return [f"no_history_{side}", f"invalid_{side}", f"fh_{side}", f"st_{side}", f"all_{side}"]
+
+
+def _asof_cols(alias: str, side: str) -> str:
+    """The cumulative counts picked by one ASOF lookup; no match means no history."""
+    return f"""({alias}.cumall IS NULL)              AS no_history_{side},
+                    COALESCE({alias}.cum_invalid, 0)   AS invalid_{side},
+                    COALESCE({alias}.cum_fh_redeem, 0) AS fh_{side},
+                    COALESCE({alias}.cum_st_redeem, 0) AS st_{side},
+                    COALESCE({alias}.cumall, 0)        AS all_{side}"""
+
+
+def _segment_asof_join(alias: str, days_back: int) -> str:
+    return f"""
+                ASOF LEFT JOIN cum {alias}
+                    ON r.Price_limit_bin = {alias}.Price_limit_bin
+                    AND r.Coupon_limit_bin = {alias}.Coupon_limit_bin
+                    AND r.Expiry_span_bin = {alias}.Expiry_span_bin
+                    AND (r.Receive_date - INTERVAL {days_back} DAY) >= {alias}.Receive_date"""
+
+
+def _window_rate_cols(window_len: int) -> str:
+    """Segment rates over [Receive_date - window_len, Receive_date - 1]: right minus left cumulative counts."""
+    d, rows = window_len - 1, f"(all_right - all_left_{window_len})"
+    rates = ",\n".join(
+        f"""CASE
+                    WHEN {rows} = 0 THEN 0.000
+                    ELSE ROUND(({num}_right - {num}_left_{window_len}) / {rows}, 3)
+                        END AS Rate_{name}_{d}d"""
+        for num, name in [("invalid", "invalid"), ("fh", "fh_redeem"), ("st", "st_redeem")])
+    return f"""(no_history_right OR no_history_left_{window_len})::INT AS no_history_indicator_{d}d,
+                {rates}"""
+
+
+_DECAY_COUNTS = [("invalid", "cum_invalid"), ("fh", "cum_fh_redeem"), ("st", "cum_st_redeem"), ("all", "cumall")]
+_MAX_DECAY_EXPONENT = 1000  # 2^1000 is still a DOUBLE
+
+
+def _decayed_cum_sql(half_lives: list[int], origin_us: int) -> str:
+    """
+    The cumulative counts of `cum` plus, per half-life h, the running sums of the daily counts
+    scaled by 2^((day - origin) / h): the decayed sums as of any day up to a common factor,
+    which cancels in a rate.
+    """
+    diffs = ",\n".join(f"{c} - COALESCE(LAG({c}) OVER seg, 0) AS daily_{n}" for n, c in _DECAY_COUNTS)
+    scaled = ",\n".join(
+        f"SUM(daily_{n} * POW(2, (epoch_us(Receive_date) - {origin_us}) / {US_PER_DAY} / {h})) OVER seg AS decayed_{n}_hl{h}"
+        for h in half_lives for n, _ in _DECAY_COUNTS)
+    return f"""
+            WITH daily AS (
+                SELECT *,
+                    {diffs}
+                FROM cum
+                WINDOW seg AS (PARTITION BY {SEGMENT_COLS} ORDER BY Receive_date)
+            )
+            SELECT * EXCLUDE ({", ".join(f"daily_{n}" for n, _ in _DECAY_COUNTS)}),
+                {scaled}
+            FROM daily
+            WINDOW seg AS (
+                PARTITION BY {SEGMENT_COLS}
+                ORDER BY Receive_date
+                ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
+            )
+    """
+
+
+def _decay_names(half_lives: list[int]) -> list[str]:
+    return [f"decayed_{n}_hl{h}" for h in half_lives for n, _ in _DECAY_COUNTS]
+
+
+def _decay_rate_cols(half_life: int) -> str:
+    """Decayed segment rates of the receipts up to Receive_date - 1, a receipt d days back weighing 2^(-d/h)."""
+    h, rows = half_life, f"COALESCE(decayed_all_hl{half_life}, 0)"
+    rates = ",\n".join(
+        f"""CASE
+                    WHEN Receive_date IS NULL OR {rows} = 0 THEN 0.000
+                    ELSE ROUND(decayed_{num}_hl{h} / {rows}, 3)
+                        END AS Rate_{name}_hl{h}d"""
+        for num, name in [("invalid", "invalid"), ("fh", "fh_redeem"), ("st", "st_redeem")])
+    return f"""no_history_right::INT AS no_history_indicator_hl{h}d,
+                {rates}"""
+
 
 ## coupon features
     # Encode bins on Coupon_amt_cent, Price_limit_cent, (End_date - Start_date); numeric + categorical
@@ -21,25 +107,37 @@ workdays = [date(2023, 1, 28), date(2023, 1, 29), date(2023, 4, 23), date(2023,
     # the flags of whether the coupon is received on weekday/workday or weekend/holiday
     # the HISTORICAL invalidity rate of the coupon's segment
     # the HISTORICAL redemption rate of the coupon's segment
+    # both over the lookback windows, and exponentially decayed with each half-life (suffix _hl{h}d)
 def coupon_features(
         receipts_labelled_parquet: Path,
         out_parquet: Path,
         lookback_days: list[int] = [8, 15, 31],
-        Price_limit_bin_splits: list[int] = [1000, 10000], # only 2 splits allowed; in units of cents
-        Coupon_limit_bin_splits: list[int] = [1000, 10000], # only 2 splits allowed; in units of cents
-        Expiry_span_bin_split: int = 10, # only 1 split allowed; in units of days
+        half_lives: list[int] = [], # in days; decayed segment rates, from the same lookups as the windows
+        Price_limit_bin_splits: list[int] = [1000, 10000], # any number of increasing splits; in units of cents
+        Coupon_limit_bin_splits: list[int] = [1000, 10000], # any number of increasing splits; in units of cents
+        Expiry_span_bin_split: int | list[int] = 10, # one or more increasing splits; in units of days
         holidays: list[datetime.date] = holidays,
         workdays: list[datetime.date] = workdays,
-        threads: int = 8
+        date_dim_parquet: Path | None = None,
+        calendar_markers: bool = True, # False skips the date dimension and the calendar markers
+        segment_store_dir: Path | None = None,
+        threads: int = 8,
+        engine: EngineProfile | str | None = None,
+        profile_dir: Path | None = None
 ) -> None:
     """
-    Generate coupon features and save to out_parquet."""
-    con = duckdb.connect()
-    con.execute(f"PRAGMA threads={threads}")
+    Generate coupon features and save to out_parquet.
+    Without lookback_days and half_lives the historical segment rates are skipped (see src/lazy_features.py).
+    With a segment_store_dir, the historical segment rates are looked up in that store
+    (which must hold the receipts' history) instead of being rebuilt from the receipts.
+    With a profile_dir, a per-section profiling report is written there as well (see src/profiling.py)."""
+    half_lives = check_half_lives(half_lives)
+    con = ProfiledConnection(connect(engine, threads), profile_dir, run_name="coupon_features")
 
     # =================
     # Section 1: Load
     # =================
+    con.section("Section 1: Load")
     con.execute("""
         CREATE OR REPLACE TABLE receipts AS
             SELECT
@@ -58,29 +156,16 @@ def coupon_features(
     # Section 2.1: Create bins + categorical features for
     # Price_limit_cent, Coupon_amt_cent, Expiry_span
     # =====================================================
-    con.execute(f"""
-        CREATE OR REPLACE TABLE receipts_1 AS     
-        SELECT *,
-            CASE 
-                WHEN Price_limit_cent <= {Price_limit_bin_splits[0]} THEN 0
-                WHEN Price_limit_cent > {Price_limit_bin_splits[0]} AND Price_limit_cent <= {Price_limit_bin_splits[1]} THEN 1
-                ELSE 2 END AS Price_limit_bin,
-            CASE
-                WHEN Coupon_amt_cent <= {Coupon_limit_bin_splits[0]} THEN 0
-                WHEN Coupon_amt_cent > {Coupon_limit_bin_splits[0]} AND Coupon_amt_cent <= {Coupon_limit_bin_splits[1]} THEN 1
-                ELSE 2 END AS Coupon_limit_bin,
-            CASE
-                WHEN End_date BETWEEN Start_date AND (INTERVAL {Expiry_span_bin_split} DAY + Start_date) THEN 0
-                WHEN End_date > (INTERVAL {Expiry_span_bin_split} DAY + Start_date) THEN 1
-                ELSE -1 END AS Expiry_span_bin
-        FROM receipts
-    """)
+    con.section("Section 2.1: Bins on Price_limit_cent, Coupon_amt_cent, Expiry_span")
+    create_segment_bins(con, "receipts", "receipts_1",
+                        Price_limit_bin_splits, Coupon_limit_bin_splits, Expiry_span_bin_split)
     
     # ===================================================
     # Section 2.2: Create generosity ratio, 
     # various date precedence markers, 
     # and the weekday/workday v.s. weekend/holiday flag
     # ===================================================
+    con.section("Section 2.2: Generosity ratio, date precedence & calendar markers")
     con.execute("""
         CREATE OR REPLACE TABLE receipts_2 AS
             SELECT *,
@@ -96,136 +181,85 @@ def coupon_features(
             FROM receipts_1
     """)
     
-    con.execute("CREATE TEMP TABLE workdays(d TIMESTAMP)")
-    con.execute("INSERT INTO workdays SELECT * FROM UNNEST(?::TIMESTAMP[])", [workdays])
-
-    con.execute("CREATE TEMP TABLE holidays(d TIMESTAMP)")
-    con.execute("INSERT INTO holidays SELECT * FROM UNNEST(?::TIMESTAMP[])", [holidays])
-
-
-    con.execute(f"""
-        CREATE OR REPLACE TABLE receipts_3 AS
-            SELECT r.*,
-                CASE
-                    WHEN dayname(r.Receive_date) IN ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday'] THEN 1
-                    ELSE 0 END AS Weekday_marker,
-                CASE
-                    WHEN w.d IS NOT NULL THEN 1 ELSE 0 END AS Workday_marker,
-                CASE
-                    WHEN h.d IS NOT NULL THEN 1 ELSE 0 END AS Holiday_marker
-            FROM receipts_2 r
-            LEFT JOIN workdays w ON r.Receive_date = w.d
-            LEFT JOIN holidays h ON r.Receive_date = h.d
-    """)
+    # calendar markers come from the date dimension, joined on the integer day key:
+    # a materialized one (src/date_dim.py) if given, otherwise built here over the receipts' dates.
+    if not calendar_markers:
+        con.execute("CREATE OR REPLACE TABLE receipts_3 AS SELECT * FROM receipts_2")
+    elif date_dim_parquet is not None:
+        con.execute("""
+            CREATE OR REPLACE TABLE date_dim AS
+                SELECT * FROM read_parquet(?)""", [str(date_dim_parquet)])
+        n_outside = con.execute(f"""
+            SELECT COUNT(*) FROM receipts_2
+            WHERE Receive_date IS NOT NULL
+              AND {day_key("Receive_date")} NOT IN (SELECT day_key FROM date_dim)""").fetchone()[0]
+        if n_outside:
+            raise ValueError(f"{n_outside} receipts have a Receive_date outside the date dimension {date_dim_parquet}")
+    else:
+        start, end = con.execute(
+            "SELECT CAST(MIN(Receive_date) AS DATE), CAST(MAX(Receive_date) AS DATE) FROM receipts_2").fetchone()
+        create_date_dim(con, start or date(1970, 1, 1), end or date(1970, 1, 1), holidays, workdays)
+
+    if calendar_markers:
+        con.execute(f"""
+            CREATE OR REPLACE TABLE receipts_3 AS
+                SELECT r.*,
+                    COALESCE(d.Weekday_marker, 0) AS Weekday_marker,
+                    COALESCE(d.Workday_marker, 0) AS Workday_marker,
+                    COALESCE(d.Holiday_marker, 0) AS Holiday_marker
+                FROM receipts_2 r
+                LEFT JOIN date_dim d ON {day_key("r.Receive_date")} = d.day_key
+        """)
 
     # ===================================================
     # Section 2.3: 
     # the HISTORICAL invalidity & redemption rate of the coupon's segment
     # ===================================================
-    con.execute("""CREATE OR REPLACE TABLE receipts_4 AS
-                SELECT * from receipts_3
-                ORDER BY Receive_date, receipt_key""")
-
-    con.execute("""
-        CREATE OR REPLACE TABLE cum AS
-            -- pre-aggregate to daily
-            WITH daily AS (
-                SELECT
-                    Receive_date,
-                    Price_limit_bin, Coupon_limit_bin, Expiry_span_bin,
-                    SUM(label_invalid)      AS daily_invalid,
-                    SUM(label_same_user_fh) AS daily_fh_redeem,
-                    SUM(label_same_user_st) AS daily_st_redeem,
-                    COUNT(*)                AS daily_vol
-                FROM receipts_4
-                GROUP BY 1,2,3,4
-            )
-            SELECT 
-                Receive_date, 
-                Price_limit_bin, Coupon_limit_bin, Expiry_span_bin, 
-                SUM(daily_invalid)      OVER same_seg AS cum_invalid,
-                SUM(daily_fh_redeem)    OVER same_seg AS cum_fh_redeem,
-                SUM(daily_st_redeem)    OVER same_seg AS cum_st_redeem,
-                SUM(daily_vol)          OVER same_seg AS cumall
-            FROM daily
-            WINDOW same_seg AS (
-                PARTITION BY Price_limit_bin, Coupon_limit_bin, Expiry_span_bin
-                ORDER BY Receive_date            ---DuckDB puts the lines with NaT value to the end 
-                ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW 
-            )
-    """)
-
-    con.execute("""
-        CREATE OR REPLACE TABLE asof_right AS
-            SELECT r.Receive_date, r.receipt_key,
-                (c1.cumall IS NULL) AS no_history_indicator,
-                COALESCE(c1.cum_invalid, 0) AS invalid_right,
-                COALESCE(c1.cum_fh_redeem, 0) AS fh_right,
-                COALESCE(c1.cum_st_redeem, 0) AS st_right,
-                COALESCE(c1.cumall, 0) AS all_right
-            FROM receipts_4 AS r
-            ASOF LEFT JOIN cum c1
-                ON r.Price_limit_bin = c1.Price_limit_bin
-                AND r.Coupon_limit_bin = c1.Coupon_limit_bin
-                AND r.Expiry_span_bin = c1.Expiry_span_bin
-                AND (r.Receive_date - INTERVAL 1 DAY) >= c1.Receive_date
-    """)
-
-    for window_len in lookback_days:
-        con.execute(f"""
-            CREATE OR REPLACE TABLE rlookback AS
-            WITH asof_left AS (
-                SELECT r.Receive_date, r.receipt_key,
-                    (c2.cumall IS NULL) AS no_history_indicator,
-                    COALESCE(c2.cum_invalid, 0) AS invalid_left,
-                    COALESCE(c2.cum_fh_redeem, 0) AS fh_left,
-                    COALESCE(c2.cum_st_redeem, 0) AS st_left,
-                    COALESCE(c2.cumall, 0) AS all_left,
-                FROM receipts_4 AS r
-                ASOF LEFT JOIN cum c2
-                    ON r.Price_limit_bin = c2.Price_limit_bin
-                    AND r.Coupon_limit_bin = c2.Coupon_limit_bin
-                    AND r.Expiry_span_bin = c2.Expiry_span_bin
-                    AND (r.Receive_date - INTERVAL {window_len} DAY) >= c2.Receive_date
-            )
-        
-            SELECT
-                a.receipt_key, a.Receive_date,
-                (a.no_history_indicator OR b.no_history_indicator)::INT AS no_history_indicator,
-                (a.invalid_right - b.invalid_left) AS invalid_{window_len-1}d,
-                (a.fh_right - b.fh_left) AS fh_{window_len-1}d,
-                (a.st_right - b.st_left) AS st_{window_len-1}d,
-                (a.all_right - b.all_left) AS row_count_{window_len-1}d
-            FROM asof_right a
-            LEFT JOIN asof_left b
-                ON a.receipt_key = b.receipt_key
-        """)
+    con.section("Section 2.3: Historical segment rates")
+    if not (lookback_days or half_lives):
+        con.execute("CREATE OR REPLACE TABLE receipts_4 AS SELECT * FROM receipts_3 ORDER BY Receive_date, receipt_key")
+    else:
+        # per-(segment, day) cumulative counts: from a persisted segment store (see src/segment_store.py)
+        # if given, otherwise from the receipts at hand.
+        if segment_store_dir is not None:
+            load_segment_store(con, segment_store_dir, "cum",
+                               Price_limit_bin_splits, Coupon_limit_bin_splits, Expiry_span_bin_split)
+        else:
+            con.execute(f"CREATE OR REPLACE TABLE cum AS {segment_cum_sql('receipts_3')}")
+        if half_lives:
+            origin_us, span_days = con.execute(f"""
+                SELECT MIN(epoch_us(Receive_date)), (MAX(epoch_us(Receive_date)) - MIN(epoch_us(Receive_date))) / {US_PER_DAY}
+                FROM cum""").fetchone()
+            if span_days is not None and span_days / min(half_lives) > _MAX_DECAY_EXPONENT:
+                raise ValueError(f"a history of {span_days:.0f} days is too long for a half-life of {min(half_lives)} days")
+            con.execute(f"CREATE OR REPLACE TABLE cum AS {_decayed_cum_sql(half_lives, origin_us or 0)}")
 
+        lookup_cols = ",\n".join([_asof_cols("c1", "right")] + [f"c1.{n}" for n in _decay_names(half_lives)]
+                                 + [_asof_cols(f"c_{w}", f"left_{w}") for w in lookback_days])
+        # all windows in one pass: one right ASOF lookup (as of yesterday) plus one left lookup per window,
+        # differenced in a single query and written once. the decayed sums ride along the right lookup.
         con.execute(f"""
             CREATE OR REPLACE TABLE receipts_4 AS
-            SELECT r.*, 
-                bk.no_history_indicator AS no_history_indicator_{window_len-1}d,
-                CASE 
-                    WHEN bk.row_count_{window_len-1}d = 0 THEN 0.000 
-                    ELSE ROUND(bk.invalid_{window_len-1}d / bk.row_count_{window_len-1}d, 3) 
-                        END AS Rate_invalid_{window_len-1}d,
-                CASE
-                    WHEN bk.row_count_{window_len-1}d = 0 THEN 0.000
-                    ELSE ROUND(bk.fh_{window_len-1}d / bk.row_count_{window_len-1}d, 3)
-                        END AS Rate_fh_redeem_{window_len-1}d,
-                CASE
-                    WHEN bk.row_count_{window_len-1}d = 0 THEN 0.000
-                    ELSE ROUND(bk.st_{window_len-1}d / bk.row_count_{window_len-1}d, 3)
-                        END AS Rate_st_redeem_{window_len-1}d
-            FROM receipts_4 r
-            LEFT JOIN rlookback bk
-                ON r.receipt_key = bk.receipt_key 
+                WITH lookups AS (
+                    SELECT r.*,
+                        {lookup_cols}
+                    FROM receipts_3 AS r
+                    {_segment_asof_join("c1", 1)}
+                    {"".join(_segment_asof_join(f"c_{w}", w) for w in lookback_days)}
+                )
+                SELECT
+                    * EXCLUDE ({", ".join(_asof_names("right") + [n for w in lookback_days for n in _asof_names(f"left_{w}")]
+                                          + _decay_names(half_lives))}),
+                    {", ".join([_window_rate_cols(w) for w in lookback_days] + [_decay_rate_cols(h) for h in half_lives])}
+                FROM lookups
+                ORDER BY Receive_date, receipt_key
         """)
     
     # ===================================
     # Section 3: Write parquet and close
     # ===================================
-    con.sql("SELECT * FROM receipts_4").write_parquet(str(out_parquet))
+    con.section("Section 3: Write parquet and close")
+    con.sql(typed_select_sql(con, "receipts_4", order_by="Receive_date, receipt_key")).write_parquet(str(out_parquet))
     con.close()
     
     
@@ -0,0 +1,79 @@
+# src/date_dim.py
+from __future__ import annotations
+from src.engine import EngineProfile, REPO_ROOT, connect
+from pathlib import Path
+from datetime import date
+import yaml
+
+## date dimension:
+    # one row per calendar day keyed by an integer day_key (days since 1970-01-01),
+    # carrying the weekday / workday / holiday markers and other calendar attributes.
+    # stages join it on day_key(<timestamp column>) instead of calling string functions per row.
+    # the holiday calendar lives in conf/calendar.yaml.
+
+CALENDAR_YAML = REPO_ROOT / "conf" / "calendar.yaml"
+
+
+def load_calendar(path: Path = CALENDAR_YAML) -> tuple[list[date], list[date]]:
+    """(holidays, workdays) from the calendar yaml; workdays are the adjusted working weekends."""
+    with open(path, 'r') as f:
+        cal = yaml.safe_load(f)
+    return list(cal.get("holidays") or []), list(cal.get("workdays") or [])
+
+
+def day_key(expr: str) -> str:
+    """SQL expression of the integer day key of a DATE / TIMESTAMP expression."""
+    return f"(CAST({expr} AS DATE) - DATE '1970-01-01')"
+
+
+def create_date_dim(con, start: date, end: date,
+                    holidays: list[date], workdays: list[date]) -> None:
+    """Create table `date_dim` covering [start, end] in the open connection."""
+    con.execute("CREATE OR REPLACE TEMP TABLE cal_holidays(d DATE)")
+    con.execute("INSERT INTO cal_holidays SELECT UNNEST(?::DATE[])", [list(holidays)])
+    con.execute("CREATE OR REPLACE TEMP TABLE cal_workdays(d DATE)")
+    con.execute("INSERT INTO cal_workdays SELECT UNNEST(?::DATE[])", [list(workdays)])
+
+    con.execute(f"""
+        CREATE OR REPLACE TABLE date_dim AS
+            WITH days AS (
+                SELECT CAST(generate_series AS DATE) AS d
+                FROM generate_series(CAST(? AS DATE), CAST(? AS DATE), INTERVAL 1 DAY)
+            )
+            SELECT
+                {day_key("days.d")}::INTEGER     AS day_key,
+                days.d                            AS cal_date,
+                year(days.d)::SMALLINT            AS year,
+                month(days.d)::TINYINT            AS month,
+                day(days.d)::TINYINT              AS day_of_month,
+                isodow(days.d)::TINYINT           AS day_of_week,   -- 1 = Monday
+                weekofyear(days.d)::TINYINT       AS week_of_year,
+                CASE WHEN isodow(days.d) <= 5 THEN 1 ELSE 0 END AS Weekday_marker,
+                CASE WHEN w.d IS NOT NULL THEN 1 ELSE 0 END     AS Workday_marker,
+                CASE WHEN h.d IS NOT NULL THEN 1 ELSE 0 END     AS Holiday_marker,
+                CASE
+                    WHEN w.d IS NOT NULL THEN 1
+                    WHEN h.d IS NOT NULL THEN 0
+                    WHEN isodow(days.d) <= 5 THEN 1
+                    ELSE 0 END AS Business_day_marker
+            FROM days
+            LEFT JOIN cal_workdays w ON days.d = w.d
+            LEFT JOIN cal_holidays h ON days.d = h.d
+            ORDER BY day_key
+    """, [start, end])
+
+
+def build_date_dim(
+        out_parquet: Path,
+        start: date,
+        end: date,
+        calendar_yaml: Path = CALENDAR_YAML,
+        threads: int = 8,
+        engine: EngineProfile | str | None = None
+) -> None:
+    """Materialize the date dimension over [start, end] to out_parquet."""
+    holidays, workdays = load_calendar(calendar_yaml)
+    con = connect(engine, threads)
+    create_date_dim(con, start, end, holidays, workdays)
+    con.sql("SELECT * FROM date_dim ORDER BY day_key").write_parquet(str(out_parquet))
+    con.close()
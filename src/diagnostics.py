@@ -1,7 +1,8 @@
 # src/diagnostics.py
 from __future__ import annotations
-import duckdb
+from src.engine import EngineProfile, connect
 from pathlib import Path
+from statistics import NormalDist
 import pandas as pd
 
 ## notes on the receipt.parquet:
@@ -10,100 +11,233 @@ import pandas as pd
     # added labels and audit counts,
     # no dup in rows.
 
+## notes on the diagnostics store:
+    # the segment metrics only need the receipts summed per distinct (price limit, coupon amount, expiry span):
+    # Price_limit, Coupon_limit (cents), span_us (expiry span in microseconds, Expiry_span its INTERVAL) and
+    # the receipt / valid / fh / st redeemed counts n, n_valid, n_fh, n_st. build_diag_store() persists that
+    # table, a few thousand rows; DiagStore rolls it up into any set of splits without reading the receipts.
+
+## notes on sampled diagnostics:
+    # diag_on_receipts(sample_fraction=f) keeps the receipts whose hash(receipt_key, seed) falls in the first
+    # f of the hash range: a fixed-seed Bernoulli sample of the rows, the same receipts for the same seed and
+    # fraction, at the same rate in every segment whatever the parquet's row order or row groups. the realised
+    # fraction (sampled receipts / all receipts) is reported. each percentage then comes with its Wilson score
+    # interval ({metric}_lo / _hi, at the given confidence) over the segment's sampled receipts: independent
+    # draws, as the interval assumes. the parquet is still scanned whole; the sample saves the aggregation.
+
+_MARGINALS = (None, "rollup", "cube")
+_DAY_US = 86_400_000_000
+_HASH_RANGE = 1_000_000
+_METRICS = {"validity_pc": "n_valid", "redeem_fh_pc": "n_fh", "redeem_st_pc": "n_st"}
+
+
+def _bounds(splits: list, min_max: list) -> tuple[list, list]:
+    """Lower and upper bounds of the len(splits) + 1 bins; both inclusive, as the bins always were."""
+    return [min_max[0]] + list(splits), list(splits) + [min_max[1]]
+
+
+def _bins_sql(col: str, splits: list, min_max: list) -> str:
+    """The bins a value falls in: two when it is on a split, none when it is out of range or NULL."""
+    lower, upper = _bounds(splits, min_max)
+    return f"list_filter(range({len(splits) + 1}), i -> {lower}[i + 1] <= {col} AND {col} <= {upper}[i + 1])"
+
+
+def _sql_path(p: Path) -> str:
+    return "'" + str(p).replace("'", "''") + "'"
+
+
+def _fine_sql(receipts: str, where: str = "TRUE") -> str:
+    """SELECT of the receipts (a relation) summed per distinct price limit, coupon amount and expiry span."""
+    return f"""
+            SELECT
+                Price_limit_cent AS Price_limit,
+                Coupon_amt_cent AS Coupon_limit,
+                epoch_us(CAST(End_date AS TIMESTAMP)) - epoch_us(CAST(Start_date AS TIMESTAMP)) AS span_us,
+                MAX(End_date - Start_date) AS Expiry_span,
+                COUNT(*) AS n,
+                SUM(label_valid) AS n_valid,
+                SUM(label_same_user_fh) AS n_fh,
+                SUM(label_same_user_st) AS n_st
+            FROM {receipts}
+            WHERE {where}
+            GROUP BY 1,2,3"""
+
+
+def _wilson_sql(x: str, n: str, z: float, sign: str) -> str:
+    """A bound of the Wilson score interval of the proportion x / n, in percent."""
+    return f"""ROUND(100 * ({x} / {n} + {z ** 2 / 2} / {n} {sign} {z} * SQRT({x} / {n} * (1 - {x} / {n}) / {n}
+                    + {z ** 2 / 4} / ({n} * {n}))) / (1 + {z ** 2} / {n}), 2)"""
+
+
+def _segments_sql(
+        fine: str,
+        Price_limit_bin_splits: list,
+        Coupon_limit_bin_splits: list,
+        Expiry_span_bin_splits: list,
+        marginals: str | None,
+        ci_z: float | None = None
+) -> str:
+    """
+    One GROUP BY over the segments every row of the `fine` relation (see _fine_sql) falls in, LEFT JOINed
+    to the grid of all segments. The bins of a value are looked up once per distinct value of each
+    dimension (the p / c / e maps), not once per row.
+    `fine` is read once, into a materialized CTE the maps and the GROUP BY share, even when it is a view.
+    With ci_z, every percentage comes with the bounds of its Wilson score interval at that z.
+    """
+    dims = [("p", "Price_limit", Price_limit_bin_splits, [0, 1000000000000000]),
+            ("c", "Coupon_limit", Coupon_limit_bin_splits, [0, 1000000000000000]),
+            ("e", "span_us", [d * _DAY_US for d in Expiry_span_bin_splits], [0, 365 * _DAY_US])]
+    marginal = marginals is not None
+    # ROLLUP (p, c, e): only the trailing dimensions of a segment may be marginalized
+    rollup = "WHERE (p IS NOT NULL OR c IS NULL) AND (c IS NOT NULL OR e IS NULL)" if marginals == "rollup" else ""
+    # NULL stands for all of a dimension's bins: every value in any of them maps to it as well
+    maps = ",".join(f"""
+            {d}_map AS (
+                SELECT {col}, UNNEST({_bins_sql(col, splits, mm)}) AS {d}
+                FROM (SELECT DISTINCT {col} FROM fine_once)
+                {f"UNION ALL SELECT DISTINCT {col}, NULL FROM fine_once WHERE len({_bins_sql(col, splits, mm)}) > 0"
+                 if marginal else ""}
+            )""" for d, col, splits, mm in dims)
+    grid = ", ".join(
+        f"(SELECT UNNEST([{', '.join([str(b) for b in range(len(splits) + 1)] + (['NULL'] if marginal else []))}]) AS {d})"
+        f" AS grid_{d}" for d, _, splits, _ in dims)
+    ci = "".join(f""",
+            {_wilson_sql(x, "receipts_count", ci_z, "-")} AS {m}_lo,
+            {_wilson_sql(x, "receipts_count", ci_z, "+")} AS {m}_hi""" for m, x in _METRICS.items()) if ci_z else ""
+    return f"""
+        WITH
+            fine_once AS MATERIALIZED (
+                SELECT * FROM {fine}
+            ),{maps},
+            cells AS (
+                SELECT
+                    p, c, e,
+                    MAX(Price_limit) AS Price_limit_upper_bin,
+                    MAX(Coupon_limit) AS Coupon_limit_upper_bin,
+                    MAX(Expiry_span) AS Expiry_span_upper_bin,
+                    ROUND(SUM(n_valid) / SUM(n) * 100, 2) AS validity_pc,
+                    ROUND(SUM(n_fh) / SUM(n) * 100, 2) AS redeem_fh_pc,
+                    ROUND(SUM(n_st) / SUM(n) * 100, 2) AS redeem_st_pc,
+                    SUM(n) AS receipts_count,
+                    {", ".join(f"SUM({x}) AS {x}" for x in _METRICS.values())}
+                FROM fine_once
+                JOIN p_map USING (Price_limit)
+                JOIN c_map USING (Coupon_limit)
+                JOIN e_map USING (span_us)
+                {rollup}
+                GROUP BY p, c, e
+            ),
+            grid AS (
+                SELECT * FROM {grid}
+                {rollup}
+            )
+        SELECT
+            {"grid.p AS Price_limit_bin, grid.c AS Coupon_limit_bin, grid.e AS Expiry_span_bin," if marginal else ""}
+            Price_limit_upper_bin, Coupon_limit_upper_bin, Expiry_span_upper_bin,
+            validity_pc, redeem_fh_pc, redeem_st_pc,
+            CAST(COALESCE(receipts_count, 0) AS BIGINT) AS receipts_count{ci}
+        FROM grid
+        LEFT JOIN cells ON COALESCE(grid.p, -1) = COALESCE(cells.p, -1)   ---NULL: the marginal
+                       AND COALESCE(grid.c, -1) = COALESCE(cells.c, -1)
+                       AND COALESCE(grid.e, -1) = COALESCE(cells.e, -1)
+        ORDER BY grid.p NULLS LAST, grid.c NULLS LAST, grid.e NULLS LAST"""
+
+
 def diag_on_receipts(
     receipts_parquet: Path,
     Price_limit_bin_splits: list,  # in units of cents
     Coupon_limit_bin_splits: list, # in units of cents
     Expiry_span_bin_splits: list,
+    marginals: str | None = None,  # "rollup" or "cube": also the segments with trailing / any dimensions merged
+    sample_fraction: float | None = None, # e.g. 0.05: a fixed-seed sample of the receipts, see the notes above
+    seed: int = 0,
+    confidence: float = 0.95,      # of the sampled percentages' intervals
     threads: int = 8,
+    engine: EngineProfile | str | None = None,
 ) -> pd.DataFrame:
     """
     After segmenting receipts by the price limit, coupon limit and expiry span,
     calculate the percentage of valid coupons and redemption rate (st & fh).
+    Bins include both of their bounds, so a receipt right on a split counts in the two segments sharing it.
     
     Output: a panda dataframe with each row representing a segment.
         indices: Price_limit_upper_bin (INTEGER), Coupon_limit_upper_bin (INTEGER), and Expiry_upper_bin (INTERVAL).
         cols: number of receipts within each bin, the validity percentage, short-term and full horizon redemption rate.
+        with marginals, the segment's bin numbers come first: Price_limit_bin, Coupon_limit_bin, Expiry_span_bin,
+        NULL where the dimension is merged (all its bins).
+        with a sample_fraction, the counts and percentages are the sample's: each percentage gets its confidence
+        interval ({metric}_lo, {metric}_hi) and a sample_fraction column reports the realised fraction
+        (sampled receipts / all receipts).
     """
-    con = duckdb.connect()
-    con.execute(f"PRAGMA threads={threads}")
+    if marginals not in _MARGINALS:
+        raise ValueError(f"marginals should be one of {_MARGINALS}, got {marginals!r}")
+    if sample_fraction is not None and not 0 < sample_fraction <= 1:
+        raise ValueError(f"sample_fraction should be in (0, 1], got {sample_fraction}")
+    if not 0 < confidence < 1:
+        raise ValueError(f"confidence should be in (0, 1), got {confidence}")
+    con = connect(engine, threads)
 
     # =================
     # Section 1: Load
     # =================
-    con.execute("""
-        CREATE OR REPLACE TABLE receipts AS
-            SELECT 
-                Price_limit_cent AS Price_limit,
-                Coupon_amt_cent AS Coupon_limit,
-                Start_date, End_date,
-                label_valid AS L_valid,
-                label_same_user_fh AS L_usage_fh,
-                label_same_user_st AS L_usage_st
-            FROM read_parquet(?)""", [str(receipts_parquet)])
+    receipts = f"read_parquet({_sql_path(receipts_parquet)})"
+    sampled = f"hash(receipt_key, {int(seed)}) % {_HASH_RANGE} < {round(sample_fraction * _HASH_RANGE)}" \
+        if sample_fraction is not None else "TRUE"
+    # the few thousand distinct (price, coupon, span) rows are held in memory, as in DiagStore
+    con.execute(f"CREATE TEMP TABLE fine AS {_fine_sql(receipts, sampled)}")
+    if sample_fraction is not None:
+        # the parquet's row count comes from its metadata
+        n_all = con.execute(f"SELECT COUNT(*) FROM {receipts}").fetchone()[0]
+        n_sampled = con.execute("SELECT COALESCE(SUM(n), 0) FROM fine").fetchone()[0]
+        realised = n_sampled / n_all if n_all else 0.
     
     # =======================================
     # Section 2: Segmentation & Statistics
     # =======================================
-    def _set_lower_upper_bounds(i: int, splits: list, 
-                                min_max: list = [0, 1000000000000000]
-                ):
-        minv = min_max[0]
-        maxv = min_max[1]
-        if i != 0:
-            lower = splits[i - 1]
-        else:
-            lower = minv
-        if i != len(splits):
-            upper = splits[i]
-        else:
-            upper = maxv
-        return lower, upper
-    
-    con.execute("""
-        CREATE TABLE segs (Price_limit_upper_bin INTEGER, Coupon_limit_upper_bin INTEGER, Expiry_span_upper_bin INTERVAL,
-                            validity_pc DOUBLE, redeem_fh_pc DOUBLE, redeem_st_pc DOUBLE, receipts_count INTEGER);
-    """)
-
-    for i in range(len(Price_limit_bin_splits) + 1):
-        Price_limit_lower, Price_limit_upper = _set_lower_upper_bounds(i, Price_limit_bin_splits)
-
-        for j in range(len(Coupon_limit_bin_splits) + 1):
-            Coupon_limit_lower, Coupon_limit_upper = _set_lower_upper_bounds(j, Coupon_limit_bin_splits)
-            
-            for k in range(len(Expiry_span_bin_splits) + 1):
-                Expiry_span_lower, Expiry_span_upper = _set_lower_upper_bounds(k, Expiry_span_bin_splits, min_max=[0, 365])
-            
-                con.execute(f"""
-                    CREATE OR REPLACE TABLE seg AS
-                        SELECT
-                            MAX(Price_limit) AS Price_limit_upper_bin,
-                            MAX(Coupon_limit) AS Coupon_limit_upper_bin,
-                            MAX(End_date - Start_date) AS Expiry_span_upper_bin,
-                            ROUND(SUM(L_valid) / COUNT(*) * 100, 2) AS validity_pc,
-                            ROUND(SUM(L_usage_fh) / COUNT(*) * 100, 2) AS redeem_fh_pc,
-                            ROUND(SUM(L_usage_st) / COUNT(*) * 100, 2) AS redeem_st_pc,
-                            COUNT(*) AS receipts_count
-                        FROM receipts
-                        WHERE
-                            (Price_limit BETWEEN {Price_limit_lower} AND {Price_limit_upper}) AND
-                            (Coupon_limit BETWEEN {Coupon_limit_lower} AND {Coupon_limit_upper}) AND
-                            (End_date BETWEEN (Start_date + INTERVAL {Expiry_span_lower} DAY) 
-                                        AND (Start_date + INTERVAL {Expiry_span_upper} DAY))
-                """)
-
-                con.execute("""
-                    CREATE OR REPLACE TABLE segs AS
-                        SELECT * FROM segs
-                        UNION BY NAME
-                        SELECT * FROM seg
-                """)
-    
-    # ==================================
-    # Section 3: output as pd.DataFrame
-    # ==================================
-    df = con.sql("SELECT * FROM segs").df()
+    # the receipts summed per distinct price / coupon / span, mapped to their segments, then grouped
+    ci_z = NormalDist().inv_cdf((1 + confidence) / 2) if sample_fraction is not None else None
+    df = con.sql(_segments_sql("fine", Price_limit_bin_splits, Coupon_limit_bin_splits,
+                               Expiry_span_bin_splits, marginals, ci_z)).df()
+    con.close()
+    if sample_fraction is not None:
+        df["sample_fraction"] = realised
     return df
 
 
+def build_diag_store(
+    receipts_parquet: Path,
+    store_parquet: Path,
+    threads: int = 8,
+    engine: EngineProfile | str | None = None,
+) -> None:
+    """Sum the labelled receipts per distinct price limit, coupon amount and expiry span into store_parquet."""
+    con = connect(engine, threads)
+    con.execute(f"COPY ({_fine_sql(f'read_parquet({_sql_path(receipts_parquet)})')} ORDER BY ALL) TO {_sql_path(store_parquet)} (FORMAT PARQUET)")
+    con.close()
+
+
+class DiagStore:
+    """A diagnostics store (see build_diag_store) held in memory, rolled up into segments on demand."""
+
+    def __init__(self, store_parquet: Path, threads: int = 1, engine: EngineProfile | str | None = None):
+        self.con = connect(engine, threads)
+        self.con.execute(f"CREATE TABLE fine AS SELECT * FROM read_parquet({_sql_path(store_parquet)})")
+
+    def segments(
+        self,
+        Price_limit_bin_splits: list,  # in units of cents
+        Coupon_limit_bin_splits: list, # in units of cents
+        Expiry_span_bin_splits: list,
+        marginals: str | None = None,
+    ) -> pd.DataFrame:
+        """The output of diag_on_receipts for these splits, from the store."""
+        if marginals not in _MARGINALS:
+            raise ValueError(f"marginals should be one of {_MARGINALS}, got {marginals!r}")
+        return self.con.sql(_segments_sql("fine", Price_limit_bin_splits, Coupon_limit_bin_splits,
+                                          Expiry_span_bin_splits, marginals)).df()
+
+    def close(self) -> None:
+        self.con.close()
+
+
 # TODO: correct the logic of repeat redemption in labels.py and then calculate the repeat redemption rate per segment.
\ No newline at end of file
@@ -0,0 +1,76 @@
+# src/engine.py
+from __future__ import annotations
+import duckdb
+import yaml
+from dataclasses import dataclass, fields
+from pathlib import Path
+
+## shared DuckDB execution profile:
+    # every SQL stage opens its connection through connect(), so memory limit, spill directory,
+    # insertion-order preservation and object cache are set in one place (conf/engine_profiles.yaml).
+    # without preserve_insertion_order a write does not keep the row order of the table it reads:
+    # the stages writing sorted output sort in the writing query itself (e.g. typed_select_sql's order_by).
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+PROFILES_YAML = REPO_ROOT / "conf" / "engine_profiles.yaml"
+
+
+@dataclass(frozen=True)
+class EngineProfile:
+    """
+    DuckDB settings applied to a fresh connection.
+    None keeps DuckDB's own default for that setting.
+    """
+    threads: int = 8
+    memory_limit: str | None = None              # e.g. "3GB"; DuckDB's default is 80% of the RAM
+    temp_directory: str | None = None            # spill directory; relative paths resolve against the repo root
+    max_temp_directory_size: str | None = None   # e.g. "50GB"
+    preserve_insertion_order: bool = True        # False lets large scans / writes spill & reorder freely
+    enable_object_cache: bool = False            # cache parquet metadata across queries
+
+
+def load_engine_profile(name: str, path: Path = PROFILES_YAML) -> EngineProfile:
+    """Load the named preset (e.g. "laptop_4gb", "batch_node_64gb") from the profiles yaml."""
+    with open(path, 'r') as f:
+        profiles = yaml.safe_load(f)["profiles"]
+    if name not in profiles:
+        raise ValueError(f"Unknown engine profile '{name}'; available: {sorted(profiles)}")
+
+    known = {f.name for f in fields(EngineProfile)}
+    unknown = set(profiles[name]) - known
+    if unknown:
+        raise ValueError(f"[{name}] unknown engine settings: {sorted(unknown)}")
+    return EngineProfile(**profiles[name])
+
+
+def connect(
+        engine: EngineProfile | str | None = None,
+        threads: int = 8
+) -> duckdb.DuckDBPyConnection:
+    """
+    Open an in-memory DuckDB connection configured by `engine`:
+    - None: only `threads` is set (the stages' historical behaviour);
+    - str: the name of a preset in conf/engine_profiles.yaml;
+    - EngineProfile: used as is.
+    When a profile is given, its own `threads` wins over the `threads` argument.
+    """
+    if engine is None:
+        engine = EngineProfile(threads=threads)
+    elif isinstance(engine, str):
+        engine = load_engine_profile(engine)
+
+    con = duckdb.connect()
+    con.execute(f"PRAGMA threads={engine.threads}")
+    if engine.memory_limit is not None:
+        con.execute(f"SET memory_limit = '{engine.memory_limit}'")
+    if engine.temp_directory is not None:
+        temp_dir = Path(engine.temp_directory)
+        if not temp_dir.is_absolute():
+            temp_dir = REPO_ROOT / temp_dir
+        temp_dir.mkdir(parents=True, exist_ok=True)
+        con.execute(f"SET temp_directory = '{temp_dir.as_posix()}'")
+    if engine.max_temp_directory_size is not None:
+        con.execute(f"SET max_temp_directory_size = '{engine.max_temp_directory_size}'")
+    con.execute(f"SET preserve_insertion_order = {str(engine.preserve_insertion_order).lower()}")
+    con.execute(f"SET enable_object_cache = {str(engine.enable_object_cache).lower()}")
+    return con
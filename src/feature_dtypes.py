@@ -0,0 +1,41 @@
+# src/feature_dtypes.py
+from __future__ import annotations
+import re
+
+## compact output schema of the feature tables:
+    # the feature stages compute in DOUBLE / INTEGER and cast on write, by column name:
+    # - rates, ratios & frequencies -> FLOAT (float32)
+    # - markers, no-history flags & labels -> TINYINT (int8); nullable markers stay nullable
+    # - segment bins -> SMALLINT (int16): a bin is the index of its split (see src/binning.py),
+    #   so the split lists are not held to 127 splits
+    # ids, keys, amounts in cents and dates keep their types.
+    # a value out of the target type's range makes the cast (and the stage) fail instead of wrapping.
+
+DTYPE_RULES: list[tuple[re.Pattern, str]] = [
+    (re.compile(r"^(Rate_|Rt_|Freq_)|^Generosity_ratio$"), "FLOAT"),
+    (re.compile(r"_marker(_(hl)?\d+d)?$|^no_history_indicator_(hl)?\d+d$"), "TINYINT"),
+    (re.compile(r"_bin$"), "SMALLINT"),
+    (re.compile(r"^label_(invalid|valid|same_user_fh|same_user_st(_\d+d)?)$"), "TINYINT"),
+]
+
+
+def feature_dtype(col: str) -> str | None:
+    """Target DuckDB type of a feature column, None to keep its type."""
+    for pattern, dtype in DTYPE_RULES:
+        if pattern.search(col):
+            return dtype
+    return None
+
+
+def typed_select_sql(con, relation: str, order_by: str | None = None) -> str:
+    """
+    SELECT of every column of `relation` in order, cast to its compact feature type.
+    A table's row order only survives a write without preserve_insertion_order (see src/engine.py)
+    when the writing query sorts it again: pass that order as `order_by`.
+    """
+    cols = [row[0] for row in con.execute(f"DESCRIBE {relation}").fetchall()]
+    exprs = []
+    for col in cols:
+        dtype = feature_dtype(col)
+        exprs.append(f'CAST("{col}" AS {dtype}) AS "{col}"' if dtype else f'"{col}"')
+    return f"SELECT {', '.join(exprs)} FROM {relation}" + (f" ORDER BY {order_by}" if order_by else "")
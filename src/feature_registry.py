@@ -0,0 +1,129 @@
+# src/feature_registry.py
+from __future__ import annotations
+from src.feature_dtypes import feature_dtype
+from dataclasses import dataclass
+from pathlib import Path
+import pickle
+import re
+
+## feature registry:
+    # which stage writes each column of the feature tables, its written dtype and what it is computed from.
+    # columns are matched by name (windows, half-lives and encodings vary), the way src/feature_dtypes.py
+    # types them; features_combining uses it to read every requested column from the one table that owns it.
+    # - receipts:            the receipt's own columns, carried by every feature table
+    # - src.labels:          the labels, carried by the coupon features table
+    # - src.cpn_features:    bins, ratios, calendar markers and segment rates
+    # - src.user_features:   user history rates and frequencies
+    # - src.target_encoding: smoothed rates of arbitrary keys (an extra features table)
+    # each feature also names its family (the section of the stage computing it) and, for a history feature,
+    # its lookback window or half-life, so a column list can be traced back to the work producing it (plan_features).
+
+RECEIPT_COLUMNS = ["receipt_key", "Receive_date", "Start_date", "End_date", "Price_limit_cent", "Coupon_amt_cent"]
+LABEL_COLUMNS = ["label_invalid", "label_same_user_fh", "label_same_user_st"]
+
+_SEGMENT_HISTORY = ("Price_limit_bin", "Coupon_limit_bin", "Expiry_span_bin", "Receive_date", *LABEL_COLUMNS)
+_USER_HISTORY = ("User_id_code", "Receive_date")
+_WINDOW = r"_(hl)?\d+d$"
+_USER_FAMILIES = ("rcs", "txns", "visits")  # the order of src.user_features.USER_FAMILIES
+
+_RULES: list[tuple[re.Pattern, str, str | None, tuple[str, ...]]] = [
+    (re.compile(r"^(receipt_key|User_id_code|Coupon_id_code|Receive_date|Start_date|End_date"
+                r"|Price_limit_cent|Coupon_amt_cent)$"), "receipts", None, ()),
+    (re.compile(r"^label_"), "src.labels", None, ("receipts", "txns")),
+    (re.compile(r"^Price_limit_bin$"), "src.cpn_features", "bins", ("Price_limit_cent",)),
+    (re.compile(r"^Coupon_limit_bin$"), "src.cpn_features", "bins", ("Coupon_amt_cent",)),
+    (re.compile(r"^Expiry_span_bin$"), "src.cpn_features", "bins", ("Start_date", "End_date")),
+    (re.compile(r"^Generosity_ratio$"), "src.cpn_features", "ratios", ("Coupon_amt_cent", "Price_limit_cent")),
+    (re.compile(r"^(Start|End)_bf_receive_marker$"), "src.cpn_features", "ratios",
+     ("Receive_date", "Start_date", "End_date")),
+    (re.compile(r"^(Weekday|Workday|Holiday)_marker$"), "src.cpn_features", "calendar", ("Receive_date", "date_dim")),
+    (re.compile(r"^(no_history_indicator|Rate_(invalid|fh_redeem|st_redeem))" + _WINDOW), "src.cpn_features",
+     "segment", _SEGMENT_HISTORY),
+    (re.compile(r"^(no_hist_rcs_marker|Rate_same_user_(invalid|fh_redeem|st_redeem))" + _WINDOW), "src.user_features",
+     "rcs", (*_USER_HISTORY, *LABEL_COLUMNS)),
+    (re.compile(r"^(no_hist_txns_marker|Rt_avgspend_vs_pricelimit|Rt_avgreduce_vs_couponamt|Freq_purchase)" + _WINDOW),
+     "src.user_features", "txns", (*_USER_HISTORY, "Price_limit_cent", "Coupon_amt_cent", "txns")),
+    (re.compile(r"^(no_hist_visits_marker|Freq_visit)" + _WINDOW), "src.user_features", "visits",
+     (*_USER_HISTORY, "visits")),
+    (re.compile(r"^(no_hist_te_\w+_marker|Rate_te_\w+)_\d+d$"), "src.target_encoding", None,
+     ("Receive_date", *LABEL_COLUMNS)),
+]
+
+
+@dataclass(frozen=True)
+class FeatureSpec:
+    name: str
+    module: str                 # the stage writing it ("receipts": the receipt's own column)
+    family: str | None          # the section computing it, e.g. "calendar", "segment", "rcs", "visits"
+    dtype: str | None           # DuckDB type it is written with; None: kept from its source
+    inputs: tuple[str, ...]     # columns and tables it is computed from
+    window_len: int | None = None   # lookback window [Receive_date - window_len, Receive_date - 1]
+    half_life: int | None = None    # or decay half-life, in days
+
+
+def feature_spec(name: str) -> FeatureSpec | None:
+    """The registry entry of a column, None for an unregistered one."""
+    for pattern, module, family, inputs in _RULES:
+        if pattern.search(name):
+            window = re.search(_WINDOW, name) if family in ("segment", *_USER_FAMILIES) else None
+            window_len = int(name[window.start() + 1:-1]) + 1 if window and not window.group(1) else None
+            half_life = int(name[window.start() + 3:-1]) if window and window.group(1) else None
+            return FeatureSpec(name, module, family, feature_dtype(name), inputs, window_len, half_life)
+    return None
+
+
+def registered_columns(columns: list[str], module: str) -> list[str]:
+    """The columns of a table (in its order) that `module` writes."""
+    return [c for c in columns if (spec := feature_spec(c)) is not None and spec.module == module]
+
+
+def load_feature_selection(pickle_path: Path) -> list[str]:
+    """
+    A model's column list, e.g. conf/feature_selection/*.pkl.
+    The receipt_key_1 / receipt_key_2 join artifacts of the full-width table are dropped.
+    """
+    with open(pickle_path, 'rb') as f:
+        cols = pickle.load(f)
+    return [c for c in cols if not re.fullmatch(r"receipt_key_\d+", c)]
+
+
+@dataclass
+class FeaturePlan:
+    """The stage arguments producing a column list; see plan_features()."""
+    coupon_windows: list[int]       # coupon_features' lookback_days
+    coupon_half_lives: list[int]
+    calendar_markers: bool
+    user_families: list[str]        # user_features' families; empty: no user features needed
+    user_windows: list[int]
+    user_half_lives: list[int]
+    other: list[str]                # columns of other stages (e.g. target encodings), not planned here
+
+
+def plan_features(columns: list[str]) -> FeaturePlan:
+    """
+    Trace requested columns back to the families and windows producing them.
+    The user families share their windows (user_features takes one list); raises on unknown columns.
+    """
+    specs = []
+    for col in columns:
+        spec = feature_spec(col)
+        if spec is None:
+            raise ValueError(f"Unknown feature {col!r}: not in the feature registry")
+        specs.append(spec)
+
+    def windows(families):
+        return sorted({s.window_len for s in specs if s.family in families and s.window_len is not None})
+
+    def half_lives(families):
+        return sorted({s.half_life for s in specs if s.family in families and s.half_life is not None})
+
+    families = {s.family for s in specs}
+    return FeaturePlan(
+        coupon_windows=windows({"segment"}),
+        coupon_half_lives=half_lives({"segment"}),
+        calendar_markers="calendar" in families,
+        user_families=[f for f in _USER_FAMILIES if f in families],
+        user_windows=windows(set(_USER_FAMILIES)),
+        user_half_lives=half_lives(set(_USER_FAMILIES)),
+        other=[s.name for s in specs if s.module not in ("receipts", "src.labels", "src.cpn_features", "src.user_features")],
+    )
@@ -1,6 +1,6 @@
 # src/flags.py
 from __future__ import annotations
-import duckdb
+from src.engine import EngineProfile, connect
 from pathlib import Path
 
 def add_txn_level_flags(
@@ -9,6 +9,7 @@ def add_txn_level_flags(
     txn_out_parquet: Path,  # the name should reflect the reconcile_strict status- strict or relax.
     reconcile_strict: bool = 0, # 1 means not allowing reconciliation, 0 means allowing.
     threads: int = 8,
+    engine: EngineProfile | str | None = None,
 ):
     """
     Inputs:
@@ -24,8 +25,7 @@ def add_txn_level_flags(
     Output:
     the txn table with added flags. In the parquet format.
     """
-    con = duckdb.connect()
-    con.execute(f"PRAGMA threads={threads}")
+    con = connect(engine, threads)
 
     # =========================
     # SECTION 1: Load & cast
@@ -0,0 +1,211 @@
+# src/label_state.py
+from __future__ import annotations
+from src.engine import EngineProfile, connect
+from pathlib import Path
+from datetime import date
+import re
+
+### notes on the label state store:
+    # a directory holding the per-receipt partial match state of build_labels' redemption labels:
+    # - open.parquet:       receipts with at least one redemption window still open at the data cutoff,
+    #                       rewritten on every refresh.
+    # - closed/*.parquet:   receipts whose windows have all closed; their labels are final and
+    #                       never touched again (one part file per refresh, a receipt in one part only).
+    # both are staged as .tmp files and swapped in, open.parquet last.
+    # only the redemption labels (fh and every st horizon) and their audit columns are maintained;
+    # the validity flags (early / late / cross-user) still come from a full build_labels run.
+
+_ST_HORIZON = re.compile(r"^label_same_user_st_(\d+)d$")
+
+
+def _st_horizons(con, relation: str) -> list[int]:
+    cols = [row[0] for row in con.execute(f"DESCRIBE {relation}").fetchall()]
+    return [int(m.group(1)) for m in map(_ST_HORIZON.match, cols) if m]
+
+
+def _finalize_sql(horizons: list[int], source: str, cutoff_param: str = "?") -> str:
+    """SELECT recomputing labels & finality flags from the partial match state in `source`."""
+    st_cols = ",\n".join(
+        f"""CASE WHEN s.first_valid_txn_time <= LEAST(s.End_date, s.Receive_date + INTERVAL {n} DAY)
+                 THEN 1 ELSE 0 END AS label_same_user_st_{n}d,
+            (s.Receive_date IS NULL OR s.End_date IS NULL
+                OR LEAST(s.End_date, s.Receive_date + INTERVAL {n} DAY) <= {cutoff_param}
+            ) AS label_same_user_st_{n}d_final"""
+        for n in horizons)
+    return f"""
+        SELECT
+            s.receipt_key, s.User_id_code, s.Coupon_id_code,
+            s.Receive_date, s.End_date, s.start_eff, s.end_eff, s.short_end,
+            s.first_valid_txn_key, s.first_valid_txn_time, s.same_user_valid_txn_count,
+            CASE WHEN s.first_valid_txn_time IS NOT NULL THEN 1 ELSE 0 END AS label_same_user_fh,
+            CASE WHEN s.first_valid_txn_time <= s.short_end THEN 1 ELSE 0 END AS label_same_user_st,
+            (s.start_eff IS NULL OR s.end_eff IS NULL OR s.end_eff <= {cutoff_param}) AS label_same_user_fh_final,
+            {st_cols},
+            CAST({cutoff_param} AS DATE) AS state_cutoff_at
+        FROM {source} s
+    """
+
+
+def _write_state(con, state_dir: Path, horizons: list[int], cutoff: date) -> None:
+    """Split table `state` into closed (final) receipts and the still-open ones."""
+    all_final = " AND ".join(
+        ["label_same_user_fh_final"] + [f"label_same_user_st_{n}d_final" for n in horizons])
+    con.execute(f"""
+        CREATE OR REPLACE TABLE state_flagged AS
+            SELECT *, ({all_final}) AS label_final
+            FROM state
+    """)
+
+    closed_dir = state_dir / "closed"
+    closed_dir.mkdir(parents=True, exist_ok=True)
+    part = closed_dir / f"part_{cutoff:%Y%m%d}.parquet"
+
+    # receipts already closed by another part file (e.g. by a refresh that failed before
+    # swapping open.parquet) are not closed twice
+    done = [str(p) for p in sorted(closed_dir.glob("*.parquet")) if p != part]
+    skip = "" if not done else f"""
+        AND receipt_key NOT IN (SELECT receipt_key FROM read_parquet({done!r}))"""
+    n_closed = con.execute(f"SELECT COUNT(*) FROM state_flagged WHERE label_final {skip}").fetchone()[0]
+
+    # stage both files aside, then swap the closed part and open.parquet last,
+    # so a failed refresh keeps the old open state
+    part_tmp = closed_dir / f"{part.name}.tmp"
+    if n_closed:
+        con.sql(f"SELECT * FROM state_flagged WHERE label_final {skip}").write_parquet(str(part_tmp))
+    open_tmp = state_dir / "open.parquet.tmp"
+    con.sql("SELECT * FROM state_flagged WHERE NOT label_final").write_parquet(str(open_tmp))
+    if n_closed:
+        part_tmp.replace(part)
+    open_tmp.replace(state_dir / "open.parquet")
+
+
+def init_label_state(
+        labels_parquet: Path,
+        state_dir: Path,
+        data_cutoff_at: date,
+        threads: int = 8,
+        engine: EngineProfile | str | None = None
+) -> None:
+    """
+    Seed the label state store from a build_labels output computed on the txns up to data_cutoff_at.
+
+    A label is final once its window has closed by data_cutoff_at:
+    - label_same_user_fh:      end_eff <= data_cutoff_at
+    - label_same_user_st_{N}d: min(End_date, Receive_date + N days) <= data_cutoff_at
+    (receipts with missing dates have an empty window, which is final right away.)
+    """
+    state_dir = Path(state_dir)
+    state_dir.mkdir(parents=True, exist_ok=True)
+
+    con = connect(engine, threads)
+
+    con.execute("""
+        CREATE OR REPLACE TABLE labels AS
+            SELECT * FROM read_parquet(?)
+    """, [str(labels_parquet)])
+    horizons = _st_horizons(con, "labels")
+
+    con.execute(f"CREATE OR REPLACE TABLE state AS {_finalize_sql(horizons, 'labels', '$cutoff')}",
+                {"cutoff": data_cutoff_at})
+    _write_state(con, state_dir, horizons, data_cutoff_at)
+    con.close()
+
+
+def update_label_state(
+        state_dir: Path,
+        new_txns_parquet: Path,
+        data_cutoff_at: date,
+        reconcile_strict: bool = 0, # 1: not allowing txns with an imputed coupon_id; 0: allowed.
+        threads: int = 8,
+        engine: EngineProfile | str | None = None
+) -> None:
+    """
+    Fold a new partition of txns (Pay_date up to data_cutoff_at, not overlapping earlier partitions)
+    into the open receipts of the label state store.
+
+    Only open receipts are read, matched and rewritten; receipts whose windows all close
+    by data_cutoff_at move to a new closed part file.
+    """
+    state_dir = Path(state_dir)
+    con = connect(engine, threads)
+
+    # =========================
+    # Section 1: Load
+    # =========================
+    con.execute("""
+        CREATE OR REPLACE TABLE open_state AS
+            SELECT * FROM read_parquet(?)
+    """, [str(state_dir / "open.parquet")])
+    horizons = _st_horizons(con, "open_state")
+
+    con.execute(f"""
+        CREATE OR REPLACE TABLE txns AS
+            SELECT
+                CAST(txn_key    AS BIGINT)      AS txn_key,
+                CAST(User_id_code    AS BIGINT) AS t_user,
+                CAST(Coupon_id_code  AS BIGINT) AS t_coupon,
+                CAST(Pay_date   AS TIMESTAMP)   AS Pay_date
+            FROM read_parquet(?)
+            {"WHERE coupon_id_imputed = 0" if reconcile_strict else ""}
+    """, [str(new_txns_parquet)])
+
+    # ==================================================
+    # Section 2: New same-user matches of open receipts
+    # ==================================================
+    con.execute("""
+        CREATE OR REPLACE TABLE new_matches AS
+            SELECT s.receipt_key,
+                MIN_BY(t.txn_key, t.Pay_date) AS new_first_txn_key,
+                MIN(t.Pay_date)               AS new_first_txn_time,
+                COUNT(*)                      AS new_txn_count
+            FROM open_state s
+            JOIN txns t
+              ON t.t_user = s.User_id_code
+             AND t.t_coupon = s.Coupon_id_code
+             AND s.start_eff IS NOT NULL AND s.end_eff IS NOT NULL
+             AND t.Pay_date BETWEEN s.start_eff AND s.end_eff
+            GROUP BY s.receipt_key
+    """)
+
+    # ==================================================
+    # Section 3: Merge into the partial state, re-label
+    # ==================================================
+    con.execute("""
+        CREATE OR REPLACE TABLE merged AS
+            SELECT
+                s.* REPLACE (
+                    CASE WHEN m.new_first_txn_time < s.first_valid_txn_time OR s.first_valid_txn_time IS NULL
+                         THEN m.new_first_txn_key ELSE s.first_valid_txn_key END AS first_valid_txn_key,
+                    CASE WHEN m.new_first_txn_time < s.first_valid_txn_time OR s.first_valid_txn_time IS NULL
+                         THEN m.new_first_txn_time ELSE s.first_valid_txn_time END AS first_valid_txn_time,
+                    s.same_user_valid_txn_count + COALESCE(m.new_txn_count, 0) AS same_user_valid_txn_count
+                )
+            FROM open_state s
+            LEFT JOIN new_matches m USING (receipt_key)
+    """)
+    con.execute(f"CREATE OR REPLACE TABLE state AS {_finalize_sql(horizons, 'merged', '$cutoff')}",
+                {"cutoff": data_cutoff_at})
+
+    # ===================================
+    # Section 4: Write state and close
+    # ===================================
+    _write_state(con, state_dir, horizons, data_cutoff_at)
+    con.close()
+
+
+def read_label_state(state_dir: Path, threads: int = 8,
+                     engine: EngineProfile | str | None = None):
+    """All receipts of the label state store (closed and open) as a pandas DataFrame."""
+    state_dir = Path(state_dir)
+    con = connect(engine, threads)
+    paths = sorted(str(p) for p in (state_dir / "closed").glob("*.parquet"))
+    paths.append(str(state_dir / "open.parquet"))
+    # a receipt present twice (closed, and still in an open.parquet not yet swapped) keeps its closed row
+    df = con.execute("""
+        SELECT * EXCLUDE (filename) FROM read_parquet(?, union_by_name = true, filename = true)
+        QUALIFY ROW_NUMBER() OVER (
+            PARTITION BY receipt_key ORDER BY label_final DESC, filename) = 1
+        ORDER BY receipt_key
+    """, [paths]).df()
+    con.close()
+    return df
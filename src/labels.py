@@ -1,7 +1,9 @@
 # src/labels.py
 from __future__ import annotations
-import duckdb
+from src.engine import EngineProfile, connect
+from src.profiling import ProfiledConnection
 from pathlib import Path
+import numbers
 
 ### notes on the txn.parquet and receipt.parquet:
 ### txn: 
@@ -17,14 +19,19 @@ def build_labels(
     txns_parquet: Path,
     out_parquet: Path,          # out_parquet's name should reflect the reconcile's strictness mode: strict(1) or relax(0).
     reconcile_strict: bool = 0, # 1: not allowing txns with an imputed coupon_id; 0: allowed.
-    short_days: int = 15,
+    short_days: int | list[int] = 15, # one horizon, or several; the first one backs label_same_user_st and short_end,
+                                      # the label_same_user_st_{N}d columns follow in ascending N without repeats.
     threads: int = 8,
+    engine: EngineProfile | str | None = None,
+    profile_dir: Path | None = None,
 ) -> None:
     """
     Create receipt-level labels + audit columns.
 
     - label_same_user_fh: same-user redemption within [start_eff, end_eff]
     - label_same_user_st: same-user redemption within [start_eff, min(end_eff, Receive_date + short_days)]
+    - label_same_user_st_{N}d: the same short-term label for every horizon N in short_days,
+                               all derived from the single full-horizon candidate join
     - label_valid:        no early / late / cross-user redemption c.d.t the valid fh usage window
     - first_valid_txn_key / _time (earliest valid txn in full horizon)
     - same_user_valid_txn_count / early / late
@@ -32,6 +39,7 @@ def build_labels(
     - other_user_without_own_receipt_count
 
     Writes a parquet with one row per receipt_key.
+    With a profile_dir, a per-section profiling report is written there as well (see src/profiling.py).
 
     Assumptions (first line includes all needed fields for this script):
     - Parquets contain: receipts: (receipt_key, User_id_code, Coupon_id_code, Receive_date, Start_date, End_date,
@@ -40,12 +48,20 @@ def build_labels(
                           Shop_id_code, Order_id_code, Coupon_type, Biz_code, Actual_pay_cent, Reduce_amount_cent)
     - Inclusive time windows (BETWEEN) per data_spec.
     """
-    con = duckdb.connect()
-    con.execute(f"PRAGMA threads={threads}")
+    horizons = [short_days] if isinstance(short_days, numbers.Integral) else list(short_days)
+    if not horizons:
+        raise ValueError("short_days should contain at least one horizon.")
+    if not all(isinstance(n, numbers.Integral) and not isinstance(n, bool) and n > 0 for n in horizons):
+        raise ValueError(f"short_days should be positive integers, got {horizons}.")
+    short_days = int(horizons[0])
+    horizons = sorted({int(n) for n in horizons})
+
+    con = ProfiledConnection(connect(engine, threads), profile_dir, run_name="build_labels")
 
     # =========================
     # SECTION 1: Load & cast
     # =========================
+    con.section("SECTION 1: Load & cast")
 
     # table: receipts
     con.execute("""
@@ -91,6 +107,7 @@ def build_labels(
     # ===========================================
     # SECTION 2: Effective windows per receipt
     # ===========================================
+    con.section("SECTION 2: Effective windows per receipt")
 
     # table: r (newly added cols: start_eff, end_eff, short_end)
     con.execute(f"""
@@ -112,6 +129,7 @@ def build_labels(
     # ==================================================
     # SECTION 3: Candidate same-user matches by window
     # ==================================================
+    con.section("SECTION 3: Candidate same-user matches by window")
 
     # table: cand_fh
     con.execute("""
@@ -125,21 +143,13 @@ def build_labels(
          AND t.Pay_date BETWEEN r.start_eff AND r.end_eff
     """)
 
-    # table: cand_st
-    con.execute("""
-        CREATE OR REPLACE TABLE cand_st AS
-        SELECT r.receipt_key, t.txn_key, t.Pay_date
-        FROM r
-        JOIN txns t
-          ON t.t_user = r.r_user
-         AND t.t_coupon = r.r_coupon
-         AND r.start_eff IS NOT NULL AND r.short_end IS NOT NULL
-         AND t.Pay_date BETWEEN r.start_eff AND r.short_end
-    """)
+    ## no separate short-term candidate join: every short-term window [start_eff, short_end] lies within
+    ## [start_eff, end_eff], so each horizon's label is read off the earliest full-horizon match (SECTION 7).
 
     # =====================================
     # SECTION 4: Earliest valid txn (audit)
     # =====================================
+    con.section("SECTION 4: Earliest valid txn (audit)")
 
     # table: first_valid
     ## this is not necessary as we are guessing what is the truth now:
@@ -156,6 +166,30 @@ def build_labels(
     # SECTION 5: Audit_counts part 1: 
     # Same-user early/late counts
     # ======================================
+    con.section("SECTION 5: Audit_counts part 1: Same-user early/late counts")
+
+    # table: coupon_txn_cum
+    ## coupon-level time-sorted txn index with prefix counts:
+    ## the txns of a coupon within [a, b] are cum(<= b) - cum(< a), i.e. two ASOF lookups per receipt
+    ## instead of joining each receipt to every txn of its (possibly very popular) coupon.
+    ## txns with a missing user never count as "other user" (t_user <> r_user is NULL), so they are left out.
+    con.execute("""
+        CREATE OR REPLACE TABLE coupon_txn_cum AS
+        WITH daily AS (
+          SELECT t_coupon, Pay_date, COUNT(*) AS txn_daily
+          FROM txns
+          WHERE t_user IS NOT NULL AND t_coupon IS NOT NULL AND Pay_date IS NOT NULL
+          GROUP BY 1,2
+        )
+        SELECT
+            t_coupon, Pay_date,
+            SUM(txn_daily) OVER (
+                PARTITION BY t_coupon
+                ORDER BY Pay_date
+                ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
+            ) AS txn_cum
+        FROM daily
+    """)
 
     # table: audit_counts
     con.execute("""
@@ -200,16 +234,28 @@ def build_labels(
           GROUP BY r.receipt_key
         ),
                 
-        --- for each receipt event, find the txns of other users using the same coupon (same id) within the valid usage window
+        --- for each receipt event, count the txns of other users using the same coupon (same id) within the valid usage window:
+        --- all users' txns in the window (prefix counts) minus the same user's ones (inwin)
        
-        otheru AS (
-          SELECT r.receipt_key, COUNT(*) AS other_user_in_window_txn_count
+        allu AS (
+          SELECT r.receipt_key, r.r_user,
+                 CASE WHEN r.start_eff IS NULL OR r.end_eff IS NULL OR r.start_eff > r.end_eff THEN 0
+                      ELSE COALESCE(hi.txn_cum, 0) - COALESCE(lo.txn_cum, 0)
+                 END AS all_user_in_window_txn_count
           FROM r
-          JOIN txns t ON t.t_coupon = r.r_coupon
-                      AND t.t_user <> r.r_user 
-                      AND r.start_eff IS NOT NULL AND r.end_eff IS NOT NULL
-                      AND t.Pay_date BETWEEN r.start_eff AND r.end_eff
-          GROUP BY r.receipt_key
+          ASOF LEFT JOIN coupon_txn_cum hi
+                ON hi.t_coupon = r.r_coupon AND r.end_eff >= hi.Pay_date
+          ASOF LEFT JOIN coupon_txn_cum lo
+                ON lo.t_coupon = r.r_coupon AND r.start_eff > lo.Pay_date
+        ),
+
+        otheru AS (
+          SELECT allu.receipt_key,
+                 CASE WHEN allu.r_user IS NULL THEN 0
+                      ELSE allu.all_user_in_window_txn_count - COALESCE(inwin.same_user_valid_txn_count, 0)
+                 END AS other_user_in_window_txn_count
+          FROM allu
+          LEFT JOIN inwin USING(receipt_key)
         )
     
         SELECT r.receipt_key,
@@ -230,45 +276,86 @@ def build_labels(
     # SECTION 6: Audit_counts part 2: 
     # Other-user WITHOUT OWN RECEIPT covering the txn
     # ==============================================================
+    con.section("SECTION 6: Audit_counts part 2: Other-user without own receipt")
 
+    # table: own_cover
+    ## merged per-(user, coupon) validity intervals: a txn is covered by its user's own receipt
+    ## iff it falls into one of these (disjoint) islands, found by a single ASOF lookup.
     con.execute("""
-            CREATE OR REPLACE TABLE other_user_hits AS
-            SELECT
-                r.receipt_key,
-                r.r_coupon             AS coupon_id,
-                t.t_user               AS other_user,
-                t.txn_key,
-                t.Pay_date
-            FROM r
-            JOIN txns t
-                ON t.t_coupon = r.r_coupon
-                AND t.t_user <> r.r_user
-                AND r.start_eff IS NOT NULL AND r.end_eff IS NOT NULL
-                AND t.Pay_date BETWEEN r.start_eff AND r.end_eff
+                CREATE OR REPLACE TABLE own_cover AS
+                WITH w AS (
+                    SELECT r_user, r_coupon, start_eff, end_eff,
+                        MAX(end_eff) OVER (
+                            PARTITION BY r_user, r_coupon
+                            ORDER BY start_eff, end_eff
+                            ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+                        ) AS prev_end
+                    FROM r
+                    WHERE r_user IS NOT NULL AND r_coupon IS NOT NULL
+                        AND start_eff IS NOT NULL AND end_eff IS NOT NULL
+                        AND start_eff <= end_eff
+                ),
+                islands AS (
+                    SELECT *,
+                        SUM(CASE WHEN prev_end IS NULL OR start_eff > prev_end THEN 1 ELSE 0 END) OVER (
+                            PARTITION BY r_user, r_coupon
+                            ORDER BY start_eff, end_eff
+                            ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
+                        ) AS island
+                    FROM w
+                )
+                SELECT r_user, r_coupon,
+                    MIN(start_eff) AS cover_start,
+                    MAX(end_eff)   AS cover_end
+                FROM islands
+                GROUP BY r_user, r_coupon, island
                 """)
-    
+
+    # table: uncovered_txn_cum
+    ## the same coupon-level prefix counts, restricted to txns NOT covered by their user's own receipt.
+    ## the receipt's own user's txns within its window are covered by the receipt itself,
+    ## so the in-window count of uncovered txns only contains other users' txns.
     con.execute("""
-                CREATE OR REPLACE TABLE other_user_wo_own_receipt AS
+                CREATE OR REPLACE TABLE uncovered_txn_cum AS
+                WITH uncovered AS (
+                    SELECT t.t_coupon, t.Pay_date
+                    FROM txns t
+                    ASOF LEFT JOIN own_cover c
+                        ON c.r_user = t.t_user
+                        AND c.r_coupon = t.t_coupon
+                        AND t.Pay_date >= c.cover_start
+                    WHERE t.t_user IS NOT NULL AND t.t_coupon IS NOT NULL AND t.Pay_date IS NOT NULL
+                        AND (c.cover_end IS NULL OR t.Pay_date > c.cover_end)   --- the key part: no receipt event is matched
+                ),
+                daily AS (
+                    SELECT t_coupon, Pay_date, COUNT(*) AS txn_daily
+                    FROM uncovered
+                    GROUP BY 1,2
+                )
                 SELECT
-                    o.receipt_key,
-                    o.txn_key
-                FROM other_user_hits o
-                LEFT JOIN r r2
-                    ON r2.r_user = o.other_user
-                    AND r2.r_coupon = o.coupon_id
-                    AND r2.start_eff IS NOT NULL AND r2.end_eff IS NOT NULL
-                    AND o.Pay_date BETWEEN r2.start_eff AND r2.end_eff
-                WHERE r2.receipt_key IS NULL   --- the key part: no receipt event is matched
+                    t_coupon, Pay_date,
+                    SUM(txn_daily) OVER (
+                        PARTITION BY t_coupon
+                        ORDER BY Pay_date
+                        ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
+                    ) AS txn_cum
+                FROM daily
                 """)
     
     # table: other_user_wo_own_receipt_txn_counts
     con.execute("""
                 CREATE OR REPLACE TABLE other_user_wo_own_receipt_counts AS
                 SELECT
-                    receipt_key,
-                    COUNT(DISTINCT txn_key) AS other_user_without_own_receipt_txn_count
-                FROM other_user_wo_own_receipt
-                GROUP BY receipt_key
+                    r.receipt_key,
+                    CASE WHEN r.r_user IS NULL OR r.start_eff IS NULL OR r.end_eff IS NULL OR r.start_eff > r.end_eff
+                         THEN 0
+                         ELSE COALESCE(hi.txn_cum, 0) - COALESCE(lo.txn_cum, 0)
+                    END AS other_user_without_own_receipt_txn_count
+                FROM r
+                ASOF LEFT JOIN uncovered_txn_cum hi
+                    ON hi.t_coupon = r.r_coupon AND r.end_eff >= hi.Pay_date
+                ASOF LEFT JOIN uncovered_txn_cum lo
+                    ON lo.t_coupon = r.r_coupon AND r.start_eff > lo.Pay_date
                 """)
     
 
@@ -276,9 +363,14 @@ def build_labels(
     # SECTION 7: Final labels (fh, st)
     # Also generate the flags related to invalid redemption
     # ==========================================
+    con.section("SECTION 7: Final labels (fh, st) & invalid-redemption flags")
 
     # table: labels
-    con.execute("""
+    st_horizons = ",\n".join(
+        f"""CASE WHEN fv.first_valid_txn_time <= LEAST(r.End_date, r.Receive_date + INTERVAL {n} DAY)
+                 THEN 1 ELSE 0 END AS label_same_user_st_{n}d"""
+        for n in horizons)
+    con.execute(f"""
         CREATE OR REPLACE TABLE labels AS
         SELECT
             r.receipt_key,
@@ -286,11 +378,13 @@ def build_labels(
             r.r_coupon      AS Coupon_id_code,
             r.Receive_date, r.Start_date, r.End_date,
             r.start_eff, r.end_eff, r.short_end,
-            CASE WHEN EXISTS (SELECT 1 FROM cand_fh WHERE cand_fh.receipt_key = r.receipt_key)
+            CASE WHEN fv.receipt_key IS NOT NULL
                  THEN 1 ELSE 0 END AS label_same_user_fh,
-            CASE WHEN EXISTS (SELECT 1 FROM cand_st WHERE cand_st.receipt_key = r.receipt_key)
-                 THEN 1 ELSE 0 END AS label_same_user_st
+            CASE WHEN fv.first_valid_txn_time <= r.short_end
+                 THEN 1 ELSE 0 END AS label_same_user_st,
+            {st_horizons}
         FROM r
+        LEFT JOIN first_valid fv USING (receipt_key)
     """)
 
     # generate flag_early and flag_late
@@ -326,6 +420,7 @@ def build_labels(
     # ==============================================================
     # SECTION 8: Merge labels, audits, flags into final labels_out
     # ==============================================================
+    con.section("SECTION 8: Merge labels, audits, flags into final labels_out")
 
     # generate flag_struc_invalid
     con.execute("""
@@ -372,5 +467,6 @@ def build_labels(
     # ==========================================
     # SECTION 9: Write parquet and close
     # ==========================================
+    con.section("SECTION 9: Write parquet and close")
     con.sql("SELECT * FROM labels_out").write_parquet(str(out_parquet))
     con.close()
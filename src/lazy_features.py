@@ -0,0 +1,61 @@
+# src/lazy_features.py
+from __future__ import annotations
+from src.engine import EngineProfile
+from src.cpn_features import coupon_features
+from src.user_features import user_features
+from src.combine_features import features_combining
+from src.feature_registry import FeaturePlan, load_feature_selection, plan_features
+from pathlib import Path
+
+## lazy feature computation:
+    # a model reading a few columns (e.g. conf/feature_selection/ROI_train_cols_m_7d.pkl) only needs the
+    # sections and windows producing them. the requested columns are traced back through the registry
+    # (see src/feature_registry.py) and each stage runs with just those:
+    # - coupon_features always runs (it carries the receipt columns and the labels), with the requested
+    #   segment windows / half-lives only, and without the date dimension unless a calendar marker is requested
+    # - user_features runs only the requested families, over the union of their windows / half-lives
+    #   (one list is shared by the families), and not at all without a requested user feature
+    # the trainable table then holds receipt_key and the requested columns (see src/combine_features.py).
+
+
+def lazy_features(
+        columns: list[str] | Path, # a column list or a feature selection pickle
+        receipts_labelled_parquet: Path,
+        txns_parquet: Path,
+        visits_parquet: Path,
+        cpn_out_parquet: Path,
+        user_out_parquet: Path,    # not written without requested user features
+        out_parquet: Path,         # the trainable table of the requested columns
+        extra_features_parquets: list[Path] = [], # tables of the columns not planned here, e.g. target encodings
+        coupon_kwargs: dict | None = None, # extra arguments of coupon_features (splits, calendar, store...)
+        user_kwargs: dict | None = None,   # extra arguments of user_features (activity store...)
+        threads: int = 8,
+        engine: EngineProfile | str | None = None,
+        profile_dir: Path | None = None
+) -> FeaturePlan:
+    """
+    Generate only the features of the requested columns and write their trainable table to out_parquet.
+    Returns the plan the stages were run with.
+    """
+    if isinstance(columns, (str, Path)):
+        columns = load_feature_selection(columns)
+    plan = plan_features(columns)
+
+    coupon_features(receipts_labelled_parquet, cpn_out_parquet,
+                    lookback_days=plan.coupon_windows,
+                    half_lives=plan.coupon_half_lives,
+                    calendar_markers=plan.calendar_markers,
+                    threads=threads, engine=engine, profile_dir=profile_dir,
+                    **(coupon_kwargs or {}))
+    if plan.user_families:
+        user_features(receipts_labelled_parquet, txns_parquet, visits_parquet, user_out_parquet,
+                      lookback_days=plan.user_windows,
+                      half_lives=plan.user_half_lives,
+                      families=plan.user_families,
+                      threads=threads, engine=engine, profile_dir=profile_dir,
+                      **(user_kwargs or {}))
+
+    features_combining(cpn_out_parquet, user_out_parquet if plan.user_families else None, out_parquet,
+                       extra_features_parquets=extra_features_parquets, columns=columns,
+                       threads=threads, engine=engine)
+    return plan
@@ -0,0 +1,248 @@
+# src/online_store.py
+from __future__ import annotations
+from src.engine import EngineProfile, connect
+from src.prefix_sums import MISSING_TIME, US_PER_DAY
+from src.user_features import DAILY_SQL, USER_FAMILIES, daily_records
+from bisect import bisect_right
+from pathlib import Path
+from datetime import date
+import math
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+### notes on the online user feature store:
+    # per user and family (receipts, orders, visits): the sorted days with activity and the running sums
+    # of the family's daily aggregates (the same DAILY_SQL as user_features), held in plain dicts and lists.
+    # a receipt's feature vector is two bisects per window and a few divisions, mirroring user_features'
+    # SQL (DuckDB's ROUND, then the compact FLOAT / TINYINT cast), so it equals the batch row of the receipt.
+    # - update(): adds a batch of events (parquet files or DataFrames) to the running sums.
+    #   a batch must hold whole orders: one order's txn rows are deduplicated within the batch.
+    #   labelled receipts are added once their labels are known.
+    # - save() / load(): one .npz of the daily aggregates per family; the running sums are rebuilt on load.
+    # dates are whole days; events without a user or a date never count towards a dated receipt.
+    # decayed (half-life) features are not served here.
+
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+# the SELECT of each family's events, from the same columns as user_features loads
+_LOAD_SQL = {
+    "rcs": """
+        SELECT
+            User_id_code,
+            Receive_date,
+            CASE WHEN label_valid = 1 THEN 0 ELSE 1 END AS label_invalid,
+            label_same_user_fh,
+            label_same_user_st
+        FROM {src}""",
+    "txns": """
+        SELECT
+            User_id_code,
+            Order_id_code,
+            Pay_date,
+            Actual_pay_cent, Reduce_amount_cent
+        FROM {src}""",
+    "visits": """
+        SELECT
+            User_id_code,
+            CAST (Visit_date AS TIMESTAMP) AS Visit_date
+        FROM {src}""",
+}
+_TABLES = {"rcs": "receipts", "txns": "txns", "visits": "visits"}
+
+
+def _round3(x: float) -> float:
+    """DuckDB's ROUND(x, 3) on a DOUBLE: round half away from zero of x * 1000."""
+    v = abs(x * 1000)
+    r = math.floor(v)
+    if v - r >= 0.5:
+        r += 1
+    return math.copysign(r, x) / 1000
+
+
+def _ratio(num: int, den: int) -> float:
+    """CASE WHEN den = 0 THEN 0.000 ELSE ROUND(num / den, 3) END"""
+    return 0.0 if den == 0 else _round3(float(num) / float(den))
+
+
+class OnlineUserStore:
+    """
+    Per-user running aggregates of the user feature families,
+    answering the user_features row of one receipt in-process.
+    """
+
+    def __init__(self, lookback_days: list[int] = [8, 15, 31]):
+        self.lookback_days = list(lookback_days)
+        self._days = {f: {} for f in USER_FAMILIES}  # family -> user -> sorted day keys with activity
+        self._cum = {f: {} for f in USER_FAMILIES}   # family -> user -> running sums (tuples) through each day
+        self.feature_names = [n for f in USER_FAMILIES for w in self.lookback_days
+                              for n in self._family_names(f, w - 1)]
+
+    @staticmethod
+    def _family_names(family: str, d: int) -> list[str]:
+        if family == "rcs":
+            return [f"no_hist_rcs_marker_{d}d"] + [f"Rate_same_user_{c}_{d}d" for c in ["invalid", "fh_redeem", "st_redeem"]]
+        if family == "txns":
+            return [f"no_hist_txns_marker_{d}d", f"Rt_avgspend_vs_pricelimit_{d}d",
+                    f"Rt_avgreduce_vs_couponamt_{d}d", f"Freq_purchase_{d}d"]
+        return [f"no_hist_visits_marker_{d}d", f"Freq_visit_{d}d"]
+
+    # ------------------------------------------------------------------ updates
+
+    def _merge(self, family: str, users: np.ndarray, days: np.ndarray, values: np.ndarray) -> None:
+        """Add daily aggregates (sorted by user, day; one row per user and day) to the running sums."""
+        store_days, store_cum = self._days[family], self._cum[family]
+        bounds = np.flatnonzero(np.diff(users)) + 1
+        for lo, hi in zip(np.r_[0, bounds], np.r_[bounds, len(users)]):
+            user = int(users[lo])
+            new_days, new_vals = days[lo:hi].tolist(), values[lo:hi].tolist()
+            old_days, old_cum = store_days.get(user, []), store_cum.get(user, [])
+            if old_days and new_days[0] <= old_days[-1]:
+                # days at or before the user's last day: back to daily values, add, and re-accumulate
+                daily = dict(zip(old_days, (tuple(c - p for c, p in zip(cur, prev))
+                                            for cur, prev in zip(old_cum, [(0,) * len(old_cum[0])] + old_cum))))
+                for d, v in zip(new_days, new_vals):
+                    daily[d] = tuple(a + b for a, b in zip(daily.get(d, (0,) * len(v)), v))
+                old_days, old_cum = [], []
+                new_days = sorted(daily)
+                new_vals = [daily[d] for d in new_days]
+            running = old_cum[-1] if old_cum else (0,) * values.shape[1]
+            cum = list(old_cum)
+            for v in new_vals:
+                running = tuple(a + b for a, b in zip(running, v))
+                cum.append(running)
+            store_days[user] = old_days + new_days
+            store_cum[user] = cum
+
+    def _add_records(self, family: str, records: dict[str, np.ndarray]) -> None:
+        dated = records["t"] != MISSING_TIME
+        users = records["User_id_code"][dated].astype(np.int64)
+        days = records["t"][dated] // US_PER_DAY
+        values = np.column_stack([records[c][dated] for c in DAILY_SQL[family][2]]).astype(np.int64)
+        order = np.lexsort((days, users))
+        self._merge(family, users[order], days[order], values[order])
+
+    def update(
+            self,
+            receipts_labelled: Path | pd.DataFrame | None = None,
+            txns: Path | pd.DataFrame | None = None,
+            visits: Path | pd.DataFrame | None = None,
+            threads: int = 8,
+            engine: EngineProfile | str | None = None
+    ) -> None:
+        """Add a batch of labelled receipts, txns and / or visits (parquet paths or DataFrames)."""
+        con = connect(engine, threads)
+        for family, source in zip(USER_FAMILIES, [receipts_labelled, txns, visits]):
+            if source is None:
+                continue
+            if isinstance(source, pd.DataFrame):
+                con.register("events", pa.Table.from_pandas(source, preserve_index=False))
+                con.execute(f"CREATE OR REPLACE TABLE {_TABLES[family]} AS {_LOAD_SQL[family].format(src='events')}")
+                con.unregister("events")
+            else:
+                con.execute(f"CREATE OR REPLACE TABLE {_TABLES[family]} AS {_LOAD_SQL[family].format(src='read_parquet(?)')}",
+                            [str(source)])
+            self._add_records(family, daily_records(con, family))
+        con.close()
+
+    # ------------------------------------------------------------------ lookups
+
+    def _window(self, family: str, user: int, day: int, window_len: int) -> tuple[bool, tuple]:
+        """No-history flag and sums over the days (day - window_len, day - 1] of one user."""
+        days = self._days[family].get(user)
+        if not days:
+            return True, (0,) * len(DAILY_SQL[family][2])
+        cum = self._cum[family][user]
+        r = bisect_right(days, day - 1)
+        l = bisect_right(days, day - window_len)
+        right = cum[r - 1] if r else (0,) * len(cum[0])
+        left = cum[l - 1] if l else (0,) * len(cum[0])
+        return l == 0, tuple(a - b for a, b in zip(right, left))
+
+    def _values(self, user: int, receive_date: date, price_limit_cent: int | None,
+                coupon_amt_cent: int | None) -> list:
+        """The feature values in feature_names order: markers as int, rates as DOUBLE rounded the DuckDB way."""
+        day = receive_date.toordinal() - _EPOCH_ORDINAL
+        vals = []
+        for family in USER_FAMILIES:
+            for window_len in self.lookback_days:
+                d = window_len - 1
+                no_hist, sums = self._window(family, user, day, window_len)
+                if family == "rcs":
+                    invalid, fh, st, vol = sums
+                    vals += [int(no_hist), _ratio(invalid, vol), _ratio(fh, vol), _ratio(st, vol)]
+                elif family == "txns":
+                    order_vol, txn_amt, reduce_amt = sums
+                    vals += [int(no_hist),
+                             self._per_order(txn_amt, order_vol, price_limit_cent),
+                             self._per_order(reduce_amt, order_vol, coupon_amt_cent),
+                             _round3(float(order_vol) / d)]
+                else:
+                    vals += [int(no_hist), _round3(float(sums[0]) / d)]
+        return vals
+
+    def features(self, user: int, receive_date: date, price_limit_cent: int | None,
+                 coupon_amt_cent: int | None) -> dict:
+        """
+        The user features of a coupon received by `user` on `receive_date`, in user_features' column order.
+        Rates are the DOUBLE values user_features computes before its FLOAT cast (None where it writes NULL).
+        """
+        return dict(zip(self.feature_names, self._values(user, receive_date, price_limit_cent, coupon_amt_cent)))
+
+    def vector(self, user: int, receive_date: date, price_limit_cent: int | None,
+               coupon_amt_cent: int | None) -> np.ndarray:
+        """The features as a float32 vector in feature_names order, equal to the written row (NaN for NULL)."""
+        vals = self._values(user, receive_date, price_limit_cent, coupon_amt_cent)
+        return np.array([math.nan if v is None else v for v in vals], dtype=np.float32)
+
+    @staticmethod
+    def _per_order(amt: int, order_vol: int, cents: int | None) -> float | None:
+        """ROUND(amt / order_vol / (cents + 1), 3), 0 without orders"""
+        if order_vol == 0:
+            return 0.0
+        if cents is None:
+            return None
+        return _round3(float(amt) / float(order_vol) / float(cents + 1))
+
+    # ------------------------------------------------------------------ persistence
+
+    def save(self, path: Path) -> None:
+        """Write the store's daily aggregates to one .npz file."""
+        arrays = {"lookback_days": np.array(self.lookback_days, dtype=np.int64)}
+        for family in USER_FAMILIES:
+            users, days, values = [], [], []
+            for user, user_days in self._days[family].items():
+                cum = np.array(self._cum[family][user], dtype=np.int64)
+                users.append(np.full(len(user_days), user, dtype=np.int64))
+                days.append(np.array(user_days, dtype=np.int64))
+                values.append(np.diff(cum, axis=0, prepend=0))
+            n_values = len(DAILY_SQL[family][2])
+            arrays[f"{family}_users"] = np.concatenate(users) if users else np.zeros(0, dtype=np.int64)
+            arrays[f"{family}_days"] = np.concatenate(days) if days else np.zeros(0, dtype=np.int64)
+            arrays[f"{family}_values"] = np.vstack(values) if values else np.zeros((0, n_values), dtype=np.int64)
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        np.savez_compressed(path, **arrays)
+
+    @classmethod
+    def load(cls, path: Path) -> OnlineUserStore:
+        with np.load(path) as f:
+            store = cls(f["lookback_days"].tolist())
+            for family in USER_FAMILIES:
+                store._merge(family, f[f"{family}_users"], f[f"{family}_days"], f[f"{family}_values"])
+        return store
+
+
+def build_online_store(
+        receipts_labelled_parquet: Path,
+        txns_parquet: Path,
+        visits_parquet: Path,
+        store_path: Path,
+        lookback_days: list[int] = [8, 15, 31],
+        threads: int = 8,
+        engine: EngineProfile | str | None = None
+) -> OnlineUserStore:
+    """Build the online user feature store from all events so far and save it to store_path (.npz)."""
+    store = OnlineUserStore(lookback_days)
+    store.update(receipts_labelled_parquet, txns_parquet, visits_parquet, threads=threads, engine=engine)
+    store.save(store_path)
+    return store
@@ -0,0 +1,100 @@
+# src/parallel_features.py
+from __future__ import annotations
+from src.engine import EngineProfile, connect, load_engine_profile
+from src.feature_dtypes import typed_select_sql
+from src.cpn_features import coupon_features
+from src.user_features import USER_FAMILIES, user_features
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from pathlib import Path
+
+## parallel feature families:
+    # coupon_features and the three user_features families (receipts, orders, visits) do not depend
+    # on each other, so each runs in its own worker with its own DuckDB connection and thread budget,
+    # writing a partial parquet keyed by receipt_key. the user partials are then merged on receipt_key
+    # into the same table a single user_features run writes; features_combining takes both as before.
+    # DuckDB and numpy release the GIL while they work, so plain threads are enough.
+
+FAMILIES = ["coupon"] + USER_FAMILIES
+
+
+def _family_engine(engine: EngineProfile | str | None, threads: int) -> EngineProfile:
+    """The caller's engine settings with the family's own thread budget."""
+    if engine is None:
+        return EngineProfile(threads=threads)
+    if isinstance(engine, str):
+        engine = load_engine_profile(engine)
+    return replace(engine, threads=threads)
+
+
+def merge_partials(
+        partials: list[Path],
+        out_parquet: Path,
+        threads: int = 8,
+        engine: EngineProfile | str | None = None
+) -> None:
+    """
+    Join partial feature tables on receipt_key, in the given order:
+    the columns shared by all partials (receipt_key and the receipt columns) once, then each partial's own.
+    """
+    con = connect(engine, threads)
+    for i, p in enumerate(partials):
+        con.execute(f"CREATE OR REPLACE TABLE p{i} AS SELECT * FROM read_parquet(?)", [str(p)])
+    cols = [[row[0] for row in con.execute(f"DESCRIBE p{i}").fetchall()] for i in range(len(partials))]
+    shared = [c for c in cols[0] if all(c in other for other in cols[1:])]
+
+    selects = ["p0.*"] + [f"p{i}.* EXCLUDE ({', '.join(shared)})" for i in range(1, len(partials))]
+    joins = "".join(f"\n            JOIN p{i} ON p0.receipt_key = p{i}.receipt_key" for i in range(1, len(partials)))
+    con.execute(f"""
+        CREATE OR REPLACE TABLE merged AS
+            SELECT {", ".join(selects)}
+            FROM p0{joins}
+            ORDER BY p0.receipt_key
+    """)
+    con.sql(typed_select_sql(con, "merged", order_by="receipt_key")).write_parquet(str(out_parquet))
+    con.close()
+
+
+def run_feature_families(
+        receipts_labelled_parquet: Path,
+        txns_parquet: Path,
+        visits_parquet: Path,
+        cpn_out_parquet: Path,
+        user_out_parquet: Path,
+        work_dir: Path,
+        lookback_days: list[int] = [8, 15, 31],
+        half_lives: list[int] = [],
+        family_threads: dict[str, int] | int = 2, # per family; an int gives every family the same budget
+        engine: EngineProfile | str | None = None,
+        coupon_kwargs: dict | None = None, # extra arguments of coupon_features (splits, calendar, store...)
+        profile_dir: Path | None = None
+) -> None:
+    """
+    Generate coupon features (cpn_out_parquet) and user features (user_out_parquet)
+    with every feature family in its own concurrent worker; partial parquets go to work_dir.
+    The outputs are the same as running coupon_features and user_features one after the other.
+    """
+    if isinstance(family_threads, int):
+        family_threads = {f: family_threads for f in FAMILIES}
+    unknown = set(family_threads) - set(FAMILIES)
+    if unknown:
+        raise ValueError(f"Unknown feature families {sorted(unknown)}; available: {FAMILIES}")
+    budget = {f: family_threads.get(f, 1) for f in FAMILIES}
+
+    work_dir = Path(work_dir)
+    work_dir.mkdir(parents=True, exist_ok=True)
+    user_partials = [work_dir / f"user_{f}.parquet" for f in USER_FAMILIES]
+
+    with ThreadPoolExecutor(max_workers=len(FAMILIES)) as pool:
+        futures = [pool.submit(coupon_features, receipts_labelled_parquet, cpn_out_parquet,
+                               lookback_days=lookback_days, half_lives=half_lives,
+                               engine=_family_engine(engine, budget["coupon"]),
+                               profile_dir=profile_dir, **(coupon_kwargs or {}))]
+        futures += [pool.submit(user_features, receipts_labelled_parquet, txns_parquet, visits_parquet, out,
+                                lookback_days=lookback_days, half_lives=half_lives, families=[f],
+                                engine=_family_engine(engine, budget[f]), profile_dir=profile_dir)
+                    for f, out in zip(USER_FAMILIES, user_partials)]
+        for fut in futures:
+            fut.result()  # re-raise a failed family
+
+    merge_partials(user_partials, user_out_parquet, threads=sum(budget.values()), engine=engine)
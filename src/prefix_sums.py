@@ -0,0 +1,128 @@
+# src/prefix_sums.py
+from __future__ import annotations
+import numpy as np
+import pandas as pd
+
+## prefix-sum window engine:
+    # a family of per-user dated records (e.g. daily receipt / order / visit counts) is sorted by (user, time)
+    # once and turned into running sums. "the sum of a user's records up to time t" is then one binary search,
+    # so every lookback window of every query is the difference of two vectorized lookups,
+    # the same as a pair of ASOF joins on the running sums.
+    # times are int64 epoch microseconds; the composite (user, time) key uses the rank of the time
+    # among the records' distinct times, which keeps it small.
+    # a missing time is MISSING_TIME: it sorts after every date and is never shifted by a window,
+    # the way a NULL timestamp behaves on both sides of DuckDB's ASOF joins.
+    # exponentially decayed sums (DecayedSums) reuse the same sorted records and lookups:
+    # a record at time s weighs 2^(-(t - s) / half-life) at time t.
+
+US_PER_DAY = 86_400_000_000
+MISSING_TIME = np.iinfo(np.int64).max
+
+
+class PrefixSums:
+    """Running sums of per-user dated records, looked up as of any time by binary search."""
+
+    def __init__(self, users: np.ndarray, times: np.ndarray, values: dict[str, np.ndarray]):
+        self._users = np.unique(users)
+        self._times = np.unique(times)
+        self._stride = len(self._times) + 1
+
+        keys = np.searchsorted(self._users, users) * self._stride + np.searchsorted(self._times, times) + 1
+        order = np.argsort(keys, kind="stable")
+        self._order = order
+        self._keys = keys[order]
+        self._cum = {name: np.concatenate([[0], np.cumsum(np.asarray(v, dtype=np.int64)[order])])
+                     for name, v in values.items()}
+
+    def _locate(self, users: np.ndarray, times: np.ndarray,
+                valid: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """Sorted positions of every query: the user's first record and one past its last record up to t."""
+        known = np.zeros(len(users), dtype=bool)
+        uidx = np.zeros(len(users), dtype=np.int64)
+        if len(self._users):
+            uidx = np.searchsorted(self._users, users).clip(max=len(self._users) - 1)
+            known = self._users[uidx] == users
+        if valid is not None:
+            known &= valid
+
+        base = uidx * self._stride
+        first = np.searchsorted(self._keys, base, side="left")
+        upto = np.searchsorted(self._keys, base + np.searchsorted(self._times, times, side="right"), side="right")
+        return first, np.where(known, upto, first)
+
+    def asof(self, users: np.ndarray, times: np.ndarray,
+             valid: np.ndarray | None = None) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+        """
+        For every query (user, t): whether the user has a record at or before t,
+        and the running sums of the user's records up to t (0 without such a record).
+        Queries flagged invalid (e.g. a missing user or time) never have a record.
+        """
+        first, upto = self._locate(users, times, valid)
+        return upto > first, {name: cum[upto] - cum[first] for name, cum in self._cum.items()}
+
+    def window(self, users: np.ndarray, times: np.ndarray, window_len: int,
+               valid: np.ndarray | None = None) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+        """
+        Sums over the records in (t - window_len days, t - 1 day] of every query, and a no-history flag:
+        True when the user has no record up to t - 1 day or none up to t - window_len days.
+        """
+        missing = times == MISSING_TIME
+        has_right, right = self.asof(users, np.where(missing, times, times - US_PER_DAY), valid)
+        has_left, left = self.asof(users, np.where(missing, times, times - window_len * US_PER_DAY), valid)
+        return ~has_right | ~has_left, {name: right[name] - left[name] for name in right}
+
+
+def check_half_lives(half_lives: list[int]) -> list[int]:
+    """Half-lives of decayed features, in whole days."""
+    if any(not isinstance(h, int) or isinstance(h, bool) or h <= 0 for h in half_lives):
+        raise ValueError(f"half_lives must be positive whole numbers of days, got {half_lives}")
+    if len(set(half_lives)) != len(half_lives):
+        raise ValueError(f"half_lives has duplicates: {half_lives}")
+    return list(half_lives)
+
+
+class DecayedSums(PrefixSums):
+    """
+    Exponentially decayed sums of per-user dated records, for a set of half-lives (in days).
+    Along a user's records the decayed sum follows the recurrence S_k = S_(k-1) * 2^(-(s_k - s_(k-1)) / h) + v_k.
+    Its closed form S_k = 2^(-(s_k - o) / h) * sum_(j<=k) v_j * 2^((s_j - o) / h), o the user's first time,
+    is one per-user running sum in a single sweep over the sorted records, for any number of half-lives.
+    """
+
+    _MAX_EXPONENT = 1000  # 2^1000 is still a float64; longer histories need a longer half-life
+
+    def __init__(self, users: np.ndarray, times: np.ndarray, values: dict[str, np.ndarray], half_lives: list[int]):
+        super().__init__(users, times, values)
+        t = np.asarray(times)[self._order]
+        user_rank = self._keys // self._stride
+        dated = t != MISSING_TIME
+        # days since the user's first record (missing times sort last, so the first is dated if any is)
+        self._origin = t[np.searchsorted(self._keys, user_rank * self._stride)]
+        age = np.where(dated, t - self._origin, 0) / US_PER_DAY
+
+        self._names = list(values)
+        self._scaled = {}
+        for h in check_half_lives(half_lives):
+            if (age / h).max(initial=0) > self._MAX_EXPONENT:
+                raise ValueError(f"a history of {age.max():.0f} days is too long for a half-life of {h} days")
+            weight = np.where(dated, np.exp2(age / h), 0.)
+            for name, v in values.items():
+                # per user, so no user's (possibly huge) scaled sums leak into the next one's
+                self._scaled[name, h] = pd.Series(np.asarray(v, dtype=np.float64)[self._order] * weight) \
+                    .groupby(user_rank, sort=False).cumsum().to_numpy()
+
+    def before(self, users: np.ndarray, times: np.ndarray, half_life: int,
+               valid: np.ndarray | None = None) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+        """
+        Decayed sums at t of the records up to t - 1 day of every query, and a no-history flag:
+        True when the user has no record up to t - 1 day. A missing query time has no decayed sums (0).
+        """
+        missing = times == MISSING_TIME
+        first, upto = self._locate(users, np.where(missing, times, times - US_PER_DAY), valid)
+        has = upto > first
+        if not has.any():
+            return ~has, {name: np.zeros(len(users)) for name in self._names}
+        last = np.where(has, upto - 1, 0)
+        dated = has & ~missing
+        decay = np.exp2(-(np.where(dated, times - self._origin[last], 0) / US_PER_DAY) / half_life)
+        return ~has, {name: np.where(dated, self._scaled[name, half_life][last] * decay, 0.) for name in self._names}
@@ -0,0 +1,142 @@
+# src/profiling.py
+from __future__ import annotations
+import json
+import os
+import time
+from datetime import datetime
+from pathlib import Path
+
+## opt-in per-section query profiling:
+    # wrap a stage's connection in ProfiledConnection and mark its "SECTION" blocks with con.section(...).
+    # with a profile_dir, every con.execute and every relation of con.sql (when it is run, e.g. by
+    # .write_parquet) is timed and DuckDB's JSON profile (operator timings, cardinalities) is kept;
+    # on close() a per-run report <run_name>_<timestamp>_<pid>.json is written.
+    # without a profile_dir the wrapper only forwards calls.
+
+
+def _rows_produced(profile: dict) -> int | None:
+    """Rows a query produced: rows inserted for CREATE TABLE AS / written by COPY, rows returned otherwise."""
+    for child in profile.get("children", []):
+        if child.get("operator_type") in ("CREATE_TABLE_AS", "COPY_TO_FILE") and child.get("children"):
+            return child["children"][0].get("operator_cardinality")
+    return profile.get("rows_returned")
+
+
+class ProfiledConnection:
+    """A DuckDB connection that records wall time, rows produced and the JSON profile per named section."""
+
+    def __init__(self, con, profile_dir: Path | None = None, run_name: str = "run"):
+        self._con = con
+        self._run_name = run_name
+        self._dir = Path(profile_dir) if profile_dir is not None else None
+        self._sections = []
+        self._current = None
+        self._started = time.perf_counter()
+        self._started_at = datetime.now()
+
+        if self._dir is not None:
+            self._dir.mkdir(parents=True, exist_ok=True)
+            self._query_json = self._dir / f".{run_name}_{os.getpid()}_last_query.json"
+            con.execute("PRAGMA enable_profiling = 'json'")
+            con.execute(f"PRAGMA profiling_output = '{self._query_json.as_posix()}'")
+
+    def __getattr__(self, name):
+        return getattr(self._con, name)
+
+    @property
+    def enabled(self) -> bool:
+        return self._dir is not None
+
+    def section(self, name: str) -> None:
+        """Close the running section (if any) and start timing the next one."""
+        if not self.enabled:
+            return
+        self._close_section()
+        self._current = {"section": name, "queries": [], "_t0": time.perf_counter()}
+
+    def execute(self, query: str, parameters=None):
+        run = (lambda: self._con.execute(query)) if parameters is None \
+            else (lambda: self._con.execute(query, parameters))
+        return self._timed(query, run) if self.enabled else run()
+
+    def sql(self, query: str):
+        rel = self._con.sql(query)
+        return _ProfiledRelation(self, query, rel) if self.enabled and rel is not None else rel
+
+    def _timed(self, query: str, run):
+        """Run `run()` as one query of the current section, recording its wall time and profile."""
+        if self._current is None:
+            self.section("(unnamed)")
+        # statements DuckDB does not profile write no output, so drop the previous query's first
+        self._query_json.unlink(missing_ok=True)
+        t0 = time.perf_counter()
+        res = run()
+        wall = time.perf_counter() - t0
+
+        profile = None
+        if self._query_json.exists():
+            with open(self._query_json, 'r') as f:
+                profile = json.load(f)
+        self._current["queries"].append({
+            "query": " ".join(query.split())[:200],
+            "wall_time_s": round(wall, 6),
+            "rows_produced": _rows_produced(profile) if profile else None,
+            "profile": profile,
+        })
+        return res
+
+    def _close_section(self) -> None:
+        if self._current is None:
+            return
+        sec = self._current
+        sec["wall_time_s"] = round(time.perf_counter() - sec.pop("_t0"), 6)
+        sec["rows_produced"] = sum(q["rows_produced"] or 0 for q in sec["queries"])
+        self._sections.append(sec)
+        self._current = None
+
+    def report(self) -> list[dict]:
+        """Per-section summary (without the raw profiles), slowest first."""
+        rows = [{"section": s["section"], "wall_time_s": s["wall_time_s"],
+                 "rows_produced": s["rows_produced"], "n_queries": len(s["queries"])}
+                for s in self._sections]
+        return sorted(rows, key=lambda r: r["wall_time_s"], reverse=True)
+
+    def close(self) -> Path | None:
+        """Close the connection; with profiling on, write and return the run report's path."""
+        if not self.enabled:
+            self._con.close()
+            return None
+
+        self._close_section()
+        self._con.execute("PRAGMA disable_profiling")
+        self._con.close()
+        self._query_json.unlink(missing_ok=True)
+
+        out = self._dir / f"{self._run_name}_{self._started_at:%Y%m%d_%H%M%S_%f}_{os.getpid()}.json"
+        with open(out, 'w') as f:
+            json.dump({
+                "run_name": self._run_name,
+                "started_at": self._started_at.isoformat(timespec="seconds"),
+                "wall_time_s": round(time.perf_counter() - self._started, 6),
+                "summary": self.report(),
+                "sections": self._sections,
+            }, f, indent=2, default=str)
+        return out
+
+
+class _ProfiledRelation:
+    """A relation of ProfiledConnection.sql: running it (write_parquet, df, fetchall...) is timed as a query."""
+
+    _RUNS = {"write_parquet", "to_parquet", "write_csv", "to_csv", "df", "fetchdf", "to_df",
+             "fetchall", "fetchone", "fetchmany", "arrow", "fetch_arrow_table", "pl", "execute"}
+
+    def __init__(self, pcon: ProfiledConnection, query: str, rel):
+        self._pcon = pcon
+        self._query = query
+        self._rel = rel
+
+    def __getattr__(self, name):
+        attr = getattr(self._rel, name)
+        if name not in self._RUNS:
+            return attr
+        return lambda *args, **kwargs: self._pcon._timed(self._query, lambda: attr(*args, **kwargs))
@@ -0,0 +1,228 @@
+# src/segment_store.py
+from __future__ import annotations
+from src.engine import EngineProfile, connect
+from src.binning import check_splits, create_segment_bins
+from pathlib import Path
+from datetime import date
+import json
+import os
+
+### notes on the segment statistics store:
+    # a directory holding coupon_features' per-(segment, day) cumulative counts of invalid,
+    # fh / st redeemed and all receipts, so the historical segment rates can be looked up
+    # without re-reading every labelled receipt:
+    # - days/part_<first>_<last>.parquet: cumulative rows of the days added by one call, never rewritten.
+    # - last_<last day>.parquet:          the latest cumulative row per segment, the base of the next append.
+    # - segment_store.json:               the bin splits the store was built with, its last day, its part files
+    #                                     and its last_*.parquet (None for a store without dated receipts).
+    # the sidecar is the commit point: a call writes its new files first, then replaces the sidecar atomically,
+    # and readers only use the files it lists, so a call interrupted before that leaves the store as it was
+    # (its unlisted files are overwritten or ignored by the next call).
+    # receipts without a Receive_date are left out: they never match a lookup.
+
+SEGMENT_COLS = "Price_limit_bin, Coupon_limit_bin, Expiry_span_bin"
+_META = "segment_store.json"
+
+
+def segment_cum_sql(source: str, base: str | None = None) -> str:
+    """
+    SELECT of the per-(segment, Receive_date) cumulative counts of the binned, labelled receipts in `source`.
+    With `base` (a table holding one cumulative row per segment), its counts are added on top.
+    """
+    cum_cols = ["cum_invalid", "cum_fh_redeem", "cum_st_redeem", "cumall"]
+    offsets = {c: f" + COALESCE(b.{c}, 0)" if base else "" for c in cum_cols}
+    return f"""
+            -- pre-aggregate to daily
+            WITH daily AS (
+                SELECT
+                    Receive_date,
+                    {SEGMENT_COLS},
+                    SUM(label_invalid)      AS daily_invalid,
+                    SUM(label_same_user_fh) AS daily_fh_redeem,
+                    SUM(label_same_user_st) AS daily_st_redeem,
+                    COUNT(*)                AS daily_vol
+                FROM {source}
+                GROUP BY 1,2,3,4
+            ),
+            running AS (
+                SELECT
+                    Receive_date,
+                    {SEGMENT_COLS},
+                    SUM(daily_invalid)      OVER same_seg AS cum_invalid,
+                    SUM(daily_fh_redeem)    OVER same_seg AS cum_fh_redeem,
+                    SUM(daily_st_redeem)    OVER same_seg AS cum_st_redeem,
+                    SUM(daily_vol)          OVER same_seg AS cumall
+                FROM daily
+                WINDOW same_seg AS (
+                    PARTITION BY {SEGMENT_COLS}
+                    ORDER BY Receive_date            ---DuckDB puts the lines with NaT value to the end
+                    ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
+                )
+            )
+            SELECT
+                r.Receive_date,
+                r.Price_limit_bin, r.Coupon_limit_bin, r.Expiry_span_bin,
+                {", ".join(f"CAST(r.{c}{offsets[c]} AS BIGINT) AS {c}" for c in cum_cols)}
+            FROM running r
+            {f"LEFT JOIN {base} b USING ({SEGMENT_COLS})" if base else ""}
+    """
+
+
+def _splits_meta(Price_limit_bin_splits, Coupon_limit_bin_splits, Expiry_span_bin_split) -> dict:
+    return {"Price_limit_bin_splits": check_splits("Price_limit_bin_splits", Price_limit_bin_splits),
+            "Coupon_limit_bin_splits": check_splits("Coupon_limit_bin_splits", Coupon_limit_bin_splits),
+            "Expiry_span_bin_split": check_splits("Expiry_span_bin_split", Expiry_span_bin_split)}
+
+
+def _read_meta(store_dir: Path) -> dict:
+    with open(store_dir / _META, 'r') as f:
+        return json.load(f)
+
+
+def _write_meta(store_dir: Path, meta: dict) -> None:
+    """Replace the sidecar atomically: the store moves to `meta` all at once, or not at all."""
+    tmp = store_dir / f"{_META}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp, store_dir / _META)
+
+
+def _load_binned_receipts(con, receipts_labelled_parquet: Path, meta: dict) -> None:
+    """Create table `seg_receipts`: the dated labelled receipts with their segment bins."""
+    con.execute("""
+        CREATE OR REPLACE TABLE seg_raw AS
+            SELECT
+                Price_limit_cent,
+                Coupon_amt_cent,
+                Receive_date, Start_date, End_date,
+                CASE WHEN label_valid = 1 THEN 0 ELSE 1 END AS label_invalid,
+                label_same_user_fh,
+                label_same_user_st
+            FROM read_parquet(?)
+            WHERE Receive_date IS NOT NULL""", [str(receipts_labelled_parquet)])
+    create_segment_bins(con, "seg_raw", "seg_receipts", meta["Price_limit_bin_splits"],
+                        meta["Coupon_limit_bin_splits"], meta["Expiry_span_bin_split"])
+
+
+def _write_days(con, store_dir: Path, meta: dict) -> None:
+    """
+    Write table `new_cum` as a new part file and the rolled-forward per-segment base, then commit both
+    to the sidecar. Without dated rows in `new_cum` only the sidecar is written, with its last day kept
+    (None for a new store).
+    """
+    first, last = con.execute(
+        "SELECT CAST(MIN(Receive_date) AS DATE), CAST(MAX(Receive_date) AS DATE) FROM new_cum").fetchone()
+
+    old_last = meta["last_parquet"]
+    if last is not None:
+        days_dir = store_dir / "days"
+        days_dir.mkdir(parents=True, exist_ok=True)
+        part = f"part_{first:%Y%m%d}_{last:%Y%m%d}.parquet"
+        con.sql("SELECT * FROM new_cum ORDER BY Receive_date").write_parquet(str(days_dir / part))
+
+        con.execute(f"""
+            CREATE OR REPLACE TABLE new_last AS
+                SELECT * FROM (SELECT * FROM last_cum UNION ALL BY NAME SELECT * FROM new_cum)
+                QUALIFY ROW_NUMBER() OVER (PARTITION BY {SEGMENT_COLS} ORDER BY Receive_date DESC) = 1
+        """)
+        new_last = f"last_{last:%Y%m%d}.parquet"
+        con.sql("SELECT * FROM new_last").write_parquet(str(store_dir / new_last))
+
+        meta["parts"] = meta["parts"] + [part]
+        meta["last_day"] = last.isoformat()
+        meta["last_parquet"] = new_last
+
+    _write_meta(store_dir, meta)
+    if old_last is not None and old_last != meta["last_parquet"]:
+        (store_dir / old_last).unlink(missing_ok=True)
+
+
+def init_segment_store(
+        receipts_labelled_parquet: Path,
+        store_dir: Path,
+        Price_limit_bin_splits: list[int] = [1000, 10000], # in units of cents
+        Coupon_limit_bin_splits: list[int] = [1000, 10000], # in units of cents
+        Expiry_span_bin_split: int | list[int] = 10, # in units of days
+        threads: int = 8,
+        engine: EngineProfile | str | None = None
+) -> None:
+    """
+    (Re)build the segment statistics store from all labelled receipts so far,
+    binned the way coupon_features bins them with the same splits.
+    """
+    store_dir = Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+    for stale in [*(store_dir / "days").glob("*.parquet"), *store_dir.glob("last*.parquet")]:
+        stale.unlink()
+    meta = _splits_meta(Price_limit_bin_splits, Coupon_limit_bin_splits, Expiry_span_bin_split)
+    meta.update(last_day=None, parts=[], last_parquet=None)
+
+    con = connect(engine, threads)
+    _load_binned_receipts(con, receipts_labelled_parquet, meta)
+    con.execute(f"CREATE OR REPLACE TABLE new_cum AS {segment_cum_sql('seg_receipts')}")
+    con.execute("CREATE OR REPLACE TABLE last_cum AS SELECT * FROM new_cum LIMIT 0")
+    _write_days(con, store_dir, meta)
+    con.close()
+
+
+def append_segment_store(
+        store_dir: Path,
+        new_receipts_labelled_parquet: Path,
+        threads: int = 8,
+        engine: EngineProfile | str | None = None
+) -> None:
+    """
+    Append the labelled receipts of new days (all received after the store's last day)
+    to the segment statistics store. Only the new receipts and one row per segment are read.
+    """
+    store_dir = Path(store_dir)
+    meta = _read_meta(store_dir)
+
+    con = connect(engine, threads)
+    _load_binned_receipts(con, new_receipts_labelled_parquet, meta)
+    if meta["last_day"] is not None:
+        n_stale = con.execute("SELECT COUNT(*) FROM seg_receipts WHERE CAST(Receive_date AS DATE) <= ?",
+                              [date.fromisoformat(meta["last_day"])]).fetchone()[0]
+        if n_stale:
+            con.close()
+            raise ValueError(f"{n_stale} receipts were received on or before the store's last day "
+                             f"{meta['last_day']}; only later days can be appended")
+
+    if meta["last_parquet"] is not None:
+        con.execute("CREATE OR REPLACE TABLE last_cum AS SELECT * FROM read_parquet(?)",
+                    [str(store_dir / meta["last_parquet"])])
+    else:
+        con.execute(f"CREATE OR REPLACE TABLE last_cum AS {segment_cum_sql('seg_receipts')} LIMIT 0")
+    con.execute(f"CREATE OR REPLACE TABLE new_cum AS {segment_cum_sql('seg_receipts', base='last_cum')}")
+    _write_days(con, store_dir, meta)
+    con.close()
+
+
+def load_segment_store(
+        con,
+        store_dir: Path,
+        table: str,
+        Price_limit_bin_splits: int | list[int],
+        Coupon_limit_bin_splits: int | list[int],
+        Expiry_span_bin_split: int | list[int]
+) -> None:
+    """
+    Create `table` in the open connection with the store's per-(segment, day) cumulative counts.
+    Raise if the store was built with other splits than the caller's.
+    """
+    store_dir = Path(store_dir)
+    meta = _read_meta(store_dir)
+    wanted = _splits_meta(Price_limit_bin_splits, Coupon_limit_bin_splits, Expiry_span_bin_split)
+    for k, v in wanted.items():
+        if meta[k] != v:
+            raise ValueError(f"[{k}] the segment store at {store_dir} was built with {meta[k]}, not {v}")
+
+    parts = [str(store_dir / "days" / p) for p in meta["parts"]]
+    if parts:
+        con.execute(f"CREATE OR REPLACE TABLE {table} AS SELECT * FROM read_parquet(?)", [parts])
+    else:
+        con.execute(f"""
+            CREATE OR REPLACE TABLE {table} (
+                Receive_date TIMESTAMP,
+                Price_limit_bin INTEGER, Coupon_limit_bin INTEGER, Expiry_span_bin INTEGER,
+                cum_invalid BIGINT, cum_fh_redeem BIGINT, cum_st_redeem BIGINT, cumall BIGINT)""")
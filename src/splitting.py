@@ -1,14 +1,177 @@
 # src/splitting.py
 from __future__ import annotations
-import duckdb
+from src.engine import EngineProfile, connect
 from pathlib import Path
+import numpy as np
 import pandas as pd
-from datetime import date
+import re
+from datetime import date, timedelta
 
 # perform various splitting strategies for different models:
     # right-censored data awareness
     # return the cv-partitioned train/val sets and the testing set
     # splitting integrity: apply lookback guard/purge period if necessary
+    # optionally partition the train/test sets by segment bins (segment_dir): one directory per
+    # (Price_limit_bin, Coupon_limit_bin, Expiry_span_bin) holding train.parquet and test.parquet sorted by
+    # receipt_key, and the fold memberships as row-index sidecars (folds.npz: fold_{k}_train / fold_{k}_val,
+    # the rows of fold_{k}_marker = 1 / 2) instead of marker columns; loading a segment-fold pair reads only
+    # its own files (see src/train.py, load_segment_fold_data). the sidecars of all segments come from one
+    # windowed pass (row numbers per segment).
+    # forward-chaining folds: fold k validates on its window [val_start_k, val_end_k] (marker 2) and trains on
+    # what is over before val_start_k - purge_days (marker 1; policy: End_date, ROI: Receive_date), 0 otherwise.
+    # any list of windows works (forward_chain_windows() steps them evenly); all markers come from one scan.
+    # with fold_index=True the train set is written sorted by receipt_key without the marker columns, and the
+    # memberships go to a row-index sidecar next to it (fold_index_path(), same layout as folds.npz above).
+    # trainable, right_censored_trainable, test, train and folds are views over read_parquet. a set written
+    # once is a COPY of its filtered view: the predicates are pushed down into the parquet scan and rows
+    # stream straight to the file. a set read more than once (the train set with fold_index, both sets with
+    # segment_dir) is materialized in a temp table from one scan first and written from there: its rows are
+    # then held in memory (spilling to the temp directory if needed) in exchange for a single parquet read.
+
+SEGMENT_BINS = ["Price_limit_bin", "Coupon_limit_bin", "Expiry_span_bin"]
+FOLD_WINDOWS = [(date(2023, 3, 16), date(2023, 3, 31)),
+                (date(2023, 4, 16), date(2023, 4, 30)),
+                (date(2023, 5, 16), date(2023, 5, 31))]
+
+
+def forward_chain_windows(first_val_start: date, n_folds: int, step_days: int, val_days: int) -> list[tuple[date, date]]:
+    """n_folds validation windows of val_days days, the k-th starting (k - 1) * step_days after first_val_start."""
+    if n_folds < 1 or step_days < 1 or val_days < 1:
+        raise ValueError(f"n_folds, step_days and val_days should be >= 1, got {n_folds}, {step_days}, {val_days}")
+    return [(first_val_start + timedelta(days=k * step_days),
+             first_val_start + timedelta(days=k * step_days + val_days - 1)) for k in range(n_folds)]
+
+
+def _check_fold_windows(fold_windows: list[tuple[date, date]], purge_days: int) -> None:
+    if not fold_windows:
+        raise ValueError("At least one fold window is required")
+    if purge_days < 0:
+        raise ValueError(f"purge_days should be >= 0, got {purge_days}")
+    for val_start, val_end in fold_windows:
+        if val_end < val_start:
+            raise ValueError(f"Fold window ({val_start}, {val_end}) ends before it starts")
+
+
+def _fold_markers_sql(fold_windows: list[tuple[date, date]], guard_col: str, purge_days: int) -> str:
+    """One marker column per fold: 2 in its validation window, 1 when guard_col is before the purged start."""
+    return ",".join(f"""
+                    CASE
+                        WHEN Receive_date BETWEEN TIMESTAMP '{val_start}' AND TIMESTAMP '{val_end}' THEN 2
+                        WHEN {guard_col} < (TIMESTAMP '{val_start}' - INTERVAL {purge_days} DAY) THEN 1
+                        ELSE 0 END AS fold_{k}_marker""" for k, (val_start, val_end) in enumerate(fold_windows, 1))
+
+
+def _sql_path(p: Path) -> str:
+    return "'" + str(p).replace("'", "''") + "'"
+
+
+def _copy(con, select: str, out_parquet: Path) -> None:
+    con.execute(f"COPY ({select}) TO {_sql_path(out_parquet)} (FORMAT PARQUET)")
+
+
+def _fold_cols(con, table: str) -> list[str]:
+    return [row[0] for row in con.execute(f"DESCRIBE {table}").fetchall() if re.fullmatch(r"fold_\d+_marker", row[0])]
+
+
+def fold_index_path(train_set_parquet: Path) -> Path:
+    """The fold membership sidecar of a train set written with fold_index=True."""
+    return Path(train_set_parquet).with_suffix(".folds.npz")
+
+
+def load_fold_index(path: Path) -> dict[str, np.ndarray]:
+    """fold_{k}_train / fold_{k}_val row indices of a fold sidecar."""
+    with np.load(path) as idx:
+        return {name: idx[name] for name in idx.files}
+
+
+def _save_fold_index(con, table: str, fold_cols: list[str], paths: list[Path], segments: str | None = None) -> None:
+    """
+    Row indices (in receipt_key order) of each fold's train (marker 1) and val (marker 2) rows, from one
+    windowed pass over `table`: one sidecar at paths[0], or, with `segments` (a table of seg_id and the
+    segment bins), one per segment at paths[seg_id] indexing the rows within the segment.
+    """
+    seg = "s.seg_id" if segments else "0"
+    join = f"JOIN {segments} s ON " + " AND ".join(f"t.{b} IS NOT DISTINCT FROM s.{b}" for b in SEGMENT_BINS) \
+        if segments else ""
+    rows = con.execute(f"""
+        SELECT {seg} AS seg_id,
+            ROW_NUMBER() OVER (PARTITION BY {seg} ORDER BY t.receipt_key) - 1 AS row_idx,
+            {", ".join(f"t.{c}" for c in fold_cols)}
+        FROM {table} t
+        {join}
+        QUALIFY {" OR ".join(f"t.{c} IN (1, 2)" for c in fold_cols)}
+        ORDER BY seg_id, row_idx
+    """).fetchnumpy()
+    bounds = np.searchsorted(np.asarray(rows["seg_id"]), np.arange(len(paths) + 1))
+    for i, path in enumerate(paths):
+        row_idx = np.asarray(rows["row_idx"][bounds[i]:bounds[i + 1]])
+        np.savez(path, **{
+            f"{c.removesuffix('_marker')}_{part}":
+                row_idx[np.asarray(rows[c][bounds[i]:bounds[i + 1]]) == v].astype(np.int32)
+            for c in fold_cols for part, v in [("train", 1), ("val", 2)]})
+
+
+def _write_train(con, table: str, train_set_out_parquet: Path, fold_index: bool) -> None:
+    """The train set with its fold marker columns, or sorted by receipt_key with a fold sidecar instead."""
+    fold_cols = _fold_cols(con, table)
+    if not (fold_index and fold_cols):
+        _copy(con, f"SELECT * FROM {table}", train_set_out_parquet)
+        return
+    _copy(con, f"SELECT * EXCLUDE ({', '.join(fold_cols)}) FROM {table} ORDER BY receipt_key", train_set_out_parquet)
+    _save_fold_index(con, table, fold_cols, [fold_index_path(train_set_out_parquet)])
+
+
+def segment_path(segment_dir: Path, Price_limit_bin: int, Coupon_limit_bin: int, Expiry_span_bin: int) -> Path:
+    """The directory of one segment's train/test sets and fold sidecar."""
+    return Path(segment_dir) / f"Price_limit_bin={Price_limit_bin}" / f"Coupon_limit_bin={Coupon_limit_bin}" \
+        / f"Expiry_span_bin={Expiry_span_bin}"
+
+
+def _write_segments(con, train_table: str, test_table: str, segment_dir: Path) -> None:
+    """
+    Write each segment's rows of the train and test tables (materialized, see _write_sets),
+    and the train set's fold memberships.
+    """
+    fold_cols = _fold_cols(con, train_table)
+    exclude = f" EXCLUDE ({', '.join(fold_cols)})" if fold_cols else ""
+    bins = ", ".join(SEGMENT_BINS)
+    con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE segments AS
+            SELECT ROW_NUMBER() OVER (ORDER BY {bins}) - 1 AS seg_id, *
+            FROM (SELECT DISTINCT {bins} FROM {train_table} UNION SELECT DISTINCT {bins} FROM {test_table})
+    """)
+    segments = con.execute(f"SELECT {bins} FROM segments ORDER BY seg_id").fetchall()
+
+    seg_dirs = [segment_path(segment_dir, *seg) for seg in segments]
+    for seg, seg_dir in zip(segments, seg_dirs):
+        seg_dir.mkdir(parents=True, exist_ok=True)
+        where = " AND ".join(f"{b} IS NULL" if v is None else f"{b} = {int(v)}" for b, v in zip(SEGMENT_BINS, seg))
+        for split, table in [("train", train_table), ("test", test_table)]:
+            _copy(con, f"""
+                    SELECT *{exclude if table == train_table else ""} FROM {table}
+                    WHERE {where}
+                    ORDER BY receipt_key""", seg_dir / f"{split}.parquet")
+    if fold_cols:
+        _save_fold_index(con, train_table, fold_cols, [d / "folds.npz" for d in seg_dirs], segments="segments")
+
+def _write_sets(con, train_view: str, test_view: str, train_set_out_parquet: Path, test_set_out_parquet: Path,
+                fold_index: bool, segment_dir: Path | None) -> None:
+    """
+    Write the test and train sets, and their segment partitions with a segment_dir.
+    A set read more than once (by the fold sidecar or the segment partitions) is first materialized
+    from a single parquet scan; otherwise it streams from its view straight to its file.
+    """
+    if segment_dir is not None:
+        con.execute(f"CREATE OR REPLACE TEMP TABLE test_set AS SELECT * FROM {test_view}")
+        test_view = "test_set"
+    _copy(con, f"SELECT * FROM {test_view}", test_set_out_parquet)
+
+    if segment_dir is not None or (fold_index and _fold_cols(con, train_view)):
+        con.execute(f"CREATE OR REPLACE TEMP TABLE train_set AS SELECT * FROM {train_view}")
+        train_view = "train_set"
+    _write_train(con, train_view, train_set_out_parquet, fold_index)
+    if segment_dir is not None:
+        _write_segments(con, train_view, test_view, segment_dir)
 
 # Policy modeling
 def policy_model_split(
@@ -19,77 +182,67 @@ def policy_model_split(
         right_censoring: bool = True,
         censor_cutoff_at: date = date(2023, 6, 30),
         forward_chain_cv: bool = True,
-        threads: int = 8
+        fold_windows: list[tuple[date, date]] = FOLD_WINDOWS, # (val_start, val_end) of each fold, see the notes above
+        purge_days: int = 0, # trains on receipts with End_date before val_start - purge_days
+        fold_index: bool = False, # fold memberships as a row-index sidecar instead of marker columns
+        segment_dir: Path | None = None, # also write the sets partitioned by segment bins, see the notes above
+        threads: int = 8,
+        engine: EngineProfile | str | None = None
 ):
-    con = duckdb.connect()
-    con.execute(f"PRAGMA threads={threads}")
+    if forward_chain_cv:
+        _check_fold_windows(fold_windows, purge_days)
+    con = connect(engine, threads)
 
     # =====================
     # Section 1: Load
     # =====================
-    con.execute("""
-        CREATE OR REPLACE TABLE trainable AS
-            SELECT * FROM read_parquet(?)
-    """, [str(trainable_parquet)])
+    con.execute(f"""
+        CREATE OR REPLACE VIEW trainable AS
+            SELECT * FROM read_parquet({_sql_path(trainable_parquet)})
+    """)
 
     # ======================================================
     # Section 2: Applying right censoring if required
     # ======================================================
-    if right_censoring:
-        con.execute("""
-            CREATE OR REPLACE TABLE right_censored_trainable AS
-                SELECT * FROM trainable
-                WHERE
-                    End_date <= ?
-        """, [censor_cutoff_at])
+    con.execute(f"""
+        CREATE OR REPLACE VIEW right_censored_trainable AS
+            SELECT * FROM trainable
+            {f"WHERE End_date <= DATE '{censor_cutoff_at}'" if right_censoring else ""}
+    """)
 
     # =======================================================
     # Section 3: Splitting the train set and the test set
     # =======================================================
-    con.execute("""
-        CREATE OR REPLACE TABLE test AS
+    con.execute(f"""
+        CREATE OR REPLACE VIEW test AS
             SELECT * FROM right_censored_trainable
             WHERE
-                Receive_date >= ?
-    """, [test_start_at])
+                Receive_date >= DATE '{test_start_at}'
+    """)
     # data integrity: apply lookback guard on the train set:
-    con.execute("""
-        CREATE OR REPLACE TABLE train AS
+    con.execute(f"""
+        CREATE OR REPLACE VIEW train AS
             SELECT * FROM right_censored_trainable
             WHERE
-                End_date < ?
-    """, [test_start_at])
-
-    con.sql("SELECT * FROM test").write_parquet(str(test_set_out_parquet))
+                End_date < DATE '{test_start_at}'
+    """)
 
     # ============================================================
-    # Section 4: Partition 3 cv folds on the train set if required
+    # Section 4: Partition forward-chaining cv folds on the train set if required
     # ============================================================
     if forward_chain_cv:
-        con.execute("""
-            CREATE OR REPLACE TABLE folds AS
-                SELECT *, 
-                    CASE 
-                        WHEN Receive_date BETWEEN '2023-03-16' AND '2023-03-31' THEN 2
-                        WHEN End_date < '2023-03-16' THEN 1
-                        ELSE 0 END AS fold_1_marker,
-                    CASE
-                        WHEN Receive_date BETWEEN '2023-04-16' AND '2023-04-30' THEN 2
-                        WHEN End_date < '2023-04-16' THEN 1
-                        ELSE 0 END AS fold_2_marker,
-                    CASE
-                        WHEN Receive_date BETWEEN '2023-05-16' AND '2023-05-31' THEN 2
-                        WHEN End_date < '2023-05-16' THEN 1
-                        ELSE 0 END AS fold_3_marker
+        con.execute(f"""
+            CREATE OR REPLACE VIEW folds AS
+                SELECT *,{_fold_markers_sql(fold_windows, "End_date", purge_days)}
                 FROM train
         """)
-        con.sql("SELECT * FROM folds").write_parquet(str(train_set_out_parquet))
-    else:
-        con.sql("SELECT * FROM train").write_parquet(str(train_set_out_parquet))
+    _write_sets(con, "folds" if forward_chain_cv else "train", "test",
+                train_set_out_parquet, test_set_out_parquet, fold_index, segment_dir)
+    con.close()
     
     
 # ROI modeling
-## only support the 15-day short term case as-of now
+## short_days should match the horizon N of the label_same_user_st_{N}d the model is trained on.
 def ROI_model_split(
         trainable_parquet: Path,
         train_set_out_parquet: Path,
@@ -98,71 +251,63 @@ def ROI_model_split(
         right_censoring: bool = True,
         censor_cutoff_at: date = date(2023, 6, 30),
         forward_chain_cv: bool = True,
-        threads: int = 8
+        short_days: int = 15,
+        fold_windows: list[tuple[date, date]] = FOLD_WINDOWS, # (val_start, val_end) of each fold, see the notes above
+        purge_days: int | None = None, # trains on receipts received before val_start - purge_days; None: short_days
+        fold_index: bool = False, # fold memberships as a row-index sidecar instead of marker columns
+        segment_dir: Path | None = None, # also write the sets partitioned by segment bins, see the notes above
+        threads: int = 8,
+        engine: EngineProfile | str | None = None
 ):
-    con = duckdb.connect()
-    con.execute(f"PRAGMA threads={threads}")
+    purge_days = short_days if purge_days is None else purge_days
+    if forward_chain_cv:
+        _check_fold_windows(fold_windows, purge_days)
+    con = connect(engine, threads)
 
     # =====================
     # Section 1: Load
     # =====================
-    con.execute("""
-        CREATE OR REPLACE TABLE trainable AS
-            SELECT * FROM read_parquet(?)
-    """, [str(trainable_parquet)])
+    con.execute(f"""
+        CREATE OR REPLACE VIEW trainable AS
+            SELECT * FROM read_parquet({_sql_path(trainable_parquet)})
+    """)
 
     # ======================================================
     # Section 2: Applying right censoring if required
     # ======================================================
-    if right_censoring:
-        con.execute("""
-            CREATE OR REPLACE TABLE right_censored_trainable AS
-                SELECT * FROM trainable
-                WHERE
-                    End_date <= ?
-        """, [censor_cutoff_at])
+    con.execute(f"""
+        CREATE OR REPLACE VIEW right_censored_trainable AS
+            SELECT * FROM trainable
+            {f"WHERE End_date <= DATE '{censor_cutoff_at}'" if right_censoring else ""}
+    """)
 
     # =======================================================
     # Section 3: Splitting the train set and the test set
     # =======================================================
-    con.execute("""
-        CREATE OR REPLACE TABLE test AS
+    con.execute(f"""
+        CREATE OR REPLACE VIEW test AS
             SELECT * FROM right_censored_trainable
             WHERE
-                Receive_date >= ?
-    """, [test_start_at])
-    # data integrity: apply a 15-day purge on the train set:
-    con.execute("""
-        CREATE OR REPLACE TABLE train AS
+                Receive_date >= DATE '{test_start_at}'
+    """)
+    # data integrity: apply a short_days purge on the train set:
+    con.execute(f"""
+        CREATE OR REPLACE VIEW train AS
             SELECT * FROM right_censored_trainable
             WHERE
-                Receive_date < ? - INTERVAL 15 DAY
-    """, [test_start_at])
-
-    con.sql("SELECT * FROM test").write_parquet(str(test_set_out_parquet))
+                Receive_date < DATE '{test_start_at}' - INTERVAL {short_days} DAY
+    """)
 
     # ============================================================
-    # Section 4: Partition 3 cv folds on the train set if required
+    # Section 4: Partition forward-chaining cv folds on the train set if required
     # ============================================================
     if forward_chain_cv:
-        con.execute("""
-            CREATE OR REPLACE TABLE folds AS
-                SELECT *, 
-                    CASE 
-                        WHEN Receive_date BETWEEN '2023-03-16' AND '2023-03-31' THEN 2
-                        WHEN Receive_date < (TIMESTAMP '2023-03-16' - INTERVAL 15 DAY) THEN 1
-                        ELSE 0 END AS fold_1_marker,
-                    CASE
-                        WHEN Receive_date BETWEEN '2023-04-16' AND '2023-04-30' THEN 2
-                        WHEN Receive_date < (TIMESTAMP '2023-04-16' - INTERVAL 15 DAY) THEN 1
-                        ELSE 0 END AS fold_2_marker,
-                    CASE
-                        WHEN Receive_date BETWEEN '2023-05-16' AND '2023-05-31' THEN 2
-                        WHEN Receive_date < (TIMESTAMP '2023-05-16' - INTERVAL 15 DAY) THEN 1
-                        ELSE 0 END AS fold_3_marker
+        con.execute(f"""
+            CREATE OR REPLACE VIEW folds AS
+                SELECT *,{_fold_markers_sql(fold_windows, "Receive_date", purge_days)}
                 FROM train
         """)
-        con.sql("SELECT * FROM folds").write_parquet(str(train_set_out_parquet))
-    else:
-        con.sql("SELECT * FROM train").write_parquet(str(train_set_out_parquet))
+    _write_sets(con, "folds" if forward_chain_cv else "train", "test",
+                train_set_out_parquet, test_set_out_parquet, fold_index, segment_dir)
+    con.close()
     
\ No newline at end of file
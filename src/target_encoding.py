@@ -0,0 +1,142 @@
+# src/target_encoding.py
+from __future__ import annotations
+from src.engine import EngineProfile, connect
+from src.feature_dtypes import typed_select_sql
+from src.profiling import ProfiledConnection
+from src.prefix_sums import MISSING_TIME, PrefixSums
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import re
+
+## target encoding:
+    # the HISTORICAL rate of a label among the receipts sharing a key (a coupon, a user x segment, ...),
+    # over each lookback window [Receive_date - window_len, Receive_date - 1]: only receipts received before
+    # the receipt's day count, so neither its own label nor same-day labels leak in.
+    # rates are smoothed towards the all-receipts rate of the same window (the prior):
+    #   (key's label sum + m * prior) / (key's receipts + m), m = smoothing
+    # every encoding is one GROUP BY (key, day) in SQL and window lookups on sorted per-key prefix sums
+    # (see src/prefix_sums.py), so millions of keys cost one sort.
+    # keys may be any columns of the receipts table, e.g. Coupon_id_code on the labelled receipts, or
+    # User_id_code x the segment bins on the coupon features table; a receipt with a NULL key has no history.
+    # output per encoding `name` and window: no_hist_te_{name}_marker_{d}d and Rate_te_{name}_{label}_{d}d
+    # (label without its "label_" prefix), keyed by receipt_key; features_combining joins it on receipt_key.
+
+
+def _check_encodings(encodings: dict[str, list[str]], columns: list[str]) -> None:
+    if not encodings:
+        raise ValueError("At least one encoding (name -> key columns) is required")
+    for name, keys in encodings.items():
+        if not re.fullmatch(r"[A-Za-z0-9]+(_[A-Za-z0-9]+)*", name):
+            raise ValueError(f"Encoding name {name!r} should be letters and digits joined by underscores")
+        if not keys:
+            raise ValueError(f"[{name}] no key columns")
+        missing = [k for k in keys if k not in columns]
+        if missing:
+            raise ValueError(f"[{name}] key columns {missing} are not in the receipts table")
+
+
+def target_encoding(
+        receipts_parquet: Path,     # labelled receipts or a feature table: receipt_key, Receive_date, keys & labels
+        out_parquet: Path,
+        encodings: dict[str, list[str]], # encoding name -> key columns, e.g. {"coupon": ["Coupon_id_code"]}
+        labels: list[str] = ["label_invalid", "label_same_user_fh", "label_same_user_st"],
+        lookback_days: list[int] = [8, 15, 31],
+        smoothing: float = 10.0,    # weight of the prior, in receipts
+        threads: int = 8,
+        engine: EngineProfile | str | None = None,
+        profile_dir: Path | None = None
+) -> None:
+    """
+    Generate smoothed, as-of-yesterday target encodings of the label columns for every encoding's key
+    and save them to out_parquet, one row per receipt_key.
+    label_invalid is derived from label_valid when the table does not have it.
+    With a profile_dir, a per-section profiling report is written there as well (see src/profiling.py)."""
+    if smoothing < 0:
+        raise ValueError(f"smoothing should be >= 0, got {smoothing}")
+    columns = pq.read_schema(receipts_parquet).names
+    derived = "CASE WHEN label_valid = 1 THEN 0 ELSE 1 END AS label_invalid" \
+        if "label_invalid" in labels and "label_invalid" not in columns and "label_valid" in columns else None
+    missing = [l for l in labels if l not in columns and not (derived and l == "label_invalid")]
+    if not labels or missing:
+        raise ValueError(f"Label columns {missing or labels} are not in the receipts table")
+    _check_encodings(encodings, columns)
+
+    con = ProfiledConnection(connect(engine, threads), profile_dir, run_name="target_encoding")
+
+    # =================
+    # Section 1: Load
+    # =================
+    con.section("Section 1: Load")
+    con.execute(f"""
+        CREATE OR REPLACE TABLE te_receipts AS
+            SELECT
+                receipt_key,
+                COALESCE(epoch_us(CAST(Receive_date AS TIMESTAMP)), {MISSING_TIME}) AS t,
+                {", ".join(f"CAST(COALESCE({l}, 0) AS BIGINT) AS {l}" if l in columns else derived for l in labels)},
+                {", ".join(dict.fromkeys(k for keys in encodings.values() for k in keys))}
+            FROM read_parquet(?)
+    """, [str(receipts_parquet)])
+    base = con.execute("SELECT receipt_key, t FROM te_receipts ORDER BY receipt_key").fetchnumpy()
+    out = {"receipt_key": base["receipt_key"]}
+
+    # ==========================================
+    # Section 2: Prior, the all-receipts rates
+    # ==========================================
+    con.section("Section 2: Prior rates")
+    daily_sums = ", ".join(f"SUM({l}) AS {l}" for l in labels)
+    daily = con.execute(f"SELECT t, {daily_sums}, COUNT(*) AS n FROM te_receipts GROUP BY t").fetchnumpy()
+    prior = PrefixSums(np.zeros(len(daily["t"]), dtype=np.int64), daily["t"],
+                       {c: daily[c] for c in labels + ["n"]})
+    everyone = np.zeros(len(base["t"]), dtype=np.int64)
+    prior_rates = {}
+    for window_len in lookback_days:
+        _, win = prior.window(everyone, base["t"], window_len)
+        prior_rates[window_len] = {l: np.divide(win[l], win["n"], out=np.zeros(len(everyone)), where=win["n"] > 0)
+                                   for l in labels}
+
+    # ======================================
+    # Section 3: Smoothed rates of each key
+    # ======================================
+    for name, keys in encodings.items():
+        con.section(f"Section 3: Encoding {name}")
+        key_cols = ", ".join(keys)
+        has_key = " AND ".join(f"{k} IS NOT NULL" for k in keys)
+        con.execute(f"""
+            CREATE OR REPLACE TABLE te_keyed AS
+                SELECT receipt_key, t, {", ".join(labels)},
+                    CASE WHEN {has_key} THEN DENSE_RANK() OVER (ORDER BY {key_cols}) END AS key_id
+                FROM te_receipts
+        """)
+        daily = con.execute(f"""
+            SELECT key_id, t, {daily_sums}, COUNT(*) AS n
+            FROM te_keyed
+            WHERE key_id IS NOT NULL   ---never matched by a lookup
+            GROUP BY 1,2
+        """).fetchnumpy()
+        sums = PrefixSums(daily["key_id"], daily["t"], {c: daily[c] for c in labels + ["n"]})
+        q = con.execute("""
+            SELECT COALESCE(key_id, 0) AS q_key, (key_id IS NOT NULL) AS q_valid
+            FROM te_keyed
+            ORDER BY receipt_key
+        """).fetchnumpy()
+
+        for window_len in lookback_days:
+            d = window_len - 1
+            no_hist, win = sums.window(q["q_key"], base["t"], window_len, q["q_valid"])
+            out[f"no_hist_te_{name}_marker_{d}d"] = no_hist.astype(np.int8)
+            denom = win["n"] + smoothing
+            for l in labels:
+                num = win[l] + smoothing * prior_rates[window_len][l]
+                out[f"Rate_te_{name}_{l.removeprefix('label_')}_{d}d"] = \
+                    np.divide(num, denom, out=np.zeros(len(num)), where=denom > 0)
+
+    # ===================================
+    # Section 4: Write parquet & close
+    # ===================================
+    con.section("Section 4: Write parquet & close")
+    con.register("te", pd.DataFrame(out))
+    con.execute("CREATE OR REPLACE TABLE te_out AS SELECT * FROM te ORDER BY receipt_key")
+    con.sql(typed_select_sql(con, "te_out", order_by="receipt_key")).write_parquet(str(out_parquet))
+    con.close()
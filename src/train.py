@@ -7,15 +7,44 @@ import pandas as pd
 from sklearn.metrics import roc_auc_score
 
 import lightgbm as lgb
+import pyarrow.parquet as pq
 
 from src.io_load import *
+from src.splitting import load_fold_index, segment_path
 
 def _edit_filter(filter: list[list], arg: tuple) -> list[list]:
-    new_filter = []
-    for f in filter:
-        f.append(arg)
-        new_filter.append(f)
-    return new_filter
+    # new lists: the fold filters built from the same segment filters must not share them
+    return [f + [arg] for f in filter]
+
+def iter_fold_data(train_set_path,
+                   cols,
+                   n_folds=3,
+                   filters=None,
+                   val_marker=None):
+    """
+    Read cols and the fold markers of a train set once, then yield (k, train, val) for each fold,
+    selected with boolean masks over that one read (only one fold's frames are built at a time).
+    :param filters: row filters of the read (pyarrow DNF), e.g. segments or [[("label_invalid", "==", 0)]]
+    :param val_marker: None takes the rows with fold_k_marker != 1 as the validation set (as the 3-folds loaders do);
+                       2 takes only the fold's validation window
+    """
+    markers = [f"fold_{k}_marker" for k in range(1, n_folds + 1)]
+    df = load_df_from_pq(train_set_path,
+                         cols=list(dict.fromkeys(list(cols) + markers)),
+                         filters=filters or None)
+    data = df[list(cols)]
+    for k, marker in enumerate(markers, start=1):
+        is_train = (df[marker] == 1).to_numpy()
+        is_val = ~is_train if val_marker is None else (df[marker] == val_marker).to_numpy()
+        yield k, data[is_train].reset_index(drop=True), data[is_val].reset_index(drop=True)
+
+def _load_3folds(train_set_path, cols, filters=None):
+    """The 3 folds' train sets, then their val sets, from one read."""
+    trains, vals = [], []
+    for _, train, val in iter_fold_data(train_set_path, cols, n_folds=3, filters=filters):
+        trains.append(train)
+        vals.append(val)
+    return (*trains, *vals)
 
 def load_policy_training_3folds_data(repo_root, 
                                      pickle_path="data_work/trainable_colnames.pkl",
@@ -23,13 +52,6 @@ def load_policy_training_3folds_data(repo_root,
                                      segment=False,
                                      **kwargs):
     
-    fold_train_1 = ("fold_1_marker", "==", 1)
-    fold_val_1 = ("fold_1_marker", "!=", 1)
-    fold_train_2 = ("fold_2_marker", "==", 1)
-    fold_val_2 = ("fold_2_marker", "!=", 1)
-    fold_train_3 = ("fold_3_marker", "==", 1)
-    fold_val_3 = ("fold_3_marker", "!=", 1)
-
     pickle_path = os.path.join(repo_root, pickle_path)
 
     with open(pickle_path, 'rb') as f:
@@ -51,32 +73,8 @@ def load_policy_training_3folds_data(repo_root,
                                                                 train_set_path=train_set_path,
                                                                 w_3folds=True)
     
-    fold_train_1 = _edit_filter(filters, fold_train_1)
-    fold_val_1 = _edit_filter(filters, fold_val_1)
-    fold_train_2 = _edit_filter(filters, fold_train_2)
-    fold_val_2 = _edit_filter(filters, fold_val_2)
-    fold_train_3 = _edit_filter(filters, fold_train_3)
-    fold_val_3 = _edit_filter(filters, fold_val_3)
-            
-    policy_train_1 = load_df_from_pq(train_set_path, 
-                                 cols=policy_cols, 
-                                 filters=fold_train_1)
-    policy_val_1 = load_df_from_pq(train_set_path, 
-                               cols=policy_cols,
-                               filters=fold_val_1)
-    policy_train_2 = load_df_from_pq(train_set_path, 
-                                 cols=policy_cols, 
-                                 filters=fold_train_2)
-    policy_val_2 = load_df_from_pq(train_set_path, 
-                               cols=policy_cols,
-                               filters=fold_val_2)
-    policy_train_3 = load_df_from_pq(train_set_path, 
-                                 cols=policy_cols, 
-                                 filters=fold_train_3)
-    policy_val_3 = load_df_from_pq(train_set_path, 
-                               cols=policy_cols,
-                               filters=fold_val_3)
-    return policy_train_1, policy_train_2, policy_train_3, policy_val_1, policy_val_2, policy_val_3
+    # one read of the (segments') rows; the folds are masks over it
+    return _load_3folds(train_set_path, policy_cols, filters=[f for f in filters if f])
 
 def load_policy_training_data(repo_root, 
                             pickle_path="data_work/trainable_colnames.pkl",
@@ -150,6 +148,41 @@ def load_policy_certain_segment_data(repo_root,
     else:
         return policy_cols, filters
 
+def load_segment_fold_data(segment_dir,
+                           segments=[[2, 0, 0]],
+                           cols=None,
+                           split="train",
+                           fold=None):
+    """
+    Load segments of a split written with segment_dir (see src/splitting.py), reading only their files.
+    :param segments: [Price_limit_bin, Coupon_limit_bin, Expiry_span_bin] of each segment, concatenated in order
+    :param fold: None returns the whole split; k returns the (train, val) sets of fold k of the train split
+    """
+    if fold is not None and split != "train":
+        raise ValueError("Folds only partition the train split!")
+    if not segments:
+        raise ValueError("At least one segment is required!")
+
+    train_parts, val_parts = [], []
+    for seg in segments:
+        seg_dir = segment_path(segment_dir, *seg)
+        path = seg_dir / f"{split}.parquet"
+        if not path.exists():
+            raise FileNotFoundError(f"No {split} set for segment {seg} under {segment_dir}")
+        df = pq.read_table(path, columns=cols).to_pandas()
+        if fold is None:
+            train_parts.append(df)
+            continue
+        idx = load_fold_index(seg_dir / "folds.npz")
+        if f"fold_{fold}_train" not in idx:
+            raise ValueError(f"Fold {fold} is not in {seg_dir / 'folds.npz'}")
+        train_parts.append(df.iloc[idx[f"fold_{fold}_train"]])
+        val_parts.append(df.iloc[idx[f"fold_{fold}_val"]])
+
+    if fold is None:
+        return pd.concat(train_parts, ignore_index=True)
+    return pd.concat(train_parts, ignore_index=True), pd.concat(val_parts, ignore_index=True)
+
 def load_policy_test_data(repo_root,
                           pickle_path="data_work/trainable_colnames.pkl",
                           test_set_path="meituan-coupon-roi/data_work/policy_test_set.parquet"):
@@ -175,13 +208,6 @@ def get_policy_X_y_data(df):
 
 # TODO: make pickle_path and train_set_path as input arguments
 def load_ROI_training_3folds_data(repo_root, fh_or_st):
-    fold_train_1 = [[("fold_1_marker", "==", 1), ("label_invalid", "==", 0)]]
-    fold_val_1 = [[("fold_1_marker", "!=", 1), ("label_invalid", "==", 0)]]
-    fold_train_2 = [[("fold_2_marker", "==", 1), ("label_invalid", "==", 0)]]
-    fold_val_2 = [[("fold_2_marker", "!=", 1), ("label_invalid", "==", 0)]]
-    fold_train_3 = [[("fold_3_marker", "==", 1), ("label_invalid", "==", 0)]]
-    fold_val_3 = [[("fold_3_marker", "!=", 1), ("label_invalid", "==", 0)]]
-
     pickle_path = os.path.join(repo_root, "data_work/trainable_colnames.pkl")
     train_set_path = "meituan-coupon-roi/data_work/ROI_train_set_w_CV.parquet"
 
@@ -205,25 +231,8 @@ def load_ROI_training_3folds_data(repo_root, fh_or_st):
     else:
         raise ValueError("fh_or_st must be either 'fh' or 'st'.")
 
-    ROI_train_1 = load_df_from_pq(train_set_path, 
-                                 cols=ROI_cols, 
-                                 filters=fold_train_1)
-    ROI_val_1 = load_df_from_pq(train_set_path, 
-                               cols=ROI_cols,
-                               filters=fold_val_1)
-    ROI_train_2 = load_df_from_pq(train_set_path, 
-                                 cols=ROI_cols, 
-                                 filters=fold_train_2)
-    ROI_val_2 = load_df_from_pq(train_set_path, 
-                               cols=ROI_cols,
-                               filters=fold_val_2)
-    ROI_train_3 = load_df_from_pq(train_set_path, 
-                                 cols=ROI_cols, 
-                                 filters=fold_train_3)
-    ROI_val_3 = load_df_from_pq(train_set_path, 
-                               cols=ROI_cols,
-                               filters=fold_val_3)
-    return ROI_train_1, ROI_train_2, ROI_train_3, ROI_val_1, ROI_val_2, ROI_val_3
+    # one read of the valid receipts; the folds are masks over it
+    return _load_3folds(train_set_path, ROI_cols, filters=[[("label_invalid", "==", 0)]])
 
 def load_ROI_test_data(repo_root, 
                        pickle_path="data_work/trainable_colnames.pkl",
@@ -1,32 +1,197 @@
 # src/user_features.py
 from __future__ import annotations
-import duckdb
+from src.engine import EngineProfile, connect
+from src.feature_dtypes import typed_select_sql
+from src.profiling import ProfiledConnection
+from src.prefix_sums import MISSING_TIME, US_PER_DAY, DecayedSums, PrefixSums, check_half_lives
+from src.activity_store import ActivityStore
+from src.date_dim import day_key
 from pathlib import Path
+import numpy as np
 import pandas as pd
 
+def _windows_and_decays(users: np.ndarray, times: np.ndarray, values: dict[str, np.ndarray], tag: str,
+                        q: dict, lookback_days: list[int], half_lives: list[int], windows: dict) -> None:
+    """
+    Every lookback window and every half-life decay of every receipt from one family's per-user dated records.
+    Adds {tag}_no_hist_{sfx} and {tag}_{value}_{sfx} to `windows`, sfx = {window_len-1}d or hl{half_life}d.
+    """
+    sums = DecayedSums(users, times, values, half_lives) if half_lives else PrefixSums(users, times, values)
+    for window_len in lookback_days:
+        no_hist, win = sums.window(q["q_user"], q["q_time"], window_len, q["q_valid"])
+        windows[f"{tag}_no_hist_{window_len-1}d"] = no_hist
+        for c in values:
+            windows[f"{tag}_{c}_{window_len-1}d"] = win[c]
+    for h in half_lives:
+        no_hist, dec = sums.before(q["q_user"], q["q_time"], h, q["q_valid"])
+        windows[f"{tag}_no_hist_hl{h}d"] = no_hist
+        for c in values:
+            windows[f"{tag}_{c}_hl{h}d"] = dec[c]
+
+
+# per-user daily aggregates of each family: (SQL over the loaded tables, date column, value columns)
+DAILY_SQL = {
+    "rcs": ("""
+            SELECT
+                User_id_code, Receive_date,
+                SUM(label_invalid)      AS invalid,
+                SUM(label_same_user_fh) AS fh_redeem,
+                SUM(label_same_user_st) AS st_redeem,
+                COUNT(*)                AS vol
+            FROM receipts
+            GROUP BY 1,2
+        """, "Receive_date", ["invalid", "fh_redeem", "st_redeem", "vol"]),
+    "txns": ("""
+            WITH per_order AS (
+                SELECT
+                    User_id_code, Pay_date, Order_id_code,
+                    FIRST(Actual_pay_cent)        AS Actual_pay_perorder, --- actual pay amount is the same across observations for each txn record involving different coupons
+                    SUM(Reduce_amount_cent)       AS Reduce_amt_perorder
+                FROM txns
+                GROUP BY 1,2,3
+            )
+            SELECT
+                User_id_code, Pay_date,
+                COUNT(Order_id_code)          AS order_vol,
+                SUM(Actual_pay_perorder)      AS txn_amt,
+                SUM(Reduce_amt_perorder)      AS reduce_amt
+            FROM per_order
+            GROUP BY 1,2
+        """, "Pay_date", ["order_vol", "txn_amt", "reduce_amt"]),
+    "visits": ("""
+            SELECT User_id_code, Visit_date,
+                COUNT(*) AS visit_tms
+            FROM visits
+            GROUP BY 1,2
+        """, "Visit_date", ["visit_tms"]),
+}
+
+
+def daily_records(con, family: str) -> dict[str, np.ndarray]:
+    """
+    One family's per-user daily aggregates (see DAILY_SQL) from the tables loaded in `con`:
+    User_id_code, t (epoch microseconds, MISSING_TIME without a date) and the value columns as BIGINT.
+    """
+    daily_sql, date_col, value_cols = DAILY_SQL[family]
+    return con.execute(f"""
+        SELECT
+            User_id_code,
+            COALESCE(epoch_us(CAST({date_col} AS TIMESTAMP)), {MISSING_TIME}) AS t,
+            {", ".join(f"CAST(COALESCE({c}, 0) AS BIGINT) AS {c}" for c in value_cols)}
+        FROM ({daily_sql})
+        WHERE User_id_code IS NOT NULL   ---never matched by an as-of lookup
+    """).fetchnumpy()
+
+
+def _family_windows(con, family: str, q: dict, lookback_days: list[int], half_lives: list[int], windows: dict) -> None:
+    """Per-user daily aggregates of one family -> running sums -> its windows and decays."""
+    daily = daily_records(con, family)
+    _windows_and_decays(daily["User_id_code"], daily["t"], {c: daily[c] for c in DAILY_SQL[family][2]},
+                        family, q, lookback_days, half_lives, windows)
+
+
+def _store_windows(activity: ActivityStore, kind: str, tag: str, col: str,
+                   q: dict, lookback_days: list[int], half_lives: list[int], windows: dict) -> None:
+    """Every lookback window and decay of every receipt from the activity store; adds {tag}_no_hist_{sfx} and {tag}_{col}_{sfx}."""
+    for window_len in lookback_days:
+        no_hist, count = activity.window(kind, q["q_user"], q["q_day"], window_len, q["q_valid"], q["q_missing"])
+        windows[f"{tag}_no_hist_{window_len-1}d"] = no_hist
+        windows[f"{tag}_{col}_{window_len-1}d"] = count
+    if half_lives:
+        users, days, counts = activity.records(kind)
+        _windows_and_decays(users, days * US_PER_DAY, {col: counts}, tag, q, [], half_lives, windows)
+
+
+def _rcs_rate_cols(sfx: str) -> str:
+    rates = [f"""CASE
+                    WHEN w.rcs_vol_{sfx} = 0 THEN 0.000
+                    ELSE ROUND(w.rcs_{c}_{sfx} / w.rcs_vol_{sfx}, 3)
+                    END AS Rate_same_user_{c}_{sfx}""" for c in ["invalid", "fh_redeem", "st_redeem"]]
+    return ",\n".join([f"w.rcs_no_hist_{sfx}::INT AS no_hist_rcs_marker_{sfx}"] + rates)
+
+
+def _txns_rate_cols(sfx: str, n_days: str) -> str:
+    return f"""w.txns_no_hist_{sfx}::INT AS no_hist_txns_marker_{sfx},
+
+                ---avgspend does not include reduced amt here.
+                CASE
+                    WHEN w.txns_order_vol_{sfx} = 0 THEN 0.000
+                    ELSE ROUND(w.txns_txn_amt_{sfx} / w.txns_order_vol_{sfx} / (r.Price_limit_cent + 1), 3)
+                    END AS Rt_avgspend_vs_pricelimit_{sfx},
+                CASE
+                    WHEN w.txns_order_vol_{sfx} = 0 THEN 0.000
+                    ELSE ROUND(w.txns_reduce_amt_{sfx} / w.txns_order_vol_{sfx} / (r.Coupon_amt_cent + 1), 3)
+                    END AS Rt_avgreduce_vs_couponamt_{sfx},
+                ROUND(w.txns_freq_orders_{sfx} / {n_days}, 3)
+                    AS Freq_purchase_{sfx}"""
+
+
+def _visits_rate_cols(sfx: str, n_days: str) -> str:
+    return f"""w.visits_no_hist_{sfx}::INT AS no_hist_visits_marker_{sfx},
+                ROUND(w.visits_visit_tms_{sfx} / {n_days}, 3)
+                    AS Freq_visit_{sfx}"""
+
+
+def _suffixes(lookback_days: list[int], half_lives: list[int]) -> list[tuple[str, str]]:
+    """
+    (column suffix, SQL expression of the number of days a frequency is averaged over) of every window and decay.
+    A decay averages over the total weight of the days before the receipt, sum_(d>=1) 2^(-d/h) = 1 / (2^(1/h) - 1).
+    """
+    return [(f"{w-1}d", f"{w-1}") for w in lookback_days] + \
+           [(f"hl{h}d", f"(1 / (POW(2, 1 / {h}) - 1))") for h in half_lives]
+
+
+# rates of receipts are per receipt, not per day, so only the other families take the day count
+_RATE_COLS = {"rcs": lambda sfx, n_days: _rcs_rate_cols(sfx), "txns": _txns_rate_cols, "visits": _visits_rate_cols}
+USER_FAMILIES = list(_RATE_COLS)
+
+
 ## user features
     # the HISTORICAL invalidity rate for this user on all their previously received coupons
     # the HISTORICAL redemption rate for this user on all their previously received coupons
     # the exceeding part of the user's HISTORICAL average spend compared to THIS coupon's price limit
     # the user's HISTORICAL frequency of visits
     # the user's HISTORICAL frequency of purchases
+    # each over the lookback windows, and exponentially decayed with each half-life (suffix _hl{h}d):
+    # a record d days before the receipt weighs 2^(-d/h).
 def user_features(
         receipts_labelled_parquet: Path,
         txns_parquet: Path,
         visits_parquet: Path,
         out_parquet: Path,
         lookback_days: list[int] = [8, 15, 31],
-        threads: int = 8
+        half_lives: list[int] = [], # in days; decayed variants of every feature, from the same pass
+        families: list[str] = USER_FAMILIES, # a subset writes only those families' features
+        activity_store_dir: Path | None = None,
+        threads: int = 8,
+        engine: EngineProfile | str | None = None,
+        profile_dir: Path | None = None
 ) -> None:
     """
-    Generate user features and save to out_parquet."""
-    
-    con = duckdb.connect()
-    con.execute(f"PRAGMA threads={threads}")
+    Generate user features and save to out_parquet.
+    Each family (receipts, orders, visits) is aggregated per user and day in SQL, every lookback window
+    is answered from its running sums (see src/prefix_sums.py), and the rates are computed and written once.
+    The decayed features of every half-life come from the same sorted records as the windows.
+    With an activity_store_dir, the visit features and Freq_purchase are read from that store
+    (see src/activity_store.py) and visits_parquet is not read.
+    With a profile_dir, a per-section profiling report is written there as well (see src/profiling.py)."""
+    unknown = set(families) - set(USER_FAMILIES)
+    if unknown:
+        raise ValueError(f"Unknown user feature families {sorted(unknown)}; available: {USER_FAMILIES}")
+    families = [f for f in USER_FAMILIES if f in families]
+    if not families:
+        raise ValueError("At least one user feature family is required")
+    if not (lookback_days or half_lives):
+        raise ValueError("At least one lookback window or half-life is required")
+    half_lives = check_half_lives(half_lives)
+    run_name = "user_features" if families == USER_FAMILIES else "_".join(["user_features"] + families)
+
+    con = ProfiledConnection(connect(engine, threads), profile_dir, run_name=run_name)
 
     # ===================
     # Section 1: load
     # ===================
+    con.section("Section 1: load")
     
     # load coupon receipts
     con.execute("""
@@ -44,118 +209,48 @@ def user_features(
             FROM read_parquet(?)""", [str(receipts_labelled_parquet)])
     
     # load txns
-    con.execute("""
-        CREATE TABLE txns AS
-            SELECT
-                User_id_code,
-                Order_id_code,
-                Pay_date,
-                Actual_pay_cent, Reduce_amount_cent
-            FROM read_parquet(?)""", [str(txns_parquet)])
+    if "txns" in families:
+        con.execute("""
+            CREATE TABLE txns AS
+                SELECT
+                    User_id_code,
+                    Order_id_code,
+                    Pay_date,
+                    Actual_pay_cent, Reduce_amount_cent
+                FROM read_parquet(?)""", [str(txns_parquet)])
     
     # load visits
-    con.execute("""
-        CREATE TABLE visits AS
-            SELECT
-                User_id_code,
-                CAST (Visit_date AS TIMESTAMP) AS Visit_date    
-            FROM read_parquet(?)
-    """, [str(visits_parquet)])
+    activity = ActivityStore(activity_store_dir) if activity_store_dir is not None else None
+    if "visits" in families and activity is None:
+        con.execute("""
+            CREATE TABLE visits AS
+                SELECT
+                    User_id_code,
+                    CAST (Visit_date AS TIMESTAMP) AS Visit_date    
+                FROM read_parquet(?)
+        """, [str(visits_parquet)])
+
+    # the receipts as queries of the prefix-sum engine (see src/prefix_sums.py)
+    q = con.execute(f"""
+        SELECT
+            receipt_key,
+            COALESCE(User_id_code, 0)           AS q_user,
+            COALESCE(epoch_us(Receive_date), {MISSING_TIME}) AS q_time,
+            (User_id_code IS NOT NULL)          AS q_valid,
+            COALESCE({day_key("Receive_date")}, 0) AS q_day,
+            (Receive_date IS NULL)              AS q_missing
+        FROM receipts
+    """).fetchnumpy()
+    windows = {"receipt_key": q["receipt_key"]}
 
     # ===================================
     # Section 2.1: HISTORICAL redemption 
     # & invalidity rate for this user 
     # of all their received coupons
     # ===================================
-
-    con.execute("""
-        CREATE TABLE cum AS
-            -- pre-aggregate to daily
-            WITH daily AS (
-                SELECT
-                    User_id_code, Receive_date,
-                    SUM(label_invalid)      AS invalid_daily,
-                    SUM(label_same_user_fh) AS fh_redeem_daily,
-                    SUM(label_same_user_st) AS st_redeem_daily,
-                    COUNT(*)                AS vol_daily
-                FROM receipts
-                GROUP BY 1,2
-            )
-            SELECT
-                User_id_code, Receive_date,
-                SUM(invalid_daily)   OVER same_user AS invalid_cum,
-                SUM(fh_redeem_daily) OVER same_user AS fh_redeem_cum,
-                SUM(st_redeem_daily) OVER same_user AS st_redeem_cum,
-                SUM(vol_daily)       OVER same_user AS vol_cum
-            FROM daily
-            WINDOW same_user AS (
-                PARTITION BY User_id_code
-                ORDER BY Receive_date  ---this will put the lines with NaT receive_date to the end.
-                ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
-            )     
-    """)
-    con.execute("""
-        CREATE TABLE asof_right AS
-            SELECT 
-                r.receipt_key,
-                (c1.vol_cum IS NULL)          AS no_history_indicator,
-                COALESCE(c1.invalid_cum, 0)   AS invalid_right,
-                COALESCE(c1.fh_redeem_cum, 0) AS fh_redeem_right,
-                COALESCE(c1.st_redeem_cum, 0) AS st_redeem_right,
-                COALESCE(c1.vol_cum, 0)       AS vol_right
-            FROM receipts r
-            ASOF LEFT JOIN cum c1
-                ON r.User_id_code = c1.User_id_code
-                AND (r.Receive_date - INTERVAL 1 DAY) >= c1.Receive_date            
-    """)
-    for window_len in lookback_days:
-        con.execute(f"""
-            CREATE OR REPLACE TABLE rlookback AS
-                WITH asof_left AS (
-                    SELECT
-                        r.receipt_key,
-                        (c2.vol_cum IS NULL)          AS no_history_indicator,
-                        COALESCE(c2.invalid_cum, 0)   AS invalid_left,
-                        COALESCE(c2.fh_redeem_cum, 0) AS fh_redeem_left,
-                        COALESCE(c2.st_redeem_cum, 0) AS st_redeem_left,
-                        COALESCE(c2.vol_cum, 0)       AS vol_left
-                    FROM receipts r
-                    ASOF LEFT JOIN cum c2
-                        ON r.User_id_code = c2.User_id_code
-                        AND (r.Receive_date - INTERVAL {window_len} DAY) >= c2.Receive_date
-                )
-                SELECT
-                    a.receipt_key,
-                    (a.no_history_indicator OR b.no_history_indicator)::INT AS no_history_indicator,
-                    (a.invalid_right - b.invalid_left)                      AS invalid_{window_len-1}d,
-                    (a.fh_redeem_right - b.fh_redeem_left)                  AS fh_redeem_{window_len-1}d,
-                    (a.st_redeem_right - b.st_redeem_left)                  AS st_redeem_{window_len-1}d,
-                    (a.vol_right - b.vol_left)                              As vol_{window_len-1}d
-                FROM asof_right a
-                LEFT JOIN asof_left b
-                    ON a.receipt_key = b.receipt_key
-        """)
-
-        con.execute(f"""
-            CREATE OR REPLACE TABLE receipts AS
-                SELECT r.*,
-                    bk.no_history_indicator AS no_hist_rcs_marker_{window_len-1}d,
-                    CASE
-                        WHEN bk.vol_{window_len-1}d = 0 THEN 0.000
-                        ELSE ROUND(bk.invalid_{window_len-1}d / bk.vol_{window_len-1}d, 3)
-                        END AS Rate_same_user_invalid_{window_len-1}d,
-                    CASE
-                        WHEN bk.vol_{window_len-1}d = 0 THEN 0.000
-                        ELSE ROUND(bk.fh_redeem_{window_len-1}d / bk.vol_{window_len-1}d, 3)
-                        END AS Rate_same_user_fh_redeem_{window_len-1}d,
-                    CASE
-                        WHEN bk.vol_{window_len-1}d = 0 THEN 0.000
-                        ELSE ROUND(bk.st_redeem_{window_len-1}d / bk.vol_{window_len-1}d, 3)
-                        END AS Rate_same_user_st_redeem_{window_len-1}d
-                FROM receipts r
-                LEFT JOIN rlookback bk
-                    ON r.receipt_key = bk.receipt_key
-        """)
+    if "rcs" in families:
+        con.section("Section 2.1: Historical redemption & invalidity rates")
+        _family_windows(con, "rcs", q, lookback_days, half_lives, windows)
     
     # ======================================
     # Section 2.2: 
@@ -166,163 +261,39 @@ def user_features(
     # (3) HISTORICAL frequency of purchase
     # of the user. 
     # ======================================
-    con.execute("""
-        CREATE OR REPLACE TABLE cum AS
-            WITH per_order AS (
-                SELECT
-                    User_id_code, Pay_date, Order_id_code,
-                    FIRST(Actual_pay_cent)        AS Actual_pay_perorder, --- actual pay amount is the same across observations for each txn record involving different coupons
-                    SUM(Reduce_amount_cent)       AS Reduce_amt_perorder
-                FROM txns
-                GROUP BY 1,2,3
-            ),
-            daily AS (
-                SELECT
-                    User_id_code, Pay_date,
-                    COUNT(Order_id_code)          AS order_vol_daily,
-                    SUM(Actual_pay_perorder)      AS txn_amt_daily,
-                    SUM(Reduce_amt_perorder)      AS reduce_amt_daily
-                FROM per_order
-                GROUP BY 1,2
-            )
-            SELECT
-                User_id_code, Pay_date,
-                SUM(order_vol_daily)  OVER same_user AS order_vol_cum,
-                SUM(txn_amt_daily)    OVER same_user AS txn_amt_cum,
-                SUM(reduce_amt_daily) OVER same_user AS reduce_amt_cum
-            FROM daily
-            WINDOW same_user AS (
-                PARTITION BY User_id_code
-                ORDER BY Pay_date
-                ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
-            )
-    """)
-    con.execute("""
-        CREATE OR REPLACE TABLE asof_right AS
-            SELECT r.receipt_key,
-                (c1.order_vol_cum IS NULL)     AS no_hist_marker,
-                COALESCE(c1.order_vol_cum, 0)  AS order_vol_right,
-                COALESCE(c1.txn_amt_cum, 0)    AS txn_amt_right,
-                COALESCE(c1.reduce_amt_cum, 0) AS reduce_amt_right
-            FROM receipts r
-            ASOF LEFT JOIN cum c1
-                ON r.User_id_code = c1.User_id_code
-                AND (r.Receive_date - INTERVAL 1 DAY) >= c1.Pay_date
-    """)
-    for window_len in lookback_days:
-        con.execute(f"""
-            CREATE OR REPLACE TABLE asof_left AS
-                SELECT r.receipt_key,
-                    (c2.order_vol_cum IS NULL)     AS no_hist_marker,
-                    COALESCE(c2.order_vol_cum, 0)  AS order_vol_left,
-                    COALESCE(c2.txn_amt_cum, 0)    AS txn_amt_left,
-                    COALESCE(c2.reduce_amt_cum, 0) AS reduce_amt_left
-                FROM receipts r
-                ASOF LEFT JOIN cum c2
-                    ON r.User_id_code = c2.User_id_code
-                    AND (r.Receive_date - INTERVAL {window_len} DAY) >= c2.Pay_date
-        """)
-        con.execute(f"""
-            CREATE OR REPLACE TABLE rlookback AS
-                SELECT a.receipt_key,
-                    (a.no_hist_marker OR b.no_hist_marker)::INT AS no_hist_marker,
-                    (a.order_vol_right - b.order_vol_left)      AS order_vol_{window_len-1}d,
-                    (a.txn_amt_right - b.txn_amt_left)          AS txn_amt_{window_len-1}d,
-                    (a.reduce_amt_right - b.reduce_amt_left)    AS reduce_amt_{window_len-1}d
-                FROM asof_right a
-                LEFT JOIN asof_left b
-                    ON a.receipt_key = b.receipt_key
-        """)
-        con.execute(f"""
-            CREATE OR REPLACE TABLE receipts AS
-                SELECT r.*,
-                    bk.no_hist_marker AS no_hist_txns_marker_{window_len-1}d,
-
-                    ---avgspend does not include reduced amt here.
-                    CASE
-                        WHEN bk.order_vol_{window_len-1}d = 0 THEN 0.000
-                        ELSE ROUND(bk.txn_amt_{window_len-1}d / bk.order_vol_{window_len-1}d / (r.Price_limit_cent + 1), 3) 
-                        END AS Rt_avgspend_vs_pricelimit_{window_len-1}d,
-                    
-                    CASE
-                        WHEN bk.order_vol_{window_len-1}d = 0 THEN 0.000
-                        ELSE ROUND(bk.reduce_amt_{window_len-1}d / bk.order_vol_{window_len-1}d / (r.Coupon_amt_cent + 1), 3)
-                        END AS Rt_avgreduce_vs_couponamt_{window_len-1}d,
-                    ROUND(bk.order_vol_{window_len-1}d / {window_len-1}, 3)
-                        AS Freq_purchase_{window_len-1}d
-                FROM receipts r
-                LEFT JOIN rlookback bk
-                    ON r.receipt_key = bk.receipt_key
-        """)
+    if "txns" in families:
+        con.section("Section 2.2: Historical spend, reduce amount & purchase frequency")
+        _family_windows(con, "txns", q, lookback_days, half_lives, windows)
+        # Freq_purchase: order counts from the activity store if given
+        if activity is not None:
+            _store_windows(activity, "orders", "store", "orders", q, lookback_days, half_lives, windows)
+        for sfx, _ in _suffixes(lookback_days, half_lives):
+            windows[f"txns_freq_orders_{sfx}"] = windows[f"store_orders_{sfx}" if activity else f"txns_order_vol_{sfx}"]
     
     # ===========================================
     # Section 2.3: 
     # each user's HISTORICAL frequency of visit
     # ===========================================
-    con.execute("""
-        CREATE OR REPLACE TABLE cum AS
-            WITH daily AS (
-                SELECT User_id_code, Visit_date,
-                    COUNT(*) AS visit_tms_daily
-                FROM visits
-                GROUP BY 1,2      
-            )
-            SELECT
-                User_id_code, Visit_date,
-                SUM(visit_tms_daily) OVER
-                    (PARTITION BY User_id_code
-                    ORDER BY Visit_date
-                    ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW)
-                AS visit_tms_cum
-            FROM daily
-    """)
-    con.execute("""
-        CREATE OR REPLACE TABLE asof_right AS
-            SELECT
-                (c1.visit_tms_cum IS NULL) AS no_hist_marker,
-                r.receipt_key,
-                COALESCE(c1.visit_tms_cum, 0) AS visit_tms_right
-            FROM receipts r
-            ASOF LEFT JOIN cum c1
-                ON r.User_id_code = c1.User_id_code
-                AND r.Receive_date - INTERVAL 1 DAY >= c1.Visit_date
-    """)
-    for window_len in lookback_days:
-        con.execute(f"""
-            CREATE OR REPLACE TABLE asof_left AS
-                SELECT
-                    (c2.visit_tms_cum IS NULL) AS no_hist_marker,
-                    r.receipt_key,
-                    COALESCE(c2.visit_tms_cum, 0) AS visit_tms_left
-                FROM receipts r
-                ASOF LEFT JOIN cum c2
-                    ON r.User_id_code = c2.User_id_code
-                    AND r.Receive_date - INTERVAL {window_len} DAY >= c2.Visit_date
-        """)
-        con.execute(f"""
-            CREATE OR REPLACE TABLE rlookback AS
-                SELECT a.receipt_key,
-                    (a.no_hist_marker OR b.no_hist_marker)::INT AS no_hist_marker,
-                    (a.visit_tms_right - b.visit_tms_left) AS visit_tms_{window_len-1}d
-                FROM asof_right a
-                LEFT JOIN asof_left b
-                    ON a.receipt_key = b.receipt_key
-        """)
-        con.execute(f"""
-            CREATE OR REPLACE TABLE receipts AS
-                SELECT r.*,
-                    bk.no_hist_marker AS no_hist_visits_marker_{window_len-1}d,
-                    ROUND(bk.visit_tms_{window_len-1}d / {window_len-1}, 3)
-                        AS Freq_visit_{window_len-1}d
-                FROM receipts r
-                LEFT JOIN rlookback bk
-                    ON r.receipt_key = bk.receipt_key
-                ORDER BY
-                    r.receipt_key
-        """)
-    
+    if "visits" in families:
+        con.section("Section 2.3: Historical visit frequency")
+        if activity is not None:
+            _store_windows(activity, "visit_days", "visits", "visit_tms", q, lookback_days, half_lives, windows)
+        else:
+            _family_windows(con, "visits", q, lookback_days, half_lives, windows)
+
     # ===================================
-    # Section 3: Write parquet & close
+    # Section 3: Rates, write parquet & close
     # ===================================
-    con.sql("SELECT * FROM receipts").write_parquet(str(out_parquet))
-    con.close()
\ No newline at end of file
+    con.section("Section 3: Write parquet & close")
+    con.register("windows", pd.DataFrame(windows))
+    con.execute(f"""
+        CREATE OR REPLACE TABLE receipts_out AS
+            SELECT r.*,
+                {", ".join(_RATE_COLS[f](*sfx) for f in families for sfx in _suffixes(lookback_days, half_lives))}
+            FROM receipts r
+            LEFT JOIN windows w
+                ON r.receipt_key = w.receipt_key
+            ORDER BY r.receipt_key
+    """)
+    con.sql(typed_select_sql(con, "receipts_out", order_by="receipt_key")).write_parquet(str(out_parquet))
+    con.close()
@@ -0,0 +1,80 @@
+from datetime import date
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from src.activity_store import ActivityStore, build_activity_store
+from src.user_features import user_features
+
+def test_visit_and_purchase_windows(make_labelled_receipts, add_receipt_keys,
+                                    make_txns, make_visits,
+                                    cast_datatype, to_parquet):
+    """
+    Case 1: One user visiting on 3 days and paying 3 orders over 2 days.
+    Expect:
+    - popcount / slice-sum windows over (day - w, day - 1]
+    - user_features reading the store writes the same table as reading the raw visits
+    """
+    receipt_rows = (
+       (1, 9001, 100, 0, "2023-01-02", "2023-01-02", "2023-01-03", 1, 0, 0),
+       (1, 9002, 900, 0, "2023-01-04", "2023-01-04", "2023-01-05", 1, 1, 1),
+       (2, 9003, 500, 1000, "2023-01-04", "2023-01-04", "2023-01-05", 0, 1, 1))
+    rcs = make_labelled_receipts(*receipt_rows)
+    rcs = add_receipt_keys(rcs, keys=range(1, 4))
+    rcs = cast_datatype(rcs, "receipt_labelled")
+    rp = "tests/data_test/rcs_activity.parquet"; to_parquet(rcs, rp)
+
+    txn_rows = (
+	    (1, -1, "2023-01-01", 2500, 0, 1),
+	    (1, 9002, "2023-01-01", 2500, 900, 2),
+	    (1, -1, "2023-01-03", 1200, 0, 3))
+    txns = make_txns(*txn_rows)
+    txns = cast_datatype(txns, "txn_wo_key")
+    tp = "tests/data_test/txns_activity.parquet"; to_parquet(txns, tp)
+
+    visits = make_visits((1, "2023-01-01"), (1, "2023-01-02"), (1, "2023-01-03"))
+    visits = cast_datatype(visits, "visit")
+    vp = "tests/data_test/visits_activity.parquet"; to_parquet(visits, vp)
+
+    sd = "tests/data_test/activity_store"
+    build_activity_store(tp, vp, sd, start=date(2023, 1, 1), end=date(2023, 1, 10), threads=1)
+    store = ActivityStore(sd)
+
+    day = (date(2023, 1, 4) - date(1970, 1, 1)).days
+    users, days = np.array([1, 1, 2]), np.array([day, day - 2, day])
+    no_hist, visit_days = store.window("visit_days", users, days, 3)
+    assert visit_days.tolist() == [2, 1, 0]
+    assert no_hist.tolist() == [False, True, True]
+    _, orders = store.window("orders", users, days, 4)
+    assert orders.tolist() == [3, 2, 0]
+
+    user_features(rp, tp, vp, "tests/data_test/user_raw.parquet", lookback_days=[2, 3], threads=1)
+    user_features(rp, tp, vp, "tests/data_test/user_store.parquet", lookback_days=[2, 3],
+                  activity_store_dir=sd, threads=1)
+    pd.testing.assert_frame_equal(pq.read_table("tests/data_test/user_raw.parquet").to_pandas(),
+                                  pq.read_table("tests/data_test/user_store.parquet").to_pandas())
+
+
+def test_empty_activity(make_txns, make_visits, cast_datatype, to_parquet):
+    """
+    Case 2: No txns and no visits, with and without a given day range.
+    Expect:
+    - an empty store (0 days without a range) instead of an error
+    - every query without history and without activity
+    """
+    txns = make_txns((1, -1, "2023-01-01", 2500, 0, 1))
+    txns = cast_datatype(txns, "txn_wo_key").iloc[:0]
+    tp = "tests/data_test/txns_activity_empty.parquet"; to_parquet(txns, tp)
+    visits = make_visits((1, "2023-01-01"))
+    visits = cast_datatype(visits, "visit").iloc[:0]
+    vp = "tests/data_test/visits_activity_empty.parquet"; to_parquet(visits, vp)
+
+    day = (date(2023, 1, 4) - date(1970, 1, 1)).days
+    for sd, start, end, n_days in [("tests/data_test/activity_store_empty", None, None, 0),
+                                   ("tests/data_test/activity_store_empty_range", date(2023, 1, 1), date(2023, 1, 10), 10)]:
+        build_activity_store(tp, vp, sd, start=start, end=end, threads=1)
+        store = ActivityStore(sd)
+        assert (len(store.users), store.n_days) == (0, n_days)
+        for kind in ["visit_days", "orders"]:
+            no_hist, count = store.window(kind, np.array([1, 2]), np.array([day, day]), 3)
+            assert no_hist.tolist() == [True, True]
+            assert count.tolist() == [0, 0]
@@ -117,4 +117,115 @@ def test_multi_segment(make_labelled_receipts, add_receipt_keys,
         if i == 5:
             assert value == 1
         else:
-            assert value == 0
\ No newline at end of file
+            assert value == 0
+
+def test_multi_split_bins(make_labelled_receipts, add_receipt_keys,
+                          cast_datatype, to_parquet):
+    """
+    Case 3: With more than two splits per dimension,
+    test whether each receipt lands in the bin (splits[i-1], splits[i]],
+    values on a split stay in the lower bin, and a negative expiry span gets -1.
+    """
+    # construct data
+    receipt_rows = (
+        (1, 9001, 100, 0, "2023-01-01", "2023-01-01", "2023-01-03", 1, 0, 0),
+        (2, 9002, 500, 500, "2023-01-02", "2023-01-02", "2023-01-05", 1, 1, 1),
+        (3, 9003, 501, 1000, "2023-01-03", "2023-01-03", "2023-01-06", 1, 0, 0),
+        (4, 9004, 5000, 10000, "2023-01-04", "2023-01-04", "2023-01-14", 1, 1, 0),
+        (5, 9005, 20000, 50000, "2023-01-05", "2023-01-05", "2023-02-05", 0, 0, 0),
+        (6, 9006, 100, 900, "2023-01-06", "2023-01-06", "2023-01-05", 1, 0, 0))
+    rcs = make_labelled_receipts(*receipt_rows)
+    rcs = add_receipt_keys(rcs, keys=range(1, 7))
+    rcs = cast_datatype(rcs, "receipt_labelled")
+    rp = "tests/data_test/rcs_labelled_3.parquet"; to_parquet(rcs, rp)
+
+    # go through the function:
+    outp = "tests/data_test/rcs_labelled_featureout_3.parquet"
+    coupon_features(rp, outp, lookback_days=[7],
+                    Price_limit_bin_splits=[0, 500, 1000, 10000],
+                    Coupon_limit_bin_splits=[100, 500, 5000],
+                    Expiry_span_bin_split=[3, 10, 30])
+
+    # assertion:
+    out = pq.read_table(outp).to_pandas()
+    assert (out["Price_limit_bin"] == [0, 1, 2, 3, 4, 2]).all()
+    assert (out["Coupon_limit_bin"] == [0, 1, 2, 2, 3, 0]).all()
+    assert (out["Expiry_span_bin"] == [0, 0, 0, 1, 3, -1]).all()
+
+    # compact output dtypes (see src/feature_dtypes.py)
+    assert out["Price_limit_bin"].dtype == np.int16
+    assert out["Holiday_marker"].dtype == np.int8
+    assert out["no_history_indicator_6d"].dtype == np.int8
+    assert out["Rate_invalid_6d"].dtype == np.float32
+    assert out["Generosity_ratio"].dtype == np.float32
+
+def test_multi_window_regression(make_labelled_receipts, add_receipt_keys,
+                                 cast_datatype, to_parquet):
+    """
+    Case 4: Regression test of the whole output (columns, their order, row order and values)
+    against a fixed expected frame, for two windows in one run and for a single window.
+    The expected values were produced by the one-window-at-a-time implementation.
+    """
+    # construct data
+    receipt_rows = (
+        (1, 9001, 100, 0, "2023-01-01", "2023-01-02", "2023-01-03", 1, 0, 0),
+        (2, 9002, 500, 1000, "2023-01-01", "2023-01-02", "2023-01-09", 0, 1, 1),
+        (3, 9003, 250, 1000, "2023-01-02", "2023-01-02", "2023-01-20", 1, 1, 0),
+        (4, 9004, 1000, 10000, "2023-01-03", "2023-01-04", "2023-01-24", 1, 1, 1),
+        (5, 9005, 500, 1000, "2023-01-05", "2023-01-05", "2023-01-06", 1, 0, 0),
+        (6, 9006, 100, 900, "2023-01-07", "2023-01-08", "2023-01-16", 1, 1, 1),
+        (7, 9007, 250, 1000, "2023-01-09", "2023-01-09", "2023-01-12", 0, 0, 0),
+        (8, 9008, 1000, 10000, "2023-01-12", "2023-01-12", "2023-01-30", 1, 0, 0),
+        (9, 9009, 1000, 10000, "2023-01-10", "2023-01-10", "2023-01-28", 1, 1, 1),
+        (1, 9010, 100, 0, "2023-01-11", "2023-01-11", "2023-01-12", 1, 1, 0))
+    rcs = make_labelled_receipts(*receipt_rows)
+    rcs = add_receipt_keys(rcs, keys=range(1, 11))
+    rcs = cast_datatype(rcs, "receipt_labelled")
+    rp = "tests/data_test/rcs_labelled_4.parquet"; to_parquet(rcs, rp)
+
+    base_cols = ["receipt_key", "User_id_code", "Coupon_id_code", "Price_limit_cent", "Coupon_amt_cent",
+                 "Receive_date", "Start_date", "End_date",
+                 "label_invalid", "label_same_user_fh", "label_same_user_st"]
+    shared = {
+        "Price_limit_bin": [0, 0, 0, 1, 0, 0, 0, 1, 0, 1],
+        "Coupon_limit_bin": [0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+        "Expiry_span_bin": [0, 0, 1, 1, 0, 0, 0, 1, 0, 1],
+        "Generosity_ratio": [100.0, 0.4995, 0.2498, 0.1, 0.4995, 0.111, 0.2498, 0.1, 100.0, 0.1],
+        "Start_bf_receive_marker": [0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+        "End_bf_receive_marker": [0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+        "Weekday_marker": [0, 0, 1, 1, 1, 0, 1, 1, 1, 1],
+        "Workday_marker": [0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+        "Holiday_marker": [1, 1, 1, 0, 0, 0, 0, 0, 0, 0],
+    }
+    windows_3_8 = {
+        "no_history_indicator_2d": [1, 1, 1, 1, 0, 0, 0, 0, 0, 0],
+        "Rate_invalid_2d": [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0],
+        "Rate_fh_redeem_2d": [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 1.0],
+        "Rate_st_redeem_2d": [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 1.0],
+        "no_history_indicator_7d": [1, 1, 1, 1, 1, 1, 0, 1, 0, 0],
+        "Rate_invalid_7d": [0.0, 0.0, 0.0, 0.0, 0.5, 0.333, 0.0, 0.0, 0.333, 0.0],
+        "Rate_fh_redeem_7d": [0.0, 0.0, 0.0, 0.0, 0.5, 0.333, 0.5, 1.0, 0.333, 1.0],
+        "Rate_st_redeem_7d": [0.0, 0.0, 0.0, 0.0, 0.5, 0.333, 0.5, 1.0, 0.333, 1.0],
+    }
+    window_15 = {
+        "no_history_indicator_14d": [1, 1, 1, 1, 1, 1, 1, 1, 1, 1],
+        "Rate_invalid_14d": [0.0, 0.0, 0.0, 0.0, 0.5, 0.333, 0.25, 0.0, 0.4, 0.0],
+        "Rate_fh_redeem_14d": [0.0, 0.0, 0.0, 0.0, 0.5, 0.333, 0.5, 1.0, 0.4, 1.0],
+        "Rate_st_redeem_14d": [0.0, 0.0, 0.0, 0.0, 0.5, 0.333, 0.5, 1.0, 0.4, 1.0],
+    }
+    # rows come out ordered by Receive_date
+    row_order = [1, 2, 3, 4, 5, 6, 7, 9, 10, 8]
+    expected_in = rcs.set_index("receipt_key").loc[row_order].reset_index()
+    expected_in["label_invalid"] = 1 - expected_in["label_valid"]
+
+    for lookback_days, window_cols in (([3, 8], windows_3_8), ([15], window_15)):
+        # go through the function:
+        outp = "tests/data_test/rcs_labelled_featureout_4.parquet"
+        coupon_features(rp, outp, lookback_days=lookback_days)
+
+        # assertion:
+        out = pq.read_table(outp).to_pandas()
+        expected = pd.concat([expected_in[base_cols], pd.DataFrame({**shared, **window_cols})], axis=1)
+        assert list(out.columns) == list(expected.columns)
+        pd.testing.assert_frame_equal(out, expected, check_dtype=False, check_exact=False,
+                                      rtol=0, atol=1e-3)
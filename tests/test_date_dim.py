@@ -0,0 +1,28 @@
+from datetime import date
+import pyarrow.parquet as pq
+from src.date_dim import build_date_dim, load_calendar
+
+def test_calendar_markers():
+    """
+    Case 1: Build the date dimension over the 2023 Spring Festival block.
+    Expect:
+    - consecutive integer day keys (days since 1970-01-01)
+    - holidays marked as such and off work, even on weekdays (2023-01-23, a Monday)
+    - adjusted working weekends (2023-01-28, a Saturday) marked as workdays and business days
+    """
+    holidays, workdays = load_calendar()
+    assert date(2023, 1, 23) in holidays and date(2023, 1, 28) in workdays
+
+    outp = "tests/data_test/date_dim.parquet"
+    build_date_dim(outp, date(2023, 1, 20), date(2023, 1, 30), threads=1)
+    dd = pq.read_table(outp).to_pandas().set_index("cal_date")
+
+    assert dd["day_key"].tolist() == list(range(19377, 19388))
+    assert dd.loc[date(2023, 1, 23), "Weekday_marker"] == 1
+    assert dd.loc[date(2023, 1, 23), "Holiday_marker"] == 1
+    assert dd.loc[date(2023, 1, 23), "Business_day_marker"] == 0
+    assert dd.loc[date(2023, 1, 28), "Weekday_marker"] == 0
+    assert dd.loc[date(2023, 1, 28), "Workday_marker"] == 1
+    assert dd.loc[date(2023, 1, 28), "Business_day_marker"] == 1
+    assert dd.loc[date(2023, 1, 30), "Business_day_marker"] == 1
+    assert dd.loc[date(2023, 1, 30), "day_of_week"] == 1
@@ -0,0 +1,124 @@
+import pytest
+import duckdb
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from src.diagnostics import DiagStore, build_diag_store, diag_on_receipts, _fine_sql, _segments_sql
+
+def _write_receipts(make_labelled_receipts, add_receipt_keys, cast_datatype, to_parquet):
+    receipt_rows = (
+       (1, 9001, 100, 500, "2023-01-01", "2023-01-01", "2023-01-03", 1, 1, 1),
+       (1, 9002, 100, 1000, "2023-01-01", "2023-01-01", "2023-01-11", 1, 0, 0),
+       (2, 9003, 100, 5000, "2023-01-02", "2023-01-02", "2023-01-04", 0, 0, 0),
+       (2, 9004, 100, 5000, "2023-01-02", "2023-01-02", "2023-01-05", 1, 1, 0),
+       (3, 9005, 100, 800, "2023-01-03", "2023-01-03", "2023-03-03", 1, 1, 1))
+    rcs = make_labelled_receipts(*receipt_rows)
+    rcs = add_receipt_keys(rcs, keys=range(1, 6))
+    rcs = cast_datatype(rcs, "receipt_labelled")
+    rp = "tests/data_test/rcs_diag.parquet"; to_parquet(rcs, rp)
+    return rp
+
+def test_segment_cube(make_labelled_receipts, add_receipt_keys,
+                      cast_datatype, to_parquet):
+    """
+    Case 1: 5 receipts of 2x2x2 segments: price and coupon splits at 1000 cents, expiry split at 10 days.
+    Expect:
+    - one row per segment, in bin order, empty segments with a zero count
+    - a receipt on a split (price 1000, span 10 days) counted in both segments sharing it
+    - with cube marginals: NULL bins merging all of a dimension's bins, each receipt counted once there
+    - rollup: only trailing dimensions merged; an unknown marginals option -> ValueError
+    - the receipts scanned once by the cube query, though it refers to them 7 times
+    """
+    rp = _write_receipts(make_labelled_receipts, add_receipt_keys, cast_datatype, to_parquet)
+
+    df = diag_on_receipts(rp, [1000], [1000], [10], threads=1)
+    assert df["receipts_count"].tolist() == [2, 2, 0, 0, 3, 1, 0, 0]
+    assert df["validity_pc"][4] == pytest.approx(66.67)
+    assert df["Price_limit_upper_bin"][0] == 1000
+
+    cube = diag_on_receipts(rp, [1000], [1000], [10], marginals="cube", threads=1)
+    assert len(cube) == 3 * 3 * 3
+    total = cube[cube[["Price_limit_bin", "Coupon_limit_bin", "Expiry_span_bin"]].isna().all(axis=1)]
+    assert total["receipts_count"].tolist() == [5]
+    by_price = cube[cube["Coupon_limit_bin"].isna() & cube["Expiry_span_bin"].isna()].dropna(subset=["Price_limit_bin"])
+    assert by_price["receipts_count"].tolist() == [3, 3]
+
+    rollup = diag_on_receipts(rp, [1000], [1000], [10], marginals="rollup", threads=1)
+    assert len(rollup) == 2 * 2 * 2 + 2 * 2 + 2 + 1
+    with pytest.raises(ValueError):
+        diag_on_receipts(rp, [1000], [1000], [10], marginals="grouping_sets", threads=1)
+
+    con = duckdb.connect()
+    con.execute(f"CREATE VIEW fine AS {_fine_sql(f'read_parquet({rp!r})')}")
+    plan = con.sql(f"EXPLAIN ANALYZE {_segments_sql('fine', [1000], [1000], [10], 'cube')}").fetchall()[0][1]
+    assert plan.count("READ_PARQUET") == 1
+    con.close()
+
+
+def test_diag_store(make_labelled_receipts, add_receipt_keys,
+                    cast_datatype, to_parquet):
+    """
+    Case 2: The receipts of case 1 summed into a diagnostics store, rolled up into other split sets.
+    Expect the store to hold one row per distinct price / coupon / span, and every roll-up to equal
+    diag_on_receipts on the receipts.
+    """
+    rp = _write_receipts(make_labelled_receipts, add_receipt_keys, cast_datatype, to_parquet)
+    sp = "tests/data_test/diag_store.parquet"
+    build_diag_store(rp, sp, threads=1)
+    store = DiagStore(sp)
+    assert store.con.sql("SELECT SUM(n), COUNT(*) FROM fine").fetchone() == (5, 5)
+    for splits, marginals in [(([1000], [1000], [10]), None), (([], [50, 100], [3, 4]), "cube"),
+                              (([600, 900, 5000], [], [2]), "rollup")]:
+        pd.testing.assert_frame_equal(store.segments(*splits, marginals=marginals),
+                                      diag_on_receipts(rp, *splits, marginals=marginals, threads=1))
+    store.close()
+
+def test_sampled_diagnostics(to_parquet):
+    """
+    Case 3: 4000 random receipts over 2 price bins, ordered by date with validity rising over the days,
+    in 40 row groups; a 25% sample with seed 7.
+    Expect:
+    - about a quarter of each segment sampled, the same sample for the same seed,
+      the realised fraction reported
+    - each percentage of the sample inside its Wilson interval, the bounds matching the formula,
+      the full data's percentages inside the intervals too
+    - a file of one row group sampled the same way (not read whole);
+      a fraction outside (0, 1] -> ValueError
+    """
+    rng = np.random.default_rng(0)
+    n = 4000
+    day = np.sort(rng.integers(0, 60, n))
+    start = pd.Timestamp("2023-01-01") + pd.to_timedelta(day, unit="D")
+    rcs = pd.DataFrame({"receipt_key": np.arange(n), "Price_limit_cent": rng.choice([500, 5000], n),
+                        "Coupon_amt_cent": 100, "Start_date": start, "End_date": start + pd.Timedelta(days=5),
+                        "label_valid": (rng.random(n) < 0.1 + 0.8 * day / 60).astype(int),
+                        "label_same_user_fh": rng.integers(0, 2, n),
+                        "label_same_user_st": rng.integers(0, 2, n)})
+    rp = "tests/data_test/rcs_diag_sample.parquet"
+    pq.write_table(pa.Table.from_pandas(rcs, preserve_index=False), rp, row_group_size=100)
+
+    full = diag_on_receipts(rp, [1000], [], [], threads=1)
+    sample = diag_on_receipts(rp, [1000], [], [], sample_fraction=0.25, seed=7, threads=1)
+    assert sample.equals(diag_on_receipts(rp, [1000], [], [], sample_fraction=0.25, seed=7, threads=1))
+    assert sample["receipts_count"].div(full["receipts_count"]).between(0.22, 0.28).all()
+    assert (sample["sample_fraction"] == sample["receipts_count"].sum() / n).all()
+
+    x = sample["validity_pc"] / 100 * sample["receipts_count"]
+    m, z = sample["receipts_count"], 1.959964
+    p = x / m
+    half = z * np.sqrt(p * (1 - p) / m + z ** 2 / (4 * m ** 2)) / (1 + z ** 2 / m)
+    center = (p + z ** 2 / (2 * m)) / (1 + z ** 2 / m)
+    np.testing.assert_allclose(sample["validity_pc_lo"], 100 * (center - half), atol=0.02)
+    np.testing.assert_allclose(sample["validity_pc_hi"], 100 * (center + half), atol=0.02)
+    for metric in ["validity_pc", "redeem_fh_pc", "redeem_st_pc"]:
+        assert (sample[f"{metric}_lo"] <= sample[metric]).all() and (sample[metric] <= sample[f"{metric}_hi"]).all()
+        assert (sample[f"{metric}_lo"] <= full[metric]).all() and (full[metric] <= sample[f"{metric}_hi"]).all()
+
+    rp_one = "tests/data_test/rcs_diag_sample_one_group.parquet"; to_parquet(rcs, rp_one)
+    assert pq.ParquetFile(rp_one).metadata.num_row_groups == 1
+    one = diag_on_receipts(rp_one, [1000], [], [], sample_fraction=0.25, seed=7, threads=1)
+    pd.testing.assert_frame_equal(one, sample)
+
+    with pytest.raises(ValueError):
+        diag_on_receipts(rp, [1000], [], [], sample_fraction=1.5, threads=1)
@@ -0,0 +1,55 @@
+import pytest
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from src.engine import EngineProfile, connect, load_engine_profile
+from src.cpn_features import coupon_features
+
+def test_connect_applies_profile(tmp_path):
+    profile = EngineProfile(threads=2, memory_limit="1GB", temp_directory=str(tmp_path / "spill"),
+                            preserve_insertion_order=False)
+    con = connect(profile, threads=8)   # the profile's threads win
+    threads, insertion_order, temp_dir = con.execute("""
+        SELECT current_setting('threads'), current_setting('preserve_insertion_order'),
+               current_setting('temp_directory')""").fetchone()
+    assert threads == 2
+    assert insertion_order is False
+    assert temp_dir == (tmp_path / "spill").as_posix()
+    assert (tmp_path / "spill").is_dir()
+
+def test_presets_from_config():
+    laptop = load_engine_profile("laptop_4gb")
+    batch = load_engine_profile("batch_node_64gb")
+    assert laptop.memory_limit == "3GB"
+    assert batch.threads > laptop.threads
+    with pytest.raises(ValueError):
+        load_engine_profile("no_such_profile")
+
+def test_connect_default_keeps_threads_only():
+    con = connect(threads=3)
+    assert con.execute("SELECT current_setting('threads')").fetchone()[0] == 3
+
+
+def test_sorted_output_without_insertion_order(tmp_path):
+    """
+    A stage run under a profile without preserve_insertion_order (like the laptop / batch presets)
+    still writes its rows in order: 150k receipts keyed in Receive_date order, through coupon_features.
+    """
+    n = 150_000
+    rng = np.random.default_rng(0)
+    receive = np.sort(pd.Timestamp("2023-01-01") + pd.to_timedelta(rng.integers(0, 120, n), unit="D"))
+    rcs = pd.DataFrame({
+        "receipt_key": np.arange(1, n + 1),
+        "User_id_code": rng.integers(0, 5000, n), "Coupon_id_code": rng.integers(0, 500, n),
+        "Coupon_amt_cent": rng.choice([100, 500, 1000], n), "Price_limit_cent": rng.choice([0, 1000, 5000, 20000], n),
+        "Receive_date": receive, "Start_date": receive,
+        "End_date": receive + pd.to_timedelta(rng.integers(0, 30, n), unit="D"),
+        "label_valid": rng.integers(0, 2, n), "label_same_user_fh": rng.integers(0, 2, n),
+        "label_same_user_st": rng.integers(0, 2, n)})
+    rcs.to_parquet(tmp_path / "receipts.parquet", index=False)
+
+    coupon_features(tmp_path / "receipts.parquet", tmp_path / "cpn.parquet", lookback_days=[7],
+                    engine=EngineProfile(threads=8, preserve_insertion_order=False))
+    out = pq.read_table(tmp_path / "cpn.parquet", columns=["receipt_key"]).to_pandas()
+    assert len(out) == n
+    assert out["receipt_key"].is_monotonic_increasing
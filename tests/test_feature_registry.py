@@ -0,0 +1,41 @@
+import pytest
+import pandas as pd
+import pyarrow.parquet as pq
+from src.feature_registry import feature_spec, load_feature_selection
+from src.combine_features import features_combining
+
+def test_registry_and_projected_combine(to_parquet):
+    """
+    Case 1: Registry entries of a few columns, and a combine of two small feature tables.
+    Expect:
+    - module, dtype and inputs by name, whatever the window / half-life; None for an unknown column
+    - the column pickle without its receipt_key_1 / _2 join artifacts
+    - the selected columns only, each from the table owning it; unknown columns -> ValueError
+    """
+    spec = feature_spec("Rate_same_user_fh_redeem_hl7d")
+    assert (spec.module, spec.dtype) == ("src.user_features", "FLOAT")
+    assert "visits" in feature_spec("Freq_visit_30d").inputs
+    assert feature_spec("Rate_invalid_14d").module == "src.cpn_features"
+    assert feature_spec("Rate_te_coupon_invalid_7d").module == "src.target_encoding"
+    assert feature_spec("Price_limit_bin").dtype == "SMALLINT"
+    assert feature_spec("Shop_id_code") is None
+
+    cols = load_feature_selection("conf/feature_selection/trainable_colnames.pkl")
+    assert "receipt_key_1" not in cols and "Freq_visit_30d" in cols
+
+    keys = [1, 2, 3]
+    cpn = pd.DataFrame({"receipt_key": keys, "Price_limit_cent": [100, 200, 300],
+                        "Rate_invalid_7d": [0.1, 0.2, 0.3], "label_invalid": [0, 1, 0]})
+    user = pd.DataFrame({"receipt_key": [3, 2, 1], "Price_limit_cent": [300, 200, 100],
+                         "Freq_visit_7d": [0.5, 0.25, 0.0]})
+    cp, up = "tests/data_test/cpn_registry.parquet", "tests/data_test/user_registry.parquet"
+    to_parquet(cpn, cp); to_parquet(user, up)
+
+    out = "tests/data_test/trainable_registry.parquet"
+    features_combining(cp, up, out, columns=["Freq_visit_7d", "label_invalid"], threads=1)
+    df = pq.read_table(out).to_pandas().sort_values("receipt_key").reset_index(drop=True)
+    assert list(df.columns) == ["receipt_key", "Freq_visit_7d", "label_invalid"]
+    assert df["Freq_visit_7d"].tolist() == [0.0, 0.25, 0.5]
+
+    with pytest.raises(ValueError):
+        features_combining(cp, up, out, columns=["Freq_visit_30d"], threads=1)
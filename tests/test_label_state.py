@@ -0,0 +1,115 @@
+import shutil
+import pathlib
+from datetime import date
+import pandas as pd
+import pyarrow.parquet as pq
+from src.labels import build_labels
+from src.label_state import init_label_state, update_label_state, read_label_state
+
+def test_open_receipt_matures_with_new_partition(make_txns, make_receipts,
+                                                 add_txn_keys, add_receipt_keys,
+                                                 cast_datatype, to_parquet):
+    """
+    Case 1: Receipt 1 closes before the first cutoff, receipt 2 is still open.
+    A later txn partition redeems receipt 2 within 7d (st_7d) but after the first cutoff.
+    Expect:
+    - after init: receipt 1 is final and closed, receipt 2 is open with fh = st = 0
+    - after the refresh: receipt 2 is redeemed (fh = st_7d = 1) and final;
+      receipt 1 is left untouched in its closed part file.
+    """
+    receipts = make_receipts(
+        (1, 9001, 500, "2023-01-01", "2023-01-01", "2023-01-10"),
+        (2, 9002, 500, "2023-01-25", "2023-01-25", "2023-02-10"))
+    receipts = add_receipt_keys(receipts, keys=[1, 2])
+    receipts = cast_datatype(receipts, flag="receipt")
+    rp = "tests/data_test/receipt_state.parquet"; to_parquet(receipts, rp)
+
+    txns_1 = make_txns((1, 9001, "2023-01-05", 2000, 500))
+    txns_1 = add_txn_keys(txns_1, keys=[11])
+    txns_1 = cast_datatype(txns_1, flag="txn")
+    tp1 = "tests/data_test/txn_state_1.parquet"; to_parquet(txns_1, tp1)
+
+    txns_2 = make_txns((2, 9002, "2023-02-01", 2000, 500))
+    txns_2 = add_txn_keys(txns_2, keys=[21])
+    txns_2 = cast_datatype(txns_2, flag="txn")
+    tp2 = "tests/data_test/txn_state_2.parquet"; to_parquet(txns_2, tp2)
+
+    lp = "tests/data_test/labels_state.parquet"
+    build_labels(rp, tp1, lp, short_days=[15, 7], threads=1)
+
+    sd = "tests/data_test/label_state"
+    shutil.rmtree(sd, ignore_errors=True)
+    init_label_state(lp, sd, date(2023, 1, 31), threads=1)
+
+    open_1 = pq.read_table(f"{sd}/open.parquet").to_pandas()
+    assert open_1["receipt_key"].tolist() == [2]
+    assert open_1["label_same_user_fh"].tolist() == [0]
+    assert open_1["label_same_user_st_7d_final"].tolist() == [False]
+    assert open_1["label_same_user_fh_final"].tolist() == [False]
+
+    update_label_state(sd, tp2, date(2023, 2, 28), threads=1)
+
+    assert len(pq.read_table(f"{sd}/open.parquet")) == 0
+    closed_1 = pq.read_table(f"{sd}/closed/part_20230131.parquet").to_pandas()
+    assert closed_1["receipt_key"].tolist() == [1]
+
+    out = read_label_state(sd, threads=1).set_index("receipt_key")
+    assert out.loc[1, "label_same_user_fh"] == 1
+    assert out.loc[2, "label_same_user_fh"] == 1
+    assert out.loc[2, "label_same_user_st_7d"] == 1
+    assert out.loc[2, "label_same_user_st_15d"] == 1
+    assert out.loc[2, "first_valid_txn_key"] == 21
+    assert pd.Timestamp(out.loc[2, "first_valid_txn_time"]) == pd.Timestamp("2023-02-01")
+    assert out["label_final"].all()
+
+
+def test_refresh_failing_before_open_swap(make_txns, make_receipts,
+                                          add_txn_keys, add_receipt_keys,
+                                          cast_datatype, to_parquet):
+    """
+    Case 2: A refresh closes receipt 2 but fails before swapping open.parquet,
+    so receipt 2 is both in a closed part and in the old open.parquet.
+    Expect:
+    - read_label_state returns receipt 2 once, from its closed part
+    - the next refresh does not close receipt 2 a second time
+    - no .tmp files are left behind
+    """
+    receipts = make_receipts((2, 9002, 500, "2023-01-25", "2023-01-25", "2023-02-10"))
+    receipts = add_receipt_keys(receipts, keys=[2])
+    receipts = cast_datatype(receipts, flag="receipt")
+    rp = "tests/data_test/receipt_state_2.parquet"; to_parquet(receipts, rp)
+
+    txns_1 = make_txns((2, 9002, "2023-01-05", 2000, 500))
+    txns_1 = add_txn_keys(txns_1, keys=[11])
+    txns_1 = cast_datatype(txns_1, flag="txn")
+    tp1 = "tests/data_test/txn_state_2_1.parquet"; to_parquet(txns_1, tp1)
+
+    txns_2 = make_txns((2, 9002, "2023-02-01", 2000, 500))
+    txns_2 = add_txn_keys(txns_2, keys=[21])
+    txns_2 = cast_datatype(txns_2, flag="txn")
+    tp2 = "tests/data_test/txn_state_2_2.parquet"; to_parquet(txns_2, tp2)
+
+    empty = txns_2.iloc[:0]
+    tp3 = "tests/data_test/txn_state_2_3.parquet"; to_parquet(empty, tp3)
+
+    lp = "tests/data_test/labels_state_2.parquet"
+    build_labels(rp, tp1, lp, short_days=7, threads=1)
+
+    sd = "tests/data_test/label_state_2"
+    shutil.rmtree(sd, ignore_errors=True)
+    init_label_state(lp, sd, date(2023, 1, 31), threads=1)
+    shutil.copy(f"{sd}/open.parquet", "tests/data_test/open_state_2.parquet")
+
+    update_label_state(sd, tp2, date(2023, 2, 28), threads=1)
+    shutil.copy("tests/data_test/open_state_2.parquet", f"{sd}/open.parquet")
+
+    out = read_label_state(sd, threads=1)
+    assert out["receipt_key"].tolist() == [2]
+    assert out["label_final"].tolist() == [True]
+    assert out["first_valid_txn_key"].tolist() == [21]
+
+    update_label_state(sd, tp3, date(2023, 3, 31), threads=1)
+    assert len(pq.read_table(f"{sd}/open.parquet")) == 0
+    assert not (pathlib.Path(sd) / "closed" / "part_20230331.parquet").exists()
+    assert not list(pathlib.Path(sd).rglob("*.tmp"))
+    assert read_label_state(sd, threads=1)["receipt_key"].tolist() == [2]
@@ -1,4 +1,5 @@
 import pandas as pd
+import numpy as np
 import pyarrow.parquet as pq
 from src.labels import build_labels
 
@@ -127,6 +128,47 @@ def test_happy_path_long_window_short_term_zero(make_txn, make_receipt,
     assert row["label_valid"] == 1
     assert row["first_valid_txn_key"] == 2
 
+# ----------------------------
+# Case 1.3
+# Multi-horizon: redemption on day 17 after receipt; horizons 15/7/30 in one pass
+# → st_15d=0, st_7d=0, st_30d=1; label_same_user_st follows the first horizon
+# repeated / numpy-int horizons are deduped and sorted
+# ----------------------------
+def test_multi_horizon_short_term_labels(make_txn, make_receipt,
+                                         add_txn_key, add_receipt_key,
+                                         cast_datatype, to_parquet):
+    txn = make_txn(user=1, coupon=9001, pay_date="2023-01-18",
+                   pay_amt_cent=5000, reduce_amt_cent=500)
+    txn = add_txn_key(txn, key=3)
+    txn = cast_datatype(txn, flag="txn")
+    tp = "tests/data_test/txn_1_3.parquet"; to_parquet(txn, tp)
+
+    receipt = make_receipt(user=1, coupon=9001, coupon_amt_cent=500,
+                           receive_date="2023-01-01", start_date="2023-01-01", end_date="2023-02-28",
+                           price_limit_cent=1000, coupon_status=1)
+    receipt = add_receipt_key(receipt, key=13)
+    receipt = cast_datatype(receipt, flag="receipt")
+    rp = "tests/data_test/receipt_1_3.parquet"; to_parquet(receipt, rp)
+
+    outp = "tests/data_test/labels_out_1_3.parquet"
+    build_labels(rp, tp, outp, short_days=[15, 7, 30], threads=1)
+    row = pq.read_table(outp).to_pandas().iloc[0]
+
+    assert row["label_same_user_fh"] == 1
+    assert row["label_same_user_st_15d"] == 0
+    assert row["label_same_user_st_7d"] == 0
+    assert row["label_same_user_st_30d"] == 1
+    assert row["label_same_user_st"] == row["label_same_user_st_15d"]
+    assert pd.Timestamp(row["short_end"]) == pd.Timestamp("2023-01-16")
+
+    # repeated horizons and numpy integers: one column per horizon, in ascending order
+    build_labels(rp, tp, outp, short_days=[np.int64(15), 30, 7, 15], threads=1)
+    cols = [c for c in pq.read_schema(outp).names if c.startswith("label_same_user_st_")]
+    assert cols == ["label_same_user_st_7d", "label_same_user_st_15d", "label_same_user_st_30d"]
+    build_labels(rp, tp, outp, short_days=np.int32(30), threads=1)
+    row = pq.read_table(outp).to_pandas().iloc[0]
+    assert row["label_same_user_st"] == row["label_same_user_st_30d"] == 1
+
 # ----------------------------
 # Case 2
 # Inclusivity: Pay_date == start_eff == end_eff → fh=1, st=1
@@ -412,4 +454,78 @@ def test_cross_user_has_own_receipt(make_txn, make_receipt,
 
 
 
-    
\ No newline at end of file
+    
+# ----------------------------
+# Case 7.3
+# Cross-user: several other-user txns in owner window; the other user's own receipts
+# overlap each other and cover only part of them; a same-user txn sits in the window too
+# → other_user_in_window_count=3 AND other_user_without_own_receipt_count=1
+# ----------------------------
+def test_cross_user_partly_covered_by_overlapping_receipts(make_txns, make_receipts,
+                                                           add_txn_keys, add_receipt_keys,
+                                                           cast_datatype, to_parquet):
+    txns = make_txns(
+        (121, 9333, "2023-03-08", 2000, 200),   # owner's own redemption
+        (404, 9333, "2023-03-06", 2000, 200),   # covered by other's 1st receipt
+        (404, 9333, "2023-03-12", 2000, 200),   # covered by other's 2nd receipt (overlapping the 1st)
+        (404, 9333, "2023-03-18", 2000, 200))   # after both of other's receipts → uncovered
+    txns = add_txn_keys(txns, keys=[401, 402, 403, 404])
+    txns = cast_datatype(txns, flag="txn")
+    tp = "tests/data_test/txn_7_3.parquet"; to_parquet(txns, tp)
+
+    receipts = make_receipts(
+        (121, 9333, 200, "2023-03-01", "2023-03-01", "2023-03-20"),
+        (404, 9333, 200, "2023-03-02", "2023-03-02", "2023-03-10"),
+        (404, 9333, 200, "2023-03-09", "2023-03-09", "2023-03-14"))
+    receipts = add_receipt_keys(receipts, keys=[4021, 4022, 4023])
+    receipts = cast_datatype(receipts, flag="receipt")
+    rp = "tests/data_test/receipt_7_3.parquet"; to_parquet(receipts, rp)
+
+    outp = "tests/data_test/labels_out_7_3.parquet"
+    build_labels(rp, tp, outp)
+    owner_row = pq.read_table(outp).to_pandas().query("receipt_key == 4021").iloc[0]
+    assert owner_row["same_user_valid_txn_count"] == 1
+    assert owner_row["other_user_in_window_txn_count"] == 3
+    assert owner_row["other_user_without_own_receipt_txn_count"] == 1
+    assert owner_row["flag_cross_user"] == 1
+
+# ----------------------------
+# Case 8
+# Opt-in profiling: a per-run report with one entry per SECTION block
+# (con.sql writes included; back-to-back runs do not overwrite each other's report)
+# ----------------------------
+def test_profiling_report(make_txn, make_receipt,
+                          add_txn_key, add_receipt_key,
+                          cast_datatype, to_parquet, tmp_path):
+    import json
+    txn = make_txn(user=1, coupon=9001, pay_date="2023-01-10",
+                   pay_amt_cent=5000, reduce_amt_cent=500)
+    txn = cast_datatype(add_txn_key(txn, key=1), flag="txn")
+    tp = "tests/data_test/txn_8.parquet"; to_parquet(txn, tp)
+    receipt = make_receipt(user=1, coupon=9001, coupon_amt_cent=500,
+                           receive_date="2023-01-05", start_date="2023-01-09", end_date="2023-01-15")
+    receipt = cast_datatype(add_receipt_key(receipt, key=11), flag="receipt")
+    rp = "tests/data_test/receipt_8.parquet"; to_parquet(receipt, rp)
+
+    outp = "tests/data_test/labels_out_8.parquet"
+    build_labels(rp, tp, outp, threads=1, profile_dir=tmp_path)
+
+    reports = list(tmp_path.glob("build_labels_*.json"))
+    assert len(reports) == 1
+    with open(reports[0]) as f:
+        report = json.load(f)
+    sections = {s["section"]: s for s in report["sections"]}
+    assert len(sections) == 9
+    load = sections["SECTION 1: Load & cast"]
+    assert load["rows_produced"] == 3   # receipts, receipts_ad_fields, txns: one row each
+    assert all(q["profile"] is not None for q in load["queries"])
+    assert len(pq.read_table(outp)) == 1
+
+    # the write goes through con.sql(...).write_parquet and is timed like any query
+    write = sections["SECTION 9: Write parquet and close"]
+    assert len(write["queries"]) == 1
+    assert write["rows_produced"] == 1
+
+    # a second run right after keeps its own report
+    build_labels(rp, tp, outp, threads=1, profile_dir=tmp_path)
+    assert len(list(tmp_path.glob("build_labels_*.json"))) == 2
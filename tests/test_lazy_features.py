@@ -0,0 +1,54 @@
+import pytest
+import pandas as pd
+import pyarrow.parquet as pq
+from src.cpn_features import coupon_features
+from src.user_features import user_features
+from src.combine_features import features_combining
+from src.lazy_features import lazy_features
+
+def test_lazy_matches_full(make_labelled_receipts, add_receipt_keys,
+                           make_txns, make_visits,
+                           cast_datatype, to_parquet):
+    """
+    Case 1: Two users receiving coupons, purchasing and visiting over a few days; request a few columns.
+    Expect:
+    - only the requested sections and windows to run: no calendar markers, other windows or families
+    - the requested columns equal to those of the full run
+    - an unknown column -> ValueError
+    """
+    receipt_rows = (
+       (1, 9001, 100, 0, "2023-01-01", "2023-01-02", "2023-01-03", 1, 0, 0),
+       (2, 9002, 900, 0, "2023-01-01", "2023-01-02", "2023-01-03", 1, 1, 1),
+       (1, 9003, 500, 1000, "2023-01-02", "2023-01-02", "2023-01-03", 0, 1, 1),
+       (2, 9004, 250, 1000, "2023-01-03", "2023-01-03", "2023-01-03", 1, 0, 0),
+       (1, 9005, 100, 0, "2023-01-04", "2023-01-04", "2023-01-05", 1, 1, 1))
+    rcs = make_labelled_receipts(*receipt_rows)
+    rcs = add_receipt_keys(rcs, keys=range(1, 6))
+    rcs = cast_datatype(rcs, "receipt_labelled")
+    rp = "tests/data_test/rcs_lazy.parquet"; to_parquet(rcs, rp)
+
+    txns = make_txns((1, -1, "2023-01-01", 2500, 0, 1), (2, 9002, "2023-01-02", 2500, 900, 2))
+    txns = cast_datatype(txns, "txn_wo_key")
+    tp = "tests/data_test/txns_lazy.parquet"; to_parquet(txns, tp)
+    visits = make_visits((1, "2023-01-01"), (2, "2023-01-02"), (1, "2023-01-03"))
+    visits = cast_datatype(visits, "visit")
+    vp = "tests/data_test/visits_lazy.parquet"; to_parquet(visits, vp)
+
+    cols = ["Generosity_ratio", "Rate_fh_redeem_1d", "Freq_visit_2d", "label_same_user_fh"]
+    cpn, user = "tests/data_test/cpn_lazy.parquet", "tests/data_test/user_lazy.parquet"
+    plan = lazy_features(cols, rp, tp, vp, cpn, user, "tests/data_test/trainable_lazy.parquet", threads=1)
+    assert (plan.coupon_windows, plan.user_families, plan.user_windows) == ([2], ["visits"], [3])
+    cpn_cols = pq.read_schema(cpn).names
+    assert "Weekday_marker" not in cpn_cols and "Rate_fh_redeem_2d" not in cpn_cols
+    assert "Freq_purchase_2d" not in pq.read_schema(user).names
+
+    coupon_features(rp, "tests/data_test/cpn_lazy_full.parquet", lookback_days=[2, 3], threads=1)
+    user_features(rp, tp, vp, "tests/data_test/user_lazy_full.parquet", lookback_days=[2, 3], threads=1)
+    features_combining("tests/data_test/cpn_lazy_full.parquet", "tests/data_test/user_lazy_full.parquet",
+                       "tests/data_test/trainable_lazy_full.parquet", columns=cols, threads=1)
+    lazy, full = [pq.read_table(f"tests/data_test/trainable_lazy{s}.parquet").to_pandas()
+                  .sort_values("receipt_key").reset_index(drop=True) for s in ["", "_full"]]
+    pd.testing.assert_frame_equal(lazy, full)
+
+    with pytest.raises(ValueError):
+        lazy_features(["Shop_id_code"], rp, tp, vp, cpn, user, "tests/data_test/trainable_lazy.parquet", threads=1)
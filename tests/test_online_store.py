@@ -0,0 +1,59 @@
+import numpy as np
+import pyarrow.parquet as pq
+from src.online_store import OnlineUserStore, build_online_store
+from src.user_features import user_features
+
+def test_online_features_match_batch(make_labelled_receipts, add_receipt_keys,
+                                     make_txns, make_visits,
+                                     cast_datatype, to_parquet):
+    """
+    Case 1: Two users with receipts, orders and visits; one store built at once,
+    one built from two event batches (the second one adding to a day already in the store).
+    Expect:
+    - every receipt's online feature vector equals its row in the user_features table
+    - both stores, and the store saved and loaded back, answer the same
+    - an unknown user has no history and zero rates
+    """
+    receipt_rows = (
+       (1, 9001, 100, 0, "2023-01-02", "2023-01-02", "2023-01-03", 1, 0, 0),
+       (1, 9002, 900, 2000, "2023-01-04", "2023-01-04", "2023-01-05", 0, 1, 1),
+       (1, 9003, 300, 500, "2023-01-04", "2023-01-04", "2023-01-05", 1, 1, 0),
+       (2, 9004, 500, 1000, "2023-01-06", "2023-01-06", "2023-01-08", 0, 0, 0),
+       (1, 9005, 700, 3000, "2023-01-09", "2023-01-09", "2023-01-12", 1, 0, 0))
+    rcs = make_labelled_receipts(*receipt_rows)
+    rcs = add_receipt_keys(rcs, keys=range(1, 6))
+    rcs = cast_datatype(rcs, "receipt_labelled")
+    rp = "tests/data_test/rcs_online.parquet"; to_parquet(rcs, rp)
+
+    txn_rows = (
+        (1, -1, "2023-01-01", 2500, 0, 1),
+        (1, 9002, "2023-01-05", 2500, 900, 2),
+        (1, 9003, "2023-01-05", 2500, 300, 2),
+        (2, -1, "2023-01-03", 1200, 0, 3))
+    txns = make_txns(*txn_rows)
+    txns = cast_datatype(txns, "txn_wo_key")
+    tp = "tests/data_test/txns_online.parquet"; to_parquet(txns, tp)
+
+    visits = make_visits((1, "2023-01-01"), (1, "2023-01-03"), (2, "2023-01-02"), (1, "2023-01-07"))
+    visits = cast_datatype(visits, "visit")
+    vp = "tests/data_test/visits_online.parquet"; to_parquet(visits, vp)
+
+    out = "tests/data_test/user_online_batch.parquet"
+    user_features(rp, tp, vp, out, lookback_days=[3, 5], threads=1)
+    batch = pq.read_table(out).to_pandas()
+
+    sp = "tests/data_test/online_store.npz"
+    store = build_online_store(rp, tp, vp, sp, lookback_days=[3, 5], threads=1)
+    split = OnlineUserStore(lookback_days=[3, 5])
+    split.update(rcs.iloc[:2], txns.iloc[:1], visits.iloc[:2], threads=1)  # a batch holds whole orders
+    split.update(rcs.iloc[2:], txns.iloc[1:], visits.iloc[2:], threads=1)
+    loaded = OnlineUserStore.load(sp)
+
+    for row in batch.itertuples(index=False):
+        args = (row.User_id_code, row.Receive_date.date(), row.Price_limit_cent, row.Coupon_amt_cent)
+        expected = np.array([getattr(row, c) for c in store.feature_names], dtype=np.float32)
+        for s in (store, split, loaded):
+            np.testing.assert_array_equal(s.vector(*args), expected)
+
+    unknown = store.features(3, batch.Receive_date[0].date(), 1000, 100)
+    assert unknown["no_hist_rcs_marker_2d"] == 1 and unknown["Freq_visit_4d"] == 0
@@ -0,0 +1,46 @@
+import pandas as pd
+import pyarrow.parquet as pq
+from src.cpn_features import coupon_features
+from src.user_features import user_features
+from src.parallel_features import run_feature_families
+
+def test_parallel_families_match_serial(make_labelled_receipts, add_receipt_keys,
+                                        make_txns, make_visits,
+                                        cast_datatype, to_parquet):
+    """
+    Case 1: Two users receiving coupons, purchasing and visiting over a few days.
+    Expect the parallel run (one worker per family, user partials merged on receipt_key)
+    to write exactly the tables of coupon_features and user_features run one after the other.
+    """
+    receipt_rows = (
+       (1, 9001, 100, 0, "2023-01-01", "2023-01-02", "2023-01-03", 1, 0, 0),
+       (2, 9002, 900, 0, "2023-01-01", "2023-01-02", "2023-01-03", 1, 1, 1),
+       (1, 9003, 500, 1000, "2023-01-02", "2023-01-02", "2023-01-03", 0, 1, 1),
+       (2, 9004, 250, 1000, "2023-01-03", "2023-01-03", "2023-01-03", 1, 0, 0),
+       (1, 9005, 100, 0, "2023-01-04", "2023-01-04", "2023-01-05", 1, 1, 1))
+    rcs = make_labelled_receipts(*receipt_rows)
+    rcs = add_receipt_keys(rcs, keys=range(1, 6))
+    rcs = cast_datatype(rcs, "receipt_labelled")
+    rp = "tests/data_test/rcs_parallel.parquet"; to_parquet(rcs, rp)
+
+    txn_rows = (
+	    (1, -1, "2023-01-01", 2500, 0, 1),
+	    (2, 9002, "2023-01-02", 2500, 900, 2),
+	    (1, -1, "2023-01-03", 1200, 0, 3))
+    txns = make_txns(*txn_rows)
+    txns = cast_datatype(txns, "txn_wo_key")
+    tp = "tests/data_test/txns_parallel.parquet"; to_parquet(txns, tp)
+
+    visits = make_visits((1, "2023-01-01"), (2, "2023-01-02"), (1, "2023-01-03"))
+    visits = cast_datatype(visits, "visit")
+    vp = "tests/data_test/visits_parallel.parquet"; to_parquet(visits, vp)
+
+    coupon_features(rp, "tests/data_test/cpn_serial.parquet", lookback_days=[2, 3], threads=1)
+    user_features(rp, tp, vp, "tests/data_test/user_serial.parquet", lookback_days=[2, 3], threads=1)
+    run_feature_families(rp, tp, vp, "tests/data_test/cpn_parallel.parquet", "tests/data_test/user_parallel.parquet",
+                         "tests/data_test/parallel_work", lookback_days=[2, 3], family_threads=1)
+
+    for name in ["cpn", "user"]:
+        serial = pq.read_table(f"tests/data_test/{name}_serial.parquet").to_pandas()
+        parallel = pq.read_table(f"tests/data_test/{name}_parallel.parquet").to_pandas()
+        pd.testing.assert_frame_equal(serial, parallel)
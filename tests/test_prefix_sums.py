@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+import pytest
+from src.prefix_sums import MISSING_TIME, DecayedSums, PrefixSums, check_half_lives
+
+def _us(ts):
+    return pd.Timestamp(ts).value // 1000
+
+def test_window_sums_and_no_history():
+    """
+    Case 1: Two users with daily records; query lookback windows of 3 days (the 2 days before t).
+    Expect:
+    - sums over (t - 3d, t - 1d], the same as two as-of lookups on the running sums
+    - no_hist when the user has no record up to t - 3d, or is unknown / invalid
+    - a missing query time looks up the user's whole history (right = left, sums 0, no_hist 0)
+    """
+    users = np.array([1, 1, 1, 2])
+    times = np.array([_us("2023-01-01"), _us("2023-01-03"), _us("2023-01-04"), _us("2023-01-02")])
+    sums = PrefixSums(users, times, {"vol": np.array([1, 2, 4, 8])})
+
+    q_users = np.array([1, 1, 2, 3, 1, 1])
+    q_times = np.array([_us("2023-01-05"), _us("2023-01-03"), _us("2023-01-05"),
+                        _us("2023-01-05"), MISSING_TIME, _us("2023-01-05")])
+    valid = np.array([True, True, True, True, True, False])
+    no_hist, win = sums.window(q_users, q_times, 3, valid)
+
+    assert win["vol"].tolist() == [6, 1, 0, 0, 0, 0]
+    assert no_hist.tolist() == [False, True, False, True, False, True]
+
+def test_decayed_sums():
+    """
+    Case 2: The same records, decayed with half-lives of 1 and 2 days.
+    Expect:
+    - the sums of the records up to t - 1 day, each weighing 2^(-(t - s) / half-life)
+    - no_hist when the user has no record up to t - 1 day; unknown users and missing times sum to 0
+    - half-lives must be positive whole days
+    """
+    users = np.array([1, 1, 1, 2])
+    times = np.array([_us("2023-01-01"), _us("2023-01-03"), _us("2023-01-04"), _us("2023-01-02")])
+    sums = DecayedSums(users, times, {"vol": np.array([1, 2, 4, 8])}, [1, 2])
+
+    q_users = np.array([1, 1, 2, 3, 1])
+    q_times = np.array([_us("2023-01-05"), _us("2023-01-03"), _us("2023-01-05"), _us("2023-01-05"), MISSING_TIME])
+    no_hist, dec = sums.before(q_users, q_times, 1)
+    assert np.allclose(dec["vol"], [1 / 16 + 2 / 4 + 4 / 2, 1 / 4, 8 / 8, 0, 0])
+    assert no_hist.tolist() == [False, False, False, True, False]
+
+    _, dec = sums.before(q_users, q_times, 2)
+    assert np.allclose(dec["vol"], [1 / 4 + 2 / 2 + 4 / 2 ** 0.5, 1 / 2, 8 / 2 ** 1.5, 0, 0])
+
+    with pytest.raises(ValueError):
+        check_half_lives([0])
@@ -0,0 +1,153 @@
+import json
+import pathlib
+import shutil
+import pytest
+import pandas as pd
+import pyarrow.parquet as pq
+from src.cpn_features import coupon_features
+import src.segment_store
+from src.segment_store import init_segment_store, append_segment_store
+
+def test_appended_days_match_full_rebuild(make_labelled_receipts, add_receipt_keys,
+                                          cast_datatype, to_parquet):
+    """
+    Case 1: Seed the store with the first days of receipts, append the later days,
+    then compute coupon features for the last day's receipts from the store only.
+    Expect:
+    - the same rates as coupon_features over all receipts
+    - appending a day the store already holds is refused
+    """
+    receipt_rows = (
+        (1, 9001, 100, 0, "2023-01-01", "2023-01-02", "2023-01-03", 1, 0, 0),
+        (1, 9002, 900, 0, "2023-01-01", "2023-01-02", "2023-01-03", 1, 1, 1),
+        (2, 9003, 500, 1000, "2023-01-02", "2023-01-02", "2023-01-09", 0, 1, 1),
+        (3, 9004, 250, 1000, "2023-01-03", "2023-01-03", "2023-01-03", 1, 0, 0),
+        (4, 9011, 1000, 10000, "2023-01-03", "2023-01-04", "2023-01-24", 1, 1, 0),
+        (5, 9006, 500, 1000, "2023-01-04", "2023-01-04", "2023-01-06", 1, 0, 0),
+        (6, 9007, 100, 900, "2023-01-05", "2023-01-06", "2023-01-16", 1, 1, 1),
+        (7, 9008, 250, 1000, "2023-01-05", "2023-01-08", "2023-01-08", 0, 0, 0))
+    rcs = make_labelled_receipts(*receipt_rows)
+    rcs = add_receipt_keys(rcs, keys=range(1, 9))
+    rcs = cast_datatype(rcs, "receipt_labelled")
+    rp = "tests/data_test/rcs_store_all.parquet"; to_parquet(rcs, rp)
+    rp1 = "tests/data_test/rcs_store_1.parquet"; to_parquet(rcs[rcs["Receive_date"] <= "2023-01-02"], rp1)
+    rp2 = "tests/data_test/rcs_store_2.parquet"; to_parquet(rcs[rcs["Receive_date"].between("2023-01-03", "2023-01-04")], rp2)
+    rp3 = "tests/data_test/rcs_store_3.parquet"; to_parquet(rcs[rcs["Receive_date"] == "2023-01-05"], rp3)
+
+    sd = "tests/data_test/segment_store"
+    shutil.rmtree(sd, ignore_errors=True)
+    init_segment_store(rp1, sd, threads=1)
+    append_segment_store(sd, rp2, threads=1)
+    append_segment_store(sd, rp3, threads=1)
+
+    outp_full = "tests/data_test/rcs_store_featureout_full.parquet"
+    coupon_features(rp, outp_full, lookback_days=[3, 7], threads=1)
+    outp_inc = "tests/data_test/rcs_store_featureout_inc.parquet"
+    coupon_features(rp3, outp_inc, lookback_days=[3, 7], segment_store_dir=sd, threads=1)
+
+    full = pq.read_table(outp_full).to_pandas().set_index("receipt_key").loc[[7, 8]]
+    inc = pq.read_table(outp_inc).to_pandas().set_index("receipt_key").loc[[7, 8]]
+    pd.testing.assert_frame_equal(full, inc)
+    assert inc["no_history_indicator_6d"].tolist() == [1, 1]
+    assert abs(inc.loc[8, "Rate_invalid_6d"] - 1/5) < 1e-3
+
+    with pytest.raises(ValueError):
+        append_segment_store(sd, rp3, threads=1)
+
+
+def test_store_seeded_without_dated_receipts(make_labelled_receipts, add_receipt_keys,
+                                             cast_datatype, to_parquet):
+    """
+    Case 2: Rebuild an existing store from receipts without a Receive_date only,
+    then append dated receipts.
+    Expect:
+    - the rebuilt store has its sidecar (last_day None, no parts, no last_*.parquet) and no files,
+      none of the previous store's state left over
+    - the appended store gives the same rates as coupon_features over the dated receipts
+    """
+    receipt_rows = (
+        (1, 9001, 100, 0, None, "2023-01-02", "2023-01-03", 1, 0, 0),
+        (2, 9003, 500, 1000, "2023-01-02", "2023-01-02", "2023-01-09", 0, 1, 1),
+        (3, 9004, 250, 1000, "2023-01-03", "2023-01-03", "2023-01-03", 1, 0, 0),
+        (4, 9006, 500, 1000, "2023-01-04", "2023-01-04", "2023-01-06", 1, 1, 0))
+    rcs = make_labelled_receipts(*receipt_rows)
+    rcs = add_receipt_keys(rcs, keys=range(1, 5))
+    rcs = cast_datatype(rcs, "receipt_labelled")
+    rp0 = "tests/data_test/rcs_store_undated.parquet"; to_parquet(rcs[rcs["Receive_date"].isna()], rp0)
+    rp1 = "tests/data_test/rcs_store_dated.parquet"; to_parquet(rcs[rcs["Receive_date"].notna()], rp1)
+
+    sd = "tests/data_test/segment_store_2"
+    shutil.rmtree(sd, ignore_errors=True)
+    init_segment_store(rp1, sd, threads=1)       # a previous store to be rebuilt
+    init_segment_store(rp0, sd, threads=1)
+
+    with open(f"{sd}/segment_store.json") as f:
+        meta = json.load(f)
+    assert (meta["last_day"], meta["parts"], meta["last_parquet"]) == (None, [], None)
+    assert not list(pathlib.Path(sd).glob("last*.parquet"))
+    assert not list(pathlib.Path(sd, "days").glob("*.parquet"))
+
+    append_segment_store(sd, rp1, threads=1)
+    with open(f"{sd}/segment_store.json") as f:
+        assert json.load(f)["last_day"] == "2023-01-04"
+
+    outp_full = "tests/data_test/rcs_store_featureout_full_2.parquet"
+    coupon_features(rp1, outp_full, lookback_days=[3], threads=1)
+    outp_inc = "tests/data_test/rcs_store_featureout_inc_2.parquet"
+    coupon_features(rp1, outp_inc, lookback_days=[3], segment_store_dir=sd, threads=1)
+    pd.testing.assert_frame_equal(pq.read_table(outp_full).to_pandas(), pq.read_table(outp_inc).to_pandas())
+
+
+def test_interrupted_append_is_not_counted(make_labelled_receipts, add_receipt_keys,
+                                           cast_datatype, to_parquet, monkeypatch):
+    """
+    Case 3: Seed the store, let an append fail after writing its files but before committing
+    the sidecar, then run the append again.
+    Expect:
+    - the failed append leaves the sidecar as it was and its part file unread
+    - after the retry, the same rates as coupon_features over all receipts (no day counted twice)
+    """
+    receipt_rows = (
+        (1, 9001, 100, 0, "2023-01-01", "2023-01-02", "2023-01-03", 1, 0, 0),
+        (2, 9003, 500, 1000, "2023-01-02", "2023-01-02", "2023-01-09", 0, 1, 1),
+        (3, 9004, 250, 1000, "2023-01-03", "2023-01-03", "2023-01-03", 1, 0, 0),
+        (4, 9006, 500, 1000, "2023-01-03", "2023-01-04", "2023-01-06", 1, 1, 0),
+        (5, 9007, 100, 900, "2023-01-05", "2023-01-06", "2023-01-16", 1, 1, 1))
+    rcs = make_labelled_receipts(*receipt_rows)
+    rcs = add_receipt_keys(rcs, keys=range(1, 6))
+    rcs = cast_datatype(rcs, "receipt_labelled")
+    rp = "tests/data_test/rcs_store_crash_all.parquet"; to_parquet(rcs, rp)
+    rp1 = "tests/data_test/rcs_store_crash_1.parquet"; to_parquet(rcs[rcs["Receive_date"] <= "2023-01-02"], rp1)
+    rp2 = "tests/data_test/rcs_store_crash_2.parquet"; to_parquet(rcs[rcs["Receive_date"] > "2023-01-02"], rp2)
+
+    sd = "tests/data_test/segment_store_3"
+    shutil.rmtree(sd, ignore_errors=True)
+    init_segment_store(rp1, sd, threads=1)
+    with open(f"{sd}/segment_store.json") as f:
+        meta_before = json.load(f)
+
+    def crash(store_dir, meta):
+        raise OSError("interrupted")
+    with monkeypatch.context() as m:
+        m.setattr(src.segment_store, "_write_meta", crash)
+        with pytest.raises(OSError):
+            append_segment_store(sd, rp2, threads=1)
+    assert len(list(pathlib.Path(sd, "days").glob("*.parquet"))) == 2
+    with open(f"{sd}/segment_store.json") as f:
+        assert json.load(f) == meta_before
+
+    append_segment_store(sd, rp2, threads=1)
+    with open(f"{sd}/segment_store.json") as f:
+        meta = json.load(f)
+    assert meta["last_day"] == "2023-01-05"
+    assert len(meta["parts"]) == 2
+    assert sorted(p.name for p in pathlib.Path(sd).glob("last*.parquet")) == [meta["last_parquet"]]
+
+    outp_full = "tests/data_test/rcs_store_featureout_full_3.parquet"
+    coupon_features(rp, outp_full, lookback_days=[3, 7], threads=1)
+    outp_inc = "tests/data_test/rcs_store_featureout_inc_3.parquet"
+    coupon_features(rp2, outp_inc, lookback_days=[3, 7], segment_store_dir=sd, threads=1)
+
+    full = pq.read_table(outp_full).to_pandas().set_index("receipt_key").loc[[3, 4, 5]]
+    inc = pq.read_table(outp_inc).to_pandas().set_index("receipt_key").loc[[3, 4, 5]]
+    pd.testing.assert_frame_equal(full, inc)
@@ -0,0 +1,82 @@
+import pytest
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from datetime import date
+from src.splitting import (ROI_model_split, policy_model_split, forward_chain_windows,
+                           fold_index_path, load_fold_index, segment_path)
+from src.train import load_segment_fold_data
+
+def _trainable(n=200, seed=0):
+    rng = np.random.default_rng(seed)
+    receive = pd.Timestamp("2023-02-01") + pd.to_timedelta(rng.integers(0, 140, n), unit="D")
+    return pd.DataFrame({
+        "receipt_key": np.arange(1, n + 1),
+        "Receive_date": receive,
+        "Start_date": receive,
+        "End_date": receive + pd.to_timedelta(rng.integers(0, 20, n), unit="D"),
+        "Price_limit_bin": rng.integers(0, 2, n).astype(np.int8),
+        "Coupon_limit_bin": rng.integers(0, 2, n).astype(np.int8),
+        "Expiry_span_bin": np.zeros(n, dtype=np.int8),
+        "Rate_invalid_7d": rng.random(n),
+        "label_invalid": rng.integers(0, 2, n).astype(np.int8)})
+
+def test_segment_partitioned_split(to_parquet):
+    """
+    Case 1: 200 random receipts over 4 segments, ROI split with 3 folds, also written by segment.
+    Expect:
+    - each segment's train/test files to hold exactly its rows of the monolithic sets, sorted by receipt_key
+    - the fold sidecars to select the rows of fold_k_marker = 1 (train) / 2 (val), without marker columns
+    """
+    tp = "tests/data_test/trainable_split.parquet"; to_parquet(_trainable(), tp)
+    train_out, test_out = "tests/data_test/ROI_train_split.parquet", "tests/data_test/ROI_test_split.parquet"
+    seg_dir = "tests/data_test/ROI_segments"
+    ROI_model_split(tp, train_out, test_out, segment_dir=seg_dir, threads=1)
+    train = pq.read_table(train_out).to_pandas()
+    test = pq.read_table(test_out).to_pandas()
+
+    for seg in [[0, 0, 0], [0, 1, 0], [1, 0, 0], [1, 1, 0]]:
+        in_seg = lambda df: df[(df["Price_limit_bin"] == seg[0]) & (df["Coupon_limit_bin"] == seg[1])
+                               & (df["Expiry_span_bin"] == seg[2])].sort_values("receipt_key")
+        seg_test = load_segment_fold_data(seg_dir, [seg], split="test")
+        assert seg_test["receipt_key"].tolist() == in_seg(test)["receipt_key"].tolist()
+        for k in [1, 2, 3]:
+            fold_train, fold_val = load_segment_fold_data(seg_dir, [seg], cols=["receipt_key"], fold=k)
+            expected = in_seg(train)
+            assert fold_train["receipt_key"].tolist() == \
+                expected.loc[expected[f"fold_{k}_marker"] == 1, "receipt_key"].tolist()
+            assert fold_val["receipt_key"].tolist() == \
+                expected.loc[expected[f"fold_{k}_marker"] == 2, "receipt_key"].tolist()
+
+    assert "fold_1_marker" not in pq.read_schema(segment_path(seg_dir, 0, 0, 0) / "train.parquet").names
+
+def test_forward_chain_folds_with_index(to_parquet):
+    """
+    Case 2: The same receipts, policy split on 5 weekly folds of 7-day validation windows with a 3-day purge,
+    memberships in a row-index sidecar.
+    Expect:
+    - fold k: val = received in its window, train = End_date before its start - 3 days, nothing else
+    - the train set sorted by receipt_key without marker columns; the sidecar indexing its rows
+    - bad fold parameters -> ValueError
+    """
+    tp = "tests/data_test/trainable_split.parquet"; to_parquet(_trainable(), tp)
+    train_out, test_out = "tests/data_test/policy_train_idx.parquet", "tests/data_test/policy_test_idx.parquet"
+    windows = forward_chain_windows(date(2023, 4, 1), n_folds=5, step_days=7, val_days=7)
+    assert windows[1] == (date(2023, 4, 8), date(2023, 4, 14))
+    policy_model_split(tp, train_out, test_out, fold_windows=windows, purge_days=3, fold_index=True, threads=1)
+
+    train = pq.read_table(train_out).to_pandas()
+    assert not any(c.startswith("fold_") for c in train.columns)
+    assert train["receipt_key"].is_monotonic_increasing
+    idx = load_fold_index(fold_index_path(train_out))
+    assert sorted(idx) == sorted(f"fold_{k}_{p}" for k in range(1, 6) for p in ["train", "val"])
+    for k, (val_start, val_end) in enumerate(windows, 1):
+        val = train["Receive_date"].between(pd.Timestamp(val_start), pd.Timestamp(val_end))
+        fit = ~val & (train["End_date"] < pd.Timestamp(val_start) - pd.Timedelta(days=3))
+        assert idx[f"fold_{k}_val"].tolist() == np.flatnonzero(val).tolist()
+        assert idx[f"fold_{k}_train"].tolist() == np.flatnonzero(fit).tolist()
+
+    with pytest.raises(ValueError):
+        forward_chain_windows(date(2023, 4, 1), n_folds=0, step_days=7, val_days=7)
+    with pytest.raises(ValueError):
+        policy_model_split(tp, train_out, test_out, fold_windows=[(date(2023, 4, 8), date(2023, 4, 1))], threads=1)
@@ -0,0 +1,40 @@
+import pytest
+import numpy as np
+import pyarrow.parquet as pq
+from src.target_encoding import target_encoding
+
+def test_smoothed_coupon_rates(make_labelled_receipts, add_receipt_keys,
+                               cast_datatype, to_parquet):
+    """
+    Case 1: Coupon 9001 received 3 times, coupon 9002 once; encode by Coupon_id_code over 4-day windows, m = 2.
+    Expect:
+    - only receipts of the days before count (same-day receipts and the receipt's own label do not)
+    - the key's rate smoothed towards all receipts' rate of the same window: (sum + m * prior) / (n + m)
+    - no history -> the prior; no_hist while the key's history does not reach back a whole window
+    - a missing key column -> ValueError
+    """
+    receipt_rows = (
+       (1, 9001, 100, 1000, "2023-01-01", "2023-01-01", "2023-01-09", 1, 1, 1),
+       (2, 9001, 100, 1000, "2023-01-02", "2023-01-02", "2023-01-09", 0, 0, 0),
+       (3, 9002, 100, 1000, "2023-01-02", "2023-01-02", "2023-01-09", 1, 0, 0),
+       (4, 9001, 100, 1000, "2023-01-03", "2023-01-03", "2023-01-09", 1, 1, 0))
+    rcs = make_labelled_receipts(*receipt_rows)
+    rcs = add_receipt_keys(rcs, keys=range(1, 5))
+    rcs = cast_datatype(rcs, "receipt_labelled")
+    rp = "tests/data_test/rcs_te.parquet"; to_parquet(rcs, rp)
+
+    out = "tests/data_test/rcs_te_out.parquet"
+    target_encoding(rp, out, {"coupon": ["Coupon_id_code"]}, labels=["label_invalid", "label_same_user_fh"],
+                    lookback_days=[4], smoothing=2, threads=1)
+    df = pq.read_table(out).to_pandas()
+
+    assert df["no_hist_te_coupon_marker_3d"].tolist() == [1, 1, 1, 1]
+    # receipt 4 (coupon 9001, Jan 3): coupon history = receipts 1, 2; all history = receipts 1, 2, 3
+    prior_fh = 1 / 3
+    expected_fh = [0, (1 + 2 * 1) / (1 + 2), 1, (1 + 2 * prior_fh) / (2 + 2)]
+    np.testing.assert_allclose(df["Rate_te_coupon_same_user_fh_3d"], expected_fh, rtol=1e-6)
+    prior_invalid = 1 / 3
+    assert df["Rate_te_coupon_invalid_3d"][3] == pytest.approx((1 + 2 * prior_invalid) / (2 + 2), rel=1e-6)
+
+    with pytest.raises(ValueError):
+        target_encoding(rp, out, {"shop": ["Shop_id_code"]}, threads=1)
@@ -1,4 +1,4 @@
-from src.train import _edit_filter, load_policy_certain_segment_data, metric_individual_class_accuracy
+from src.train import _edit_filter, iter_fold_data, load_policy_certain_segment_data, metric_individual_class_accuracy
 import os
 import sys
 import pandas as pd
@@ -18,6 +18,32 @@ def test_filter_editor():
     assert new_filter_2 == [[("a1", ">", 1), ("a1", "==", 2), ("test_tuple", "==", 1)], 
                             [("a2", ">", 3), ("test_tuple", "==", 1)]]
 
+    # the input filter is left as it was, so several fold filters can be built from it
+    segments = [[("a1", ">", 1)]]
+    _edit_filter(segments, ("fold_1_marker", "==", 1))
+    assert segments == [[("a1", ">", 1)]]
+
+def test_fold_iterator(to_parquet):
+    """
+    One read of a train set with 2 folds' markers, filtered to label_invalid = 0.
+    Expect for each fold: train = marker 1, val = marker != 1 (or = 2 with val_marker=2),
+    only the requested columns, fresh 0..n-1 indices.
+    """
+    df = pd.DataFrame({"x": range(6),
+                       "label_invalid": [0, 0, 0, 0, 0, 1],
+                       "fold_1_marker": [1, 1, 2, 0, 2, 1],
+                       "fold_2_marker": [1, 1, 1, 2, 0, 2]})
+    path = os.path.abspath("tests/data_test/train_folds.parquet"); to_parquet(df, path)
+
+    folds = list(iter_fold_data(path, ["x"], n_folds=2, filters=[[("label_invalid", "==", 0)]]))
+    assert [k for k, _, _ in folds] == [1, 2]
+    assert folds[0][1]["x"].tolist() == [0, 1] and folds[0][2]["x"].tolist() == [2, 3, 4]
+    assert folds[1][1]["x"].tolist() == [0, 1, 2] and folds[1][2]["x"].tolist() == [3, 4]
+    assert list(folds[0][1].columns) == ["x"] and folds[0][2].index.tolist() == [0, 1, 2]
+
+    _, _, val = next(iter_fold_data(path, ["x"], n_folds=2, val_marker=2))
+    assert val["x"].tolist() == [2, 4]
+
 def test_loading_segmented_data():
     repo_root = os.path.dirname(os.getcwd())
 